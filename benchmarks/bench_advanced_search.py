@@ -0,0 +1,182 @@
+"""Benchmark the advanced search "game only" query.
+
+Compares the advanced search query as it was, with an ID-set union subquery
+for every filter, against the current query builder, which leaves out
+filters that match anything. Each search fetches the first page and the
+total count, like the site does. The replays, descriptions and
+character_detect tables in the target database are dropped and recreated.
+
+Run with `python -m benchmarks.bench_advanced_search`
+
+Usage:
+    bench_advanced_search [--url=<url>] [--sizes=<sizes>] [--searches=<searches>]
+
+Options:
+    --url=<url>             Database url [default: sqlite:////tmp/fcreplay_bench.db]
+    --sizes=<sizes>         Comma separated numbers of replays [default: 10000,100000]
+    --searches=<searches>   Number of searches to time per query [default: 20]
+"""
+from docopt import docopt
+from fcreplay import database
+from fcreplay.models import Base, Character_detect, Descriptions, Replays
+from fcreplay.site import queries
+from fcreplay.site import models as site_models
+from fcreplay.site.database import db as site_db
+from flask import Flask
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import datetime
+import random
+import time
+
+GAMES = ['sfiii3nr1', 'garou', 'kof98', 'ssf2t', 'vsav', 'jojoban']
+CHARACTERS = ['Alex', 'Chun-Li', 'Dudley', 'Ken', 'Makoto', 'Ryu', 'Urien', 'Yun']
+
+# Searches to time, (name, advanced_search keyword arguments)
+SEARCHES = [
+    ('game only', {'game_id': 'garou'}),
+    ('game only, any game', {'game_id': 'Any'}),
+    ('game and rank', {'game_id': 'sfiii3nr1', 'p1_rank': '5'}),
+    ('game and characters', {'game_id': 'sfiii3nr1', 'char1': 'Makoto', 'char2': 'Ken'}),
+    ('characters only', {'game_id': 'Any', 'char1': 'Makoto', 'char2': 'Ken'}),
+    ('one character only', {'game_id': 'Any', 'char1': 'Makoto'}),
+]
+
+
+def legacy_advanced_search(game_id, p1_rank, p2_rank, search_query, order_by, char1='Any', char2='Any', p1_name='', p2_name=''):
+    """advanced_search as it was before the query builder."""
+    Replays, Descriptions, Character_detect = site_models.Replays, site_models.Descriptions, site_models.Character_detect
+
+    p1_name = p1_name if p1_name.strip() else '%'
+    p2_name = p2_name if p2_name.strip() else '%'
+    char1 = '%' if char1 == 'Any' else char1
+    char2 = '%' if char2 == 'Any' else char2
+    game_id = '%' if game_id == 'Any' else game_id
+    p1_rank = '%' if p1_rank == 'any' else p1_rank
+    p2_rank = '%' if p2_rank == 'any' else p2_rank
+
+    query = [
+        Replays.created == True,
+        Replays.failed == False,
+        Replays.game.ilike(f'{game_id}'),
+        Replays.video_processed == True,
+        Replays.id.in_(
+            Descriptions.query.with_entities(Descriptions.id).filter(
+                Descriptions.description.ilike(f'%{search_query}%')
+            )
+        ),
+        Replays.id.in_(
+            Replays.query.with_entities(Replays.id).filter(
+                Replays.p1_rank.ilike(f'{p1_rank}'), Replays.p2_rank.ilike(f'{p2_rank}')
+            ).union(
+                Replays.query.with_entities(Replays.id).filter(
+                    Replays.p1_rank.ilike(f'{p2_rank}'), Replays.p2_rank.ilike(f'{p1_rank}')
+                )
+            )
+        ),
+        Replays.id.in_(
+            Replays.query.with_entities(Replays.id).filter(
+                Replays.p1.ilike(f'{p1_name}'), Replays.p2.ilike(f'{p2_name}')
+            ).union(
+                Replays.query.with_entities(Replays.id).filter(
+                    Replays.p1.ilike(f'{p2_name}'), Replays.p2.ilike(f'{p1_name}')
+                )
+            )
+        ),
+    ]
+
+    if char1 != '%' or char2 != '%':
+        query.append(
+            Replays.id.in_(
+                Character_detect.query.with_entities(Character_detect.challenge_id).filter(
+                    Character_detect.p1_char.ilike(f'{char1}'), Character_detect.p2_char.ilike(f'{char2}')
+                ).union(
+                    Character_detect.query.with_entities(Character_detect.challenge_id).filter(
+                        Character_detect.p1_char.ilike(f'{char2}'), Character_detect.p2_char.ilike(f'{char1}')
+                    )
+                )
+            )
+        )
+
+    return Replays.query.filter(*query).order_by(Replays.date_added.desc())
+
+
+def populate(db, size):
+    tables = [t.__table__ for t in (Replays, Descriptions, Character_detect)]
+    Base.metadata.drop_all(db.engine, tables=tables)
+    db.migrate()
+
+    date = datetime.datetime(2022, 1, 1)
+    replays, descriptions, characters = [], [], []
+    for i in range(size):
+        replay_id = f"{1600000000000 + i}-{i % 9999}"
+        p1, p2 = f"player{random.randint(0, 5000)}", f"player{random.randint(0, 5000)}"
+        game = random.choice(GAMES)
+        replays.append({'id': replay_id, 'p1': p1, 'p2': p2,
+                        'p1_rank': str(random.randint(0, 6)), 'p2_rank': str(random.randint(0, 6)),
+                        'created': True, 'failed': False, 'video_processed': True,
+                        'game': game, 'date_added': date + datetime.timedelta(seconds=i),
+                        'length': random.randint(60, 1200)})
+        descriptions.append({'id': replay_id, 'description': f"{p1} vs {p2}\nFightcade replay id: {replay_id}"})
+        for _ in range(random.randint(1, 3)):
+            characters.append({'challenge_id': replay_id, 'game': game,
+                               'p1_char': random.choice(CHARACTERS), 'p2_char': random.choice(CHARACTERS)})
+
+        if len(replays) == 10000:
+            db.engine.execute(Replays.__table__.insert(), replays)
+            db.engine.execute(Descriptions.__table__.insert(), descriptions)
+            db.engine.execute(Character_detect.__table__.insert(), characters)
+            replays, descriptions, characters = [], [], []
+
+    if replays:
+        db.engine.execute(Replays.__table__.insert(), replays)
+        db.engine.execute(Descriptions.__table__.insert(), descriptions)
+        db.engine.execute(Character_detect.__table__.insert(), characters)
+
+    db.engine.execute('ANALYZE')
+
+
+def time_searches(advanced_search, arguments, searches):
+    start = time.perf_counter()
+    for _ in range(searches):
+        pagination = advanced_search(**arguments).paginate(1, per_page=9)
+    return (time.perf_counter() - start) / searches * 1000, pagination.total
+
+
+def main():
+    args = docopt(__doc__)
+    config = SimpleNamespace(
+        sql_baseurl=args['--url'],
+        loglevel='ERROR',
+        sql_pool_size=5,
+        sql_max_overflow=10,
+        sql_pool_recycle=1800,
+    )
+    searches = int(args['--searches'])
+
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = args['--url']
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    site_db.init_app(app)
+
+    with patch('fcreplay.database.Config', return_value=config), app.app_context():
+        database.dispose_engines()
+        db = database.Database()
+
+        for size in [int(s) for s in args['--sizes'].split(',')]:
+            populate(db, size)
+
+            for name, search in SEARCHES:
+                arguments = {'p1_rank': 'any', 'p2_rank': 'any', 'search_query': '', 'order_by': 'date_added', **search}
+                legacy_ms, legacy_total = time_searches(legacy_advanced_search, arguments, searches)
+                current_ms, current_total = time_searches(queries.advanced_search, arguments, searches)
+                assert legacy_total == current_total, 'Query builder should not change results'
+
+                print(f"{size} replays, {name} ({current_total} matches): unions {legacy_ms:.2f}ms, query builder {current_ms:.2f}ms")
+
+        database.dispose_engines()
+
+
+if __name__ == "__main__":
+    main()
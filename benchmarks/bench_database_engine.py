@@ -0,0 +1,91 @@
+"""Benchmark Database startup and connection usage.
+
+Compares the old behaviour (a new engine and create_all for every Database
+instance) with the shared engine registry, for the number of Database
+instances and queries made while recording a single replay.
+
+Run with `python -m benchmarks.bench_database_engine`
+
+Usage:
+    bench_database_engine [--url=<url>] [--runs=<runs>]
+
+Options:
+    --url=<url>     Database url, use postgres to get real connection counts [default: sqlite:////tmp/fcreplay_bench.db]
+    --runs=<runs>   Number of replay runs to simulate [default: 20]
+"""
+from docopt import docopt
+from fcreplay import database
+from fcreplay.models import Base
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import time
+
+# Database instances created during one replay: Replay, UploadYouTube, plus
+# the tasker checking for the replay
+INSTANCES_PER_REPLAY = 3
+
+# Status updates and other writes made while processing one replay
+QUERIES_PER_REPLAY = 15
+
+
+class LegacyDatabase:
+    """Database constructor as it was before the engine registry."""
+
+    def __init__(self, url, connections):
+        self.engine = create_engine(url, pool_pre_ping=True)
+        event.listen(self.engine, 'connect', lambda *args: connections.append(1))
+        Base.metadata.create_all(self.engine)
+        self.Session = sessionmaker(bind=self.engine)
+
+
+def simulate_replay(db_class):
+    dbs = [db_class() for _ in range(INSTANCES_PER_REPLAY)]
+    for i in range(QUERIES_PER_REPLAY):
+        session = dbs[i % len(dbs)].Session()
+        session.execute('select 1')
+        session.commit()
+        session.close()
+
+
+def bench(name, db_class, runs, connections):
+    start = time.perf_counter()
+    for _ in range(runs):
+        simulate_replay(db_class)
+    elapsed = time.perf_counter() - start
+
+    print(f"{name}: {elapsed / runs * 1000:.2f}ms per replay, "
+          f"{len(connections) / runs:.2f} new connections per replay ({len(connections)} total)")
+
+
+def main():
+    args = docopt(__doc__)
+    url = args['--url']
+    runs = int(args['--runs'])
+
+    config = SimpleNamespace(
+        sql_baseurl=url,
+        loglevel='ERROR',
+        sql_pool_size=5,
+        sql_max_overflow=10,
+        sql_pool_recycle=1800,
+    )
+
+    # Make sure the schema exists before timing either approach
+    Base.metadata.create_all(create_engine(url))
+
+    legacy_connections = []
+    bench('legacy', lambda: LegacyDatabase(url, legacy_connections), runs, legacy_connections)
+
+    shared_connections = []
+    with patch('fcreplay.database.Config', return_value=config):
+        database.dispose_engines()
+        event.listen(database.get_engine(), 'connect', lambda *args: shared_connections.append(1))
+        bench('shared', database.Database, runs, shared_connections)
+        database.dispose_engines()
+
+
+if __name__ == "__main__":
+    main()
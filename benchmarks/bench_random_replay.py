@@ -0,0 +1,107 @@
+"""Benchmark random replay selection.
+
+Compares ORDER BY random() with probing the indexed sample_key column, for
+tables of different sizes. The replays table in the target database is
+dropped and recreated.
+
+Run with `python -m benchmarks.bench_random_replay`
+
+Usage:
+    bench_random_replay [--url=<url>] [--sizes=<sizes>] [--picks=<picks>]
+
+Options:
+    --url=<url>       Database url [default: sqlite:////tmp/fcreplay_bench.db]
+    --sizes=<sizes>   Comma separated table sizes [default: 10000,100000,1000000]
+    --picks=<picks>   Number of random picks to time per size [default: 50]
+"""
+from docopt import docopt
+from fcreplay import database
+from fcreplay.models import Base, Replays
+from sqlalchemy import func
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import datetime
+import random
+import time
+
+# Fraction of replays still waiting to be encoded
+PENDING_RATIO = 0.3
+
+
+def populate(db, size):
+    Base.metadata.drop_all(db.engine, tables=[Replays.__table__])
+    db.migrate()
+
+    date = datetime.datetime(2022, 1, 1)
+    rows = []
+    for i in range(size):
+        pending = random.random() < PENDING_RATIO
+        rows.append({
+            'id': f"{1600000000000 + i}-{i % 9999}",
+            'p1': f"player{i % 5000}",
+            'p2': f"player{(i * 7) % 5000}",
+            'created': not pending,
+            'failed': False,
+            'status': 'ADDED' if pending else 'FINISHED',
+            'date_added': date + datetime.timedelta(seconds=i),
+            'player_requested': False,
+            'game': 'sfiii3nr1',
+            'length': 600,
+            'sample_key': random.random(),
+        })
+
+        if len(rows) == 10000:
+            db.engine.execute(Replays.__table__.insert(), rows)
+            rows = []
+
+    if rows:
+        db.engine.execute(Replays.__table__.insert(), rows)
+
+    db.engine.execute('ANALYZE')
+
+
+def order_by_random(db):
+    session = db.Session()
+    replay = session.query(Replays).filter_by(
+        failed=False,
+        created=False,
+        status='ADDED'
+    ).order_by(func.random()).first()
+    session.close()
+    return replay
+
+
+def time_picks(pick, db, picks):
+    start = time.perf_counter()
+    for _ in range(picks):
+        assert pick(db) is not None
+    return (time.perf_counter() - start) / picks * 1000
+
+
+def main():
+    args = docopt(__doc__)
+    config = SimpleNamespace(
+        sql_baseurl=args['--url'],
+        loglevel='ERROR',
+        sql_pool_size=5,
+        sql_max_overflow=10,
+        sql_pool_recycle=1800,
+    )
+    picks = int(args['--picks'])
+
+    with patch('fcreplay.database.Config', return_value=config):
+        database.dispose_engines()
+        db = database.Database()
+
+        for size in [int(s) for s in args['--sizes'].split(',')]:
+            populate(db, size)
+            random_ms = time_picks(order_by_random, db, picks)
+            sample_ms = time_picks(database.Database.get_random_replay, db, picks)
+            print(f"{size} rows: order by random() {random_ms:.2f}ms, sample_key probe {sample_ms:.2f}ms")
+
+        database.dispose_engines()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""Benchmark description and player search.
+
+Compares a plain ilike('%...%') scan with the search index: pg_trgm GIN
+indexes on postgres when available, otherwise the search_trigram table. The
+replays, descriptions, players and search_trigram tables in the target
+database are dropped and recreated.
+
+Run with `python -m benchmarks.bench_search`
+
+Usage:
+    bench_search [--url=<url>] [--sizes=<sizes>] [--searches=<searches>]
+
+Options:
+    --url=<url>             Database url [default: sqlite:////tmp/fcreplay_bench.db]
+    --sizes=<sizes>         Comma separated numbers of replays [default: 10000,100000]
+    --searches=<searches>   Number of searches to time per query [default: 20]
+"""
+from docopt import docopt
+from fcreplay import database, search
+from fcreplay.models import Base, Descriptions, Players, Replays, Search_trigram, Search_trigram_count
+from sqlalchemy import text
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import datetime
+import random
+import time
+
+CHARACTERS = ['Alex', 'Chun-Li', 'Dudley', 'Elena', 'Hugo', 'Ibuki', 'Ken', 'Makoto', 'Necro', 'Oro',
+              'Q', 'Remy', 'Ryu', 'Sean', 'Twelve', 'Urien', 'Yang', 'Yun', 'Akuma', 'Gill']
+LOCATIONS = ['NZ', 'AU', 'JP', 'US', 'BR', 'FR', 'GB', 'KR']
+
+# Searches to time, (name, source, search_query)
+SEARCHES = [
+    ('description', 'description', 'makoto vs chun-li'),
+    ('description, rare', 'description', 'player123 '),
+    ('player', 'player', 'layer42'),
+]
+
+
+def description(replay_id, p1, p2, date_replay):
+    text_value = f"({random.choice(LOCATIONS)}) {p1} (Rank A) vs ({random.choice(LOCATIONS)}) {p2} B - {date_replay}" \
+        f"\nFightcade replay id: {replay_id}"
+    for i in range(random.randint(1, 5)):
+        text_value += f"\n{i}:00 {random.choice(CHARACTERS)} vs {random.choice(CHARACTERS)}"
+    return text_value + f"\n#fightcade\n#sfiii3nr1\n#{p1}\n#{p2}"
+
+
+def populate(db, size):
+    tables = [t.__table__ for t in (Replays, Descriptions, Players, Search_trigram, Search_trigram_count)]
+    Base.metadata.drop_all(db.engine, tables=tables)
+    db.migrate()
+
+    date = datetime.datetime(2022, 1, 1)
+    players = set()
+    replays, descriptions = [], []
+    for i in range(size):
+        replay_id = f"{1600000000000 + i}-{i % 9999}"
+        p1, p2 = f"player{random.randint(0, 5000)}", f"player{random.randint(0, 5000)}"
+        date_replay = date + datetime.timedelta(seconds=i)
+        text_value = description(replay_id, p1, p2, date_replay)
+
+        replays.append({'id': replay_id, 'p1': p1, 'p2': p2, 'created': True, 'failed': False,
+                        'video_processed': True, 'game': 'sfiii3nr1', 'date_added': date_replay})
+        descriptions.append({'id': replay_id, 'description': text_value})
+        players.update((p1, p2))
+
+        if len(replays) == 10000:
+            db.engine.execute(Replays.__table__.insert(), replays)
+            db.engine.execute(Descriptions.__table__.insert(), descriptions)
+            replays, descriptions = [], []
+
+    if replays:
+        db.engine.execute(Replays.__table__.insert(), replays)
+        db.engine.execute(Descriptions.__table__.insert(), descriptions)
+
+    db.engine.execute(Players.__table__.insert(), [{'name': p} for p in players])
+
+    # Builds the search_trigram tables from the rows added above
+    db.migrate()
+    db.engine.execute('ANALYZE')
+
+
+def run_search(db, source, search_query, index):
+    if source == 'description':
+        column, key = Descriptions.description, Descriptions.id
+    else:
+        column, key = Players.name, Players.name
+
+    session = db.Session()
+    results = session.query(key).filter(
+        search.search_filter(column, f'%{search_query}%', key=key, source=source,
+                             search_query=search_query, index=index)
+    ).all()
+    session.close()
+    return len(results)
+
+
+def time_searches(db, source, search_query, index, searches):
+    start = time.perf_counter()
+    for _ in range(searches):
+        run_search(db, source, search_query, index)
+    return (time.perf_counter() - start) / searches * 1000
+
+
+def set_pg_trgm_indexes(db, enabled):
+    """Create or drop the pg_trgm indexes."""
+    for name, table, column in search.POSTGRES_TRIGRAM_INDEXES:
+        if enabled:
+            db.engine.execute(text(f"CREATE INDEX {name} ON {table} USING gin ({column} gin_trgm_ops)"))
+        else:
+            db.engine.execute(text(f"DROP INDEX {name}"))
+
+
+def main():
+    args = docopt(__doc__)
+    config = SimpleNamespace(
+        sql_baseurl=args['--url'],
+        loglevel='ERROR',
+        sql_pool_size=5,
+        sql_max_overflow=10,
+        sql_pool_recycle=1800,
+    )
+    searches = int(args['--searches'])
+
+    with patch('fcreplay.database.Config', return_value=config):
+        database.dispose_engines()
+        db = database.Database()
+
+        for size in [int(s) for s in args['--sizes'].split(',')]:
+            populate(db, size)
+            pg_trgm = search.has_pg_trgm(db.engine)
+            index = None
+            backend = 'pg_trgm' if pg_trgm else 'ilike scan'
+            if search.uses_trigram_table(db.engine):
+                index = search.TrigramIndex(Search_trigram.__table__, Search_trigram_count.__table__)
+                backend = 'search_trigram'
+
+            for name, source, search_query in SEARCHES:
+                matches = run_search(db, source, search_query, index)
+                assert matches == run_search(db, source, search_query, None), 'Index should not change results'
+
+                if pg_trgm:
+                    set_pg_trgm_indexes(db, False)
+                scan_ms = time_searches(db, source, search_query, None, searches)
+                if pg_trgm:
+                    set_pg_trgm_indexes(db, True)
+                index_ms = time_searches(db, source, search_query, index, searches)
+
+                print(f"{size} replays, {name} ({matches} matches): ilike scan {scan_ms:.2f}ms, {backend} {index_ms:.2f}ms")
+
+        database.dispose_engines()
+
+
+if __name__ == "__main__":
+    main()
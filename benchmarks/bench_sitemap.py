@@ -0,0 +1,98 @@
+"""Benchmark building the sitemap.
+
+Times a full build of the video sitemap files, an incremental update after
+a few replays are added, and an update with nothing new. Peak python memory
+is measured with tracemalloc, to check the replays are streamed rather than
+loaded at once. The replays table in the target database is dropped and
+recreated.
+
+Run with `python -m benchmarks.bench_sitemap`
+
+Usage:
+    bench_sitemap [--url=<url>] [--sizes=<sizes>]
+
+Options:
+    --url=<url>         Database url [default: sqlite:////tmp/fcreplay_bench.db]
+    --sizes=<sizes>     Comma separated numbers of replays [default: 100000,500000]
+"""
+from docopt import docopt
+from fcreplay import database
+from fcreplay.models import Base, Replays
+from fcreplay.site.database import db as site_db
+from fcreplay.site.sitemap import Sitemap
+from flask import Flask
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import datetime
+import tempfile
+import time
+import tracemalloc
+
+
+def add_replays(db, start, count):
+    date = datetime.datetime(2022, 1, 1)
+    replays = []
+    for i in range(start, start + count):
+        replays.append({'id': f"{1600000000000 + i}-{i % 9999}", 'created': True, 'failed': False,
+                        'video_processed': True, 'date_added': date + datetime.timedelta(seconds=i)})
+        if len(replays) == 10000:
+            db.engine.execute(Replays.__table__.insert(), replays)
+            replays = []
+
+    if replays:
+        db.engine.execute(Replays.__table__.insert(), replays)
+
+
+def timed(function):
+    tracemalloc.start()
+    start = time.perf_counter()
+    function()
+    elapsed = (time.perf_counter() - start) * 1000
+    peak = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    args = docopt(__doc__)
+    config = SimpleNamespace(
+        sql_baseurl=args['--url'],
+        loglevel='ERROR',
+        sql_pool_size=5,
+        sql_max_overflow=10,
+        sql_pool_recycle=1800,
+    )
+
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = args['--url']
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    site_db.init_app(app)
+
+    with patch('fcreplay.database.Config', return_value=config), app.app_context():
+        database.dispose_engines()
+        db = database.Database()
+
+        for size in [int(s) for s in args['--sizes'].split(',')]:
+            Base.metadata.drop_all(db.engine, tables=[Replays.__table__])
+            db.migrate()
+            add_replays(db, 0, size)
+            db.engine.execute('ANALYZE')
+
+            with tempfile.TemporaryDirectory() as directory:
+                sitemap = Sitemap(directory, 'https://fightcadevids.com')
+
+                full_ms, full_mb = timed(sitemap.update)
+                add_replays(db, size, 100)
+                incremental_ms, incremental_mb = timed(sitemap.update)
+                unchanged_ms, _ = timed(sitemap.update)
+                site_db.session.remove()
+
+            print(f"{size} replays: full {full_ms:.0f}ms (peak {full_mb:.1f}MB), "
+                  f"100 new {incremental_ms:.0f}ms (peak {incremental_mb:.1f}MB), nothing new {unchanged_ms:.0f}ms")
+
+        database.dispose_engines()
+
+
+if __name__ == "__main__":
+    main()
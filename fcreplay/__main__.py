@@ -9,6 +9,8 @@ Usage:
   fcreplay get replay <url> [--playerrequested]
   fcreplay get weekly
   fcreplay instance [--debug]
+  fcreplay migrate
+  fcreplay tasker start all [--max_instances=<instances>]
   fcreplay tasker start check_top_weekly
   fcreplay tasker start check_video_status
   fcreplay tasker start retry_failed_replays
@@ -27,6 +29,7 @@ from docopt import docopt
 from fcreplay import fclogging
 from fcreplay.cli import Cli
 from fcreplay.config import Config
+from fcreplay.database import Database
 from fcreplay.getreplay import Getreplay
 from fcreplay.instance import Instance
 import os
@@ -49,11 +52,11 @@ def main():
 
     if args['tasker']:
         if args['start']:
+            Database().migrate()
+            if args['all']:
+                Tasker().start_all(max_instances=args['--max_instances'])
             if args['recorder']:
-                if '--max_instances' in args:
-                    Tasker().recorder(max_instances=args['--max_instances'])
-                else:
-                    Tasker().recorder()
+                Tasker().recorder(max_instances=args['--max_instances'])
             if args['check_top_weekly']:
                 Tasker().check_top_weekly()
             if args['check_video_status']:
@@ -91,6 +94,9 @@ def main():
         if args['weekly']:
             Getreplay().get_top_weekly()
 
+    elif args['migrate']:
+        Database().migrate()
+
     elif args['instance']:
         i = Instance()
         i.debug = args['--debug']
@@ -8,6 +8,18 @@ import pickle
 import datetime
 
 
+def video_seconds(vid_time: str) -> int:
+    """Return the number of seconds in a video time.
+
+    Args:
+        vid_time (str): Video time, h:mm:ss, mm:ss or ss
+
+    Returns:
+        int: Seconds
+    """
+    return sum(int(x) * 60 ** i for i, x in enumerate(reversed(vid_time.split(':'))))
+
+
 class CharacterDetection:
     """Character detection class from pickle file."""
 
@@ -37,22 +49,22 @@ class CharacterDetection:
 
         return False
 
-    def _get_video_time(self, detection_time: datetime.datetime) -> str:
-        """Return the video time return as a string.
+    def _get_video_time(self, detection_time: datetime.datetime) -> int:
+        """Return the video time in seconds.
+
+        If the previous detection was too soon before this one, it is removed
+        from the timeline.
 
         Args:
             detection_time (Datetime): Datetime of when a detection event happened
 
         Returns:
-            str: String format of video time h:mm:ss
+            int: Seconds since the start of the video
         """
         time_seconds = int((detection_time - self.video_start_time).total_seconds())
-        formatted_time = str(datetime.timedelta(seconds=time_seconds))
         if self._time_too_soon(time_seconds):
             del self.timeline[-1]
-            return formatted_time
-        else:
-            return formatted_time
+        return time_seconds
 
     def _time_too_soon(self, new_time: int) -> bool:
         """Check time against previous time, if it's within a 5 seconds, then return true else return false.
@@ -63,12 +75,7 @@ class CharacterDetection:
         if len(self.timeline) == 0:
             return False
 
-        pt_list = self.timeline[-1][2].split(':')
-        pt_list = list(map(int, pt_list))
-
-        pt_seconds = (((pt_list[0] * 60) + pt_list[1]) * 60) + pt_list[2]
-
-        if (new_time - pt_seconds) < 5:
+        if (new_time - self.timeline[-1][3]) < 5:
             return True
         else:
             return False
@@ -77,7 +84,7 @@ class CharacterDetection:
         """Create a timeline of character changes.
 
         Returns:
-            list: [[str: p1character, str: p2character, str: time]...]
+            list: [[str: p1character, str: p2character, str: time h:mm:ss, int: time in seconds]...]
         """
         p1character = None
         p2character = None
@@ -95,7 +102,8 @@ class CharacterDetection:
                 overlay_time = event['date']
 
             if (None not in [p1character, p2character, overlay_time]) and [p1character, p2character] != set_characters:
-                self.timeline.append([p1character, p2character, self._get_video_time(overlay_time)])
+                time_seconds = self._get_video_time(overlay_time)
+                self.timeline.append([p1character, p2character, str(datetime.timedelta(seconds=time_seconds)), time_seconds])
 
         return self.timeline
 
@@ -104,7 +112,7 @@ class CharacterDetection:
 
         Returns:
             list: Returns a nested list of characters and the time they were discovered,
-                  eg: [['p1char', 'p2char', '0:01']]
+                  eg: [['p1char', 'p2char', '0:00:01', 1]]
         """
         self.overlay_data = self._load_overlay_pickle()
 
@@ -100,15 +100,13 @@ class Cli(cmd2.Cmd):
             if not self.yes_or_no("This will delete all failed replays,"):
                 return
 
-        failed_replays = self.db.get_all_failed_replays(limit=9999)
-
-        if failed_replays is not None:
-            for r in failed_replays:
-                self.db.delete_replay(r.id)
-                print(f"Removed replay: {r.id}")
+        counts = self.db.purge_failed()
+        for challenge_id in counts['ids']:
+            print(f"Removed replay: {challenge_id}")
+        if counts['replays']:
+            print(f"Removed {counts['replays']} failed replays")
         else:
             print("No failed replays")
-            return
 
     @cmd2.with_argparser(delete_pending_parser)
     def do_delete_pending(self, args):
@@ -157,13 +155,13 @@ class Cli(cmd2.Cmd):
             if not self.yes_or_no("This will retry all failed replays,"):
                 return
 
-        failed_replays = self.db.get_all_failed_replays(limit=1000)
-        if failed_replays is None:
-            print("No failed replays to retry")
+        counts = self.db.retry_failed()
+        for challenge_id in counts['ids']:
+            print(f"Marked replay {challenge_id} to be re-encoded")
+        if counts['replays']:
+            print(f"Marked {counts['replays']} failed replays to be re-encoded")
         else:
-            for r in failed_replays:
-                self.db.rerecord_replay(r.id)
-                print(f"Marked failed replay {r.id} to be re-encoded")
+            print("No failed replays to retry")
 
     @cmd2.with_argparser(retry_all_broken_replays_parser)
     def do_retry_all_broken_replays(self, args):
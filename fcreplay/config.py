@@ -38,6 +38,9 @@ class Config:
         self.loglevel: str = str()
         "Logging level"
 
+        self.metrics_textfile: str = str()
+        "Path to write stage metrics of the last replay to, in the prometheus text format"
+
         self.min_replay_length: int = int()
         "Minimum length of a replay"
 
@@ -65,6 +68,15 @@ class Config:
         self.sql_baseurl: str = str()
         "Base url for the sql database"
 
+        self.sql_pool_size: int = 5
+        "Number of connections to keep open in the database pool"
+
+        self.sql_max_overflow: int = 10
+        "Number of connections allowed above sql_pool_size"
+
+        self.sql_pool_recycle: int = 1800
+        "Seconds before a pooled database connection is recycled"
+
         self.upload_to_ia: bool = bool()
         "If true, replays will be uploaded to the IA"
 
@@ -214,6 +226,13 @@ class Config:
                     'description': 'Maximum replay length to accept in seconds',
                 }
             },
+            'metrics_textfile': {
+                'type': 'string',
+                'meta': {
+                    'default': '',
+                    'description': 'Write stage metrics of the last replay to this file, eg. for the node_exporter textfile collector',
+                }
+            },
             'min_replay_length': {
                 'type': 'number',
                 'required': True,
@@ -278,6 +297,27 @@ class Config:
                     'description': 'URL of database'
                 }
             },
+            'sql_pool_size': {
+                'type': 'number',
+                'meta': {
+                    'default': 5,
+                    'description': 'Number of connections to keep open in the database pool'
+                }
+            },
+            'sql_max_overflow': {
+                'type': 'number',
+                'meta': {
+                    'default': 10,
+                    'description': 'Number of connections allowed above sql_pool_size'
+                }
+            },
+            'sql_pool_recycle': {
+                'type': 'number',
+                'meta': {
+                    'default': 1800,
+                    'description': 'Seconds before a pooled database connection is recycled'
+                }
+            },
             'upload_to_ia': {
                 'type': 'boolean',
                 'required': True,
@@ -0,0 +1,123 @@
+"""Track running recorder containers from the Docker events API.
+
+The running containers are listed once, then kept up to date from the
+container start and die events, so counting instances doesn't list every
+container on the host. If the event stream fails, it is opened again and
+the containers are listed again.
+
+Example:
+    tracker = ContainerTracker(docker.from_env(), 'fcreplay-instance-')
+    tracker.start()
+    tracker.count()
+"""
+import collections
+import docker
+import logging
+import requests
+import threading
+
+log = logging.getLogger('fcreplay')
+
+# Seconds to wait before opening a failed event stream again
+RECONNECT_DELAY = 5
+
+
+class ContainerTracker:
+    def __init__(self, client, prefix, on_exit=None):
+        """Track containers whose name starts with prefix.
+
+        Args:
+            client (docker.DockerClient): Docker client
+            prefix (str): Container name prefix
+            on_exit (function, optional): Called with the container name when a container dies,
+                from the event thread
+        """
+        self.client = client
+        self.prefix = prefix
+        self.on_exit = on_exit
+        self._running = {}  # Container id: name
+        self._exited = collections.deque(maxlen=100)  # Recently died ids, so a late add doesn't count them
+        self._lock = threading.Lock()
+        self._stream = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def sync(self):
+        """List the running containers again."""
+        containers = self.client.containers.list(filters={'name': self.prefix})
+        with self._lock:
+            self._running = {c.id: c.name for c in containers if c.name.startswith(self.prefix)}
+
+    def start(self):
+        """List the running containers, and follow events in a daemon thread."""
+        # Opened before listing, so no container is missed in between
+        self._stream = self._open_stream()
+        self.sync()
+        self._thread = threading.Thread(target=self._follow, name='container-events', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._stream is not None:
+            self._stream.close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _open_stream(self):
+        return self.client.events(decode=True, filters={'type': 'container', 'event': ['start', 'die']})
+
+    def _follow(self):
+        while not self._stopped.is_set():
+            try:
+                if self._stream is None:
+                    # Containers may have started or died while the stream was down
+                    self._stream = self._open_stream()
+                    self.sync()
+
+                for event in self._stream:
+                    self.handle_event(event)
+            except (docker.errors.APIError, requests.exceptions.RequestException) as e:
+                log.warning(f"Docker event stream failed: {e}")
+            except Exception as e:
+                # Eg. a broken chunk or bad JSON in the stream, the thread must keep running
+                log.exception(f"Unexpected error following docker events: {e}")
+
+            if not self._stopped.is_set():
+                self._stream = None
+                self._stopped.wait(RECONNECT_DELAY)
+
+    def handle_event(self, event):
+        """Update the running containers from a container start or die event."""
+        container_id = event.get('id') or event.get('Actor', {}).get('ID')
+        name = event.get('Actor', {}).get('Attributes', {}).get('name', '')
+        if not name.startswith(self.prefix):
+            return
+
+        action = event.get('Action') or event.get('status')
+        if action == 'start':
+            self.add(container_id, name)
+        elif action == 'die':
+            with self._lock:
+                self._running.pop(container_id, None)
+                self._exited.append(container_id)
+            log.info(f"Container {name} exited")
+            if self.on_exit is not None:
+                try:
+                    self.on_exit(name)
+                except Exception as e:
+                    log.exception(f"Container exit callback failed for {name}: {e}")
+
+    def add(self, container_id, name):
+        """Count a container as running, eg. one just started by the tasker."""
+        with self._lock:
+            if container_id not in self._exited:
+                self._running[container_id] = name
+
+    def count(self):
+        """Return the number of running containers."""
+        with self._lock:
+            return len(self._running)
+
+    def is_running(self, name):
+        with self._lock:
+            return name in self._running.values()
@@ -1,13 +1,132 @@
+from contextlib import contextmanager
+from fcreplay import eta, metrics, notify, search
+from fcreplay.character_detection import video_seconds
 from fcreplay.config import Config
 from fcreplay.models import Base
-from fcreplay.models import Job, Replays, Character_detect, Descriptions, Youtube_day_log
-from sqlalchemy import create_engine, func
+from fcreplay.models import Cache_generation, Job, Replays, Character_detect, Descriptions, Game_count, Players, Search_trigram, Search_trigram_count, Stage_timing, Youtube_day_log
+from fcreplay.status import status
+from sqlalchemy import bindparam, case, create_engine, delete, event, exists, func, inspect, or_, select, text, tuple_, union, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.orm import sessionmaker
+import collections
 import datetime
 import logging
+import random
+import threading
 
 log = logging.getLogger('fcreplay')
 
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def get_engine(config: Config = None):
+    """Return the process wide engine for the configured database.
+
+    Engines are created once per database url and shared by every Database
+    instance in the process, so a replay run uses a single connection pool.
+
+    Args:
+        config (Config, optional): Config to read the database settings from
+
+    Returns:
+        sqlalchemy.engine.Engine: Shared engine
+    """
+    if config is None:
+        config = Config()
+
+    with _engines_lock:
+        if config.sql_baseurl not in _engines:
+            _engines[config.sql_baseurl] = _create_engine(config)
+
+        return _engines[config.sql_baseurl]
+
+
+def dispose_engines():
+    """Dispose of all shared engines and close their pooled connections."""
+    with _engines_lock:
+        for engine in _engines.values():
+            engine.dispose()
+        _engines.clear()
+
+
+def _create_engine(config: Config):
+    """Create a new engine using the pool settings from the config.
+
+    Args:
+        config (Config): Config to read the database settings from
+
+    Raises:
+        e: Raises an exception on error
+    """
+    if 'DEBUG' in config.loglevel:
+        sql_echo = True
+    else:
+        logging.getLogger('sqlalchemy').setLevel(logging.ERROR)
+        sql_echo = False
+
+    engine_options = {
+        'echo': sql_echo,
+        'pool_pre_ping': True,
+    }
+
+    # SQLite uses a single connection per thread, so pool sizing doesn't apply
+    if make_url(config.sql_baseurl).get_backend_name() != 'sqlite':
+        engine_options['pool_size'] = config.sql_pool_size
+        engine_options['max_overflow'] = config.sql_max_overflow
+        engine_options['pool_recycle'] = config.sql_pool_recycle
+
+    try:
+        log.debug(f"Creating DB engine with: {config.sql_baseurl}")
+        return create_engine(config.sql_baseurl, **engine_options)
+    except Exception as e:
+        log.error(f"Unable to connect to {config.sql_baseurl}: {e}")
+        raise e
+
+
+def _count_round_trip(*args):
+    _round_trips.count = getattr(_round_trips, 'count', 0) + 1
+
+
+# Statements, commits and rollbacks sent to any database, counted per thread
+_round_trips = threading.local()
+event.listen(Engine, 'before_cursor_execute', _count_round_trip)
+event.listen(Engine, 'commit', _count_round_trip)
+event.listen(Engine, 'rollback', _count_round_trip)
+
+
+def round_trips():
+    """Return the number of statements, commits and rollbacks sent by this thread.
+
+    Compare two values to count the round trips made by some work, eg. a
+    replay run.
+
+    Returns:
+        int: Round trips
+    """
+    return getattr(_round_trips, 'count', 0)
+
+
+ReplayStatus = collections.namedtuple('ReplayStatus', ['replay', 'job_start_time', 'queue_position'])
+
+
+class _TransactionSession:
+    """Session used inside Database.transaction, where commit only flushes and close does nothing."""
+
+    def __init__(self, session):
+        self._session = session
+
+    def commit(self):
+        self._session.flush()
+
+    def close(self):
+        pass
+
+    def __getattr__(self, name):
+        return getattr(self._session, name)
+
 
 class Database:
     """Database class to manage queries."""
@@ -15,27 +134,406 @@ class Database:
     def __init__(self):
         """Initalise the database class.
 
+        The engine is shared between all instances, see get_engine. Tables
+        are not created here, use Database.migrate.
+
         Raises:
             e: Raises an exception on error
         """
-        config = Config()
+        self.engine = get_engine()
+        self._sessionmaker = sessionmaker(bind=self.engine)
+        self._local = threading.local()
 
-        if 'DEBUG' in config.loglevel:
-            sql_echo = True
-        else:
-            logging.getLogger('sqlalchemy').setLevel(logging.ERROR)
-            sql_echo = False
+    def Session(self, **kwargs):
+        """Return a new session, or the open session inside Database.transaction.
+
+        Args:
+            **kwargs: Passed to sessionmaker, ignored inside a transaction
+
+        Returns:
+            sqlalchemy.orm.Session: Session
+        """
+        session = getattr(self._local, 'session', None)
+        if session is not None:
+            return session
+        return self._sessionmaker(**kwargs)
+
+    @contextmanager
+    def transaction(self):
+        """Run every Database method called in the block in one transaction.
+
+        Methods share one session, their commits only flush, and everything
+        is committed when the block exits, or rolled back on an exception.
+        Nested blocks join the outer transaction.
+
+        Example:
+            with db.transaction():
+                db.set_youtube_uploaded(challenge_id, True)
+                db.set_youtube_id(challenge_id, youtube_id)
+        """
+        if getattr(self._local, 'session', None) is not None:
+            yield
+            return
 
-        """Create Engine"""
+        session = self._sessionmaker()
+        self._local.session = _TransactionSession(session)
         try:
-            log.debug(f"Creating DB Instance with: {config.sql_baseurl}")
-            self.engine = create_engine(config.sql_baseurl, echo=sql_echo, pool_pre_ping=True)
-            Base.metadata.create_all(self.engine)
-        except Exception as e:
-            log.error(f"Unable to connect to {config.sql_baseurl}: {e}")
-            raise e
+            yield
+            session.commit()
+        except BaseException:
+            session.rollback()
+            raise
+        finally:
+            self._local.session = None
+            session.close()
+
+    def migrate(self):
+        """Create any missing tables, columns and indexes.
+
+        This should be run once before any other process uses the database.
+        """
+        log.info('Migrating database')
+        Base.metadata.create_all(self.engine)
+        self._add_missing_columns()
+        self._add_missing_indexes()
+        self._backfill_sample_keys()
+        self._backfill_players()
+        self._backfill_vid_seconds()
+        self._build_search_index()
+        self.refresh_game_counts()
+
+    def _add_missing_columns(self):
+        """Add columns that exist in the models, but not in the database."""
+        inspector = inspect(self.engine)
+
+        for table in Base.metadata.sorted_tables:
+            existing_columns = [c['name'] for c in inspector.get_columns(table.name)]
+
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+
+                column_type = column.type.compile(dialect=self.engine.dialect)
+                log.info(f"Adding column {table.name}.{column.name}")
+                with self.engine.begin() as connection:
+                    connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+
+    def _add_missing_indexes(self):
+        """Create indexes that exist in the models, but not in the database."""
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=self.engine, checkfirst=True)
+
+    def _backfill_sample_keys(self):
+        """Set a random sample_key for replays added before the column existed."""
+        if self.engine.dialect.name == 'sqlite':
+            random_key = func.abs(func.random()) / 9223372036854775808.0
+        else:
+            random_key = func.random()
+
+        session = self.Session()
+        session.query(Replays).filter(
+            Replays.sample_key.is_(None)
+        ).update(
+            {'sample_key': random_key},
+            synchronize_session=False
+        )
+        session.commit()
+        session.close()
+
+    def _backfill_players(self):
+        """Fill the players table from existing replays, if it's empty."""
+        session = self.Session()
+        if session.query(Players).first() is None:
+            names = union(
+                select(Replays.p1).where(Replays.p1.isnot(None)),
+                select(Replays.p2).where(Replays.p2.isnot(None))
+            )
+            session.execute(Players.__table__.insert().from_select(['name'], names))
+            session.commit()
+        session.close()
+
+    def _backfill_vid_seconds(self, batch_size=10000):
+        """Set vid_seconds for characters detected before the column existed.
+
+        Rows with a vid_time that can't be parsed are left with vid_seconds NULL.
+        """
+        session = self.Session()
+        last_id = None
+        while True:
+            query = session.query(Character_detect.id, Character_detect.vid_time).filter(
+                Character_detect.vid_seconds.is_(None),
+                Character_detect.vid_time.isnot(None)
+            )
+            # Unparsable rows stay NULL, so page by id instead of fetching the first batch again
+            if last_id is not None:
+                query = query.filter(Character_detect.id > last_id)
+            rows = query.order_by(Character_detect.id).limit(batch_size).all()
+            if not rows:
+                break
+            last_id = rows[-1].id
+
+            updates = []
+            for r in rows:
+                try:
+                    updates.append({'row_id': r.id, 'seconds': video_seconds(r.vid_time)})
+                except ValueError:
+                    log.warning(f"Unable to parse vid_time '{r.vid_time}' of character_detect row {r.id}")
+
+            if updates:
+                session.execute(
+                    Character_detect.__table__.update().where(
+                        Character_detect.id == bindparam('row_id')
+                    ).values(vid_seconds=bindparam('seconds')),
+                    updates
+                )
+                session.commit()
+        session.close()
+
+    def _build_search_index(self):
+        """Create the indexes used by substring search, see fcreplay.search.
+
+        On postgres these are pg_trgm GIN indexes, and the search_trigram
+        tables are emptied. Other databases fill the search_trigram table from
+        existing descriptions and players, if it's empty.
+        """
+        if not search.uses_trigram_table(self.engine):
+            try:
+                with self.engine.begin() as connection:
+                    connection.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            except DBAPIError as e:
+                log.warning(f"Unable to create pg_trgm extension: {e.orig}")
+
+            if search.has_pg_trgm(self.engine):
+                with self.engine.begin() as connection:
+                    for name, table, column in search.POSTGRES_TRIGRAM_INDEXES:
+                        connection.execute(text(
+                            f"CREATE INDEX IF NOT EXISTS {name} ON {table} USING gin ({column} gin_trgm_ops)"
+                        ))
+            else:
+                log.error('pg_trgm is not installed, searches will scan the tables until it is installed and migrate is run again')
+
+            # Left from when postgres without pg_trgm used the search_trigram tables
+            with self.engine.begin() as connection:
+                connection.execute(Search_trigram.__table__.delete())
+                connection.execute(Search_trigram_count.__table__.delete())
+            return
+
+        session = self.Session()
+        if session.query(Search_trigram).first() is None:
+            sources = [
+                ('description', session.query(Descriptions.id, Descriptions.description)),
+                ('player', session.query(Players.name, Players.name)),
+            ]
+            counts = collections.Counter()
+            for source, query in sources:
+                rows = []
+                for key, text_value in query.yield_per(1000):
+                    rows.extend(search.trigram_rows(source, key, text_value))
+                    if len(rows) >= 10000:
+                        session.execute(Search_trigram.__table__.insert(), rows)
+                        counts.update((r['trigram'], r['source']) for r in rows)
+                        rows = []
+                if rows:
+                    session.execute(Search_trigram.__table__.insert(), rows)
+                    counts.update((r['trigram'], r['source']) for r in rows)
+
+            session.query(Search_trigram_count).delete()
+            if counts:
+                session.execute(Search_trigram_count.__table__.insert(), [
+                    {'trigram': trigram, 'source': source, 'count': count}
+                    for (trigram, source), count in counts.items()
+                ])
+            session.commit()
+        session.close()
+
+    def _index_search_text(self, session, source, key, text_value):
+        """Add text to the search_trigram tables, when pg_trgm isn't used.
+
+        Args:
+            session (sqlalchemy.orm.Session): Session to use, not committed
+            source (str): What is indexed, 'description' or 'player'
+            key (str): Challenge id or player name, not already indexed
+            text_value (str): Text to index
+        """
+        if not search.uses_trigram_table(self.engine):
+            return
+
+        rows = search.trigram_rows(source, key, text_value)
+        if not rows:
+            return
+
+        session.execute(Search_trigram.__table__.insert(), rows)
+        statement = self._insert(Search_trigram_count).values(
+            trigram=bindparam('trigram'), source=bindparam('source'), count=1
+        )
+        session.execute(statement.on_conflict_do_update(
+            index_elements=[Search_trigram_count.trigram, Search_trigram_count.source],
+            set_={'count': Search_trigram_count.count + 1}
+        ), rows)
+
+    def _unindex_search_text(self, session, source, key):
+        """Remove a key from the search_trigram tables.
 
-        self.Session = sessionmaker(bind=self.engine)
+        Args:
+            session (sqlalchemy.orm.Session): Session to use, not committed
+            source (str): What is indexed, 'description' or 'player'
+            key (str): Challenge id or player name
+        """
+        self._unindex_search_keys(session, source, [key])
+
+    def _unindex_search_keys(self, session, source, keys):
+        """Remove keys from the search_trigram tables.
+
+        Args:
+            session (sqlalchemy.orm.Session): Session to use, not committed
+            source (str): What is indexed, 'description' or 'player'
+            keys (list): Challenge ids or player names, or a select returning them
+        """
+        if not search.uses_trigram_table(self.engine):
+            return
+
+        indexed = session.query(Search_trigram.trigram, func.count()).filter(
+            Search_trigram.source == source,
+            Search_trigram.key.in_(keys)
+        ).group_by(Search_trigram.trigram).all()
+        if not indexed:
+            return
+
+        session.execute(
+            Search_trigram_count.__table__.update().where(
+                Search_trigram_count.trigram == bindparam('indexed_trigram'),
+                Search_trigram_count.source == source
+            ).values(count=Search_trigram_count.count - bindparam('removed')),
+            [{'indexed_trigram': trigram, 'removed': count} for trigram, count in indexed]
+        )
+        session.query(Search_trigram).filter(
+            Search_trigram.source == source,
+            Search_trigram.key.in_(keys)
+        ).delete(synchronize_session=False)
+
+    def _prune_players(self, session, names, batch_size=500):
+        """Remove players that are no longer in any replay, and their search trigrams.
+
+        Args:
+            session (sqlalchemy.orm.Session): Session to use, not committed
+            names (list): Players of the deleted replays, None is ignored
+            batch_size (int, optional): Names checked per statement
+        """
+        names = sorted(set(names) - {None})
+        for i in range(0, len(names), batch_size):
+            unused = [row.name for row in session.execute(
+                select(Players.name).where(
+                    Players.name.in_(names[i:i + batch_size]),
+                    ~exists().where(Replays.p1 == Players.name),
+                    ~exists().where(Replays.p2 == Players.name)
+                )
+            )]
+            if not unused:
+                continue
+
+            self._unindex_search_keys(session, 'player', unused)
+            session.query(Players).filter(Players.name.in_(unused)).delete(synchronize_session=False)
+
+    def _insert(self, model):
+        """Return a dialect specific insert, which supports ON CONFLICT.
+
+        Args:
+            model (Base): Model to insert into
+
+        Returns:
+            sqlalchemy.sql.Insert: Insert statement
+        """
+        if self.engine.dialect.name == 'sqlite':
+            return sqlite.insert(model)
+        return postgresql.insert(model)
+
+    def _adjust_game_count(self, session, game, amount):
+        """Add amount to the created replay count of a game.
+
+        Args:
+            session (sqlalchemy.orm.Session): Session to use, not committed
+            game (str): Game id
+            amount (int): Amount to add, can be negative
+        """
+        statement = self._insert(Game_count).values(id=game, count=max(amount, 0))
+        session.execute(statement.on_conflict_do_update(
+            index_elements=[Game_count.id],
+            set_={'count': Game_count.count + amount}
+        ))
+
+    def _uncount_created_replay(self, session, challenge_id):
+        """Remove a replay from the game counts, if it was created.
+
+        Args:
+            session (sqlalchemy.orm.Session): Session to use, not committed
+            challenge_id (str): Challenge id
+        """
+        replay = session.query(Replays.game, Replays.created).filter_by(
+            id=challenge_id
+        ).first()
+
+        if replay is not None and replay.created:
+            self._adjust_game_count(session, replay.game, -1)
+            self._bump_cache_generation(session)
+
+    def _bump_cache_generation(self, session):
+        """Increment the cache generation, so the site drops its cached pages.
+
+        Args:
+            session (sqlalchemy.orm.Session): Session to use, not committed
+        """
+        statement = self._insert(Cache_generation).values(id='site', generation=1)
+        session.execute(statement.on_conflict_do_update(
+            index_elements=[Cache_generation.id],
+            set_={'generation': Cache_generation.generation + 1}
+        ))
+
+    def refresh_game_counts(self):
+        """Rebuild the per game created replay counts from the replays table."""
+        session = self.Session()
+        counts = session.query(
+            Replays.game, func.count(Replays.id)
+        ).filter(
+            Replays.created == True
+        ).group_by(
+            Replays.game
+        ).all()
+
+        session.query(Game_count).delete()
+        session.add_all([Game_count(id=game, count=count) for game, count in counts])
+        session.commit()
+        session.close()
+
+    def get_game_counts(self):
+        """Get the number of created replays for each game.
+
+        Returns:
+            dict: Game id to number of created replays
+        """
+        session = self.Session()
+        counts = session.query(Game_count).all()
+        session.close()
+        return {c.id: c.count for c in counts}
+
+    def _random_replay_queries(self, query):
+        """Return queries that pick a random replay from query using the sample_key index.
+
+        A random probe is compared against the indexed sample_key, so only a
+        single index lookup is needed instead of sorting every row. When the
+        probe is past the last key the second query wraps around to the start.
+
+        Args:
+            query (sqlalchemy.orm.Query): Query of pending replays
+
+        Returns:
+            list: Queries to try in order
+        """
+        probe = random.random()
+        return [
+            query.filter(Replays.sample_key >= probe).order_by(Replays.sample_key),
+            query.order_by(Replays.sample_key)
+        ]
 
     def add_replay(self, challenge_id,
                    p1_loc, p2_loc,
@@ -94,6 +592,12 @@ class Database:
                 fail_count=fail_count
             )
         )
+        for player in {p1, p2} - {None}:
+            added = session.execute(
+                self._insert(Players).values(name=player).on_conflict_do_nothing()
+            )
+            if added.rowcount == 1:
+                self._index_search_text(session, 'player', player, player)
         session.commit()
         session.close()
 
@@ -142,27 +646,60 @@ class Database:
         session.commit()
         session.close()
 
-    def add_detected_characters(self, challenge_id, p1_char, p2_char, vid_time, game):
+    def add_detected_characters(self, challenge_id, p1_char, p2_char, vid_time, game, vid_seconds=None):
         """Add detected characters to the replay.
 
         Args:
             challenge_id (str): Challenge id of the replay
             p1_char (str): P1 character
             p2_char (str): P2 character
-            vid_time (str): Time in the video the character was detected
+            vid_time (str): Time in the video the character was detected, h:mm:ss
             game (str): Game name
+            vid_seconds (int, optional): vid_time in seconds, parsed from vid_time if not set
         """
+        if vid_seconds is None:
+            vid_seconds = video_seconds(vid_time)
+
         session = self.Session()
         session.add(Character_detect(
             challenge_id=challenge_id,
             p1_char=p1_char,
             p2_char=p2_char,
             vid_time=vid_time,
+            vid_seconds=vid_seconds,
             game=game
         ))
         session.commit()
         session.close()
 
+    def add_detected_characters_bulk(self, challenge_id, game, timeline):
+        """Add a timeline of detected characters to the replay, in one transaction.
+
+        Args:
+            challenge_id (str): Challenge id of the replay
+            game (str): Game name
+            timeline (list): [[p1_char, p2_char, vid_time, vid_seconds]...], see
+                CharacterDetection.get_characters
+        """
+        if not timeline:
+            return
+
+        rows = [
+            {
+                'challenge_id': challenge_id,
+                'p1_char': p1_char,
+                'p2_char': p2_char,
+                'vid_time': vid_time,
+                'vid_seconds': vid_seconds,
+                'game': game
+            } for p1_char, p2_char, vid_time, vid_seconds in timeline
+        ]
+
+        session = self.Session()
+        session.execute(Character_detect.__table__.insert(), rows)
+        session.commit()
+        session.close()
+
     def add_job(self, challenge_id, start_time, length):
         """Add a new encoding job to the database.
 
@@ -211,6 +748,123 @@ class Database:
         session.close()
         return job
 
+    def get_current_job(self):
+        """Return the oldest running job.
+
+        Returns:
+            sqlalchemy.object: Returns sqlalchemy object of job, or None
+        """
+        session = self.Session()
+        job = session.query(Job).order_by(Job.start_time.asc()).first()
+        session.close()
+        return job
+
+    def get_replay_status(self, challenge_id):
+        """Return a replay with its job and player queue position, in one query.
+
+        The queue position is the replay's place among unfinished player
+        requested replays, newest first like claim_next_replay, computed with
+        row_number().
+
+        Args:
+            challenge_id (str): Challenge id
+
+        Returns:
+            ReplayStatus: (replay, job_start_time, queue_position), or None if
+                the replay doesn't exist. job_start_time is None unless the
+                replay is being recorded, queue_position is None unless it's
+                an unfinished player replay.
+        """
+        session = self.Session(expire_on_commit=False)
+        queue = session.query(
+            Replays.id,
+            func.row_number().over(order_by=(Replays.date_added.desc(), Replays.id.desc())).label('position')
+        ).filter_by(
+            player_requested=True,
+            failed=False,
+            created=False
+        ).subquery()
+
+        row = session.query(
+            Replays, Job.start_time, queue.c.position
+        ).outerjoin(
+            Job, Job.id == Replays.id
+        ).outerjoin(
+            queue, queue.c.id == Replays.id
+        ).filter(
+            Replays.id == challenge_id
+        ).first()
+        session.close()
+
+        if row is None:
+            return None
+        return ReplayStatus(*row)
+
+    def add_stage_timing(self, challenge_id, game, stage, replay_length, duration, cpu_seconds=None, peak_rss=None):
+        """Record how long a processing stage took.
+
+        Args:
+            challenge_id (str): Challenge id
+            game (str): Game id
+            stage (str): Stage, see fcreplay.eta.STAGES
+            replay_length (int): Length of the replay in seconds
+            duration (float): Seconds the stage took
+            cpu_seconds (float, optional): CPU time the stage took, including child processes
+            peak_rss (int, optional): Peak resident set size in bytes
+        """
+        session = self.Session()
+        session.add(Stage_timing(
+            challenge_id=challenge_id,
+            game=game,
+            stage=stage,
+            replay_length=replay_length,
+            duration=duration,
+            cpu_seconds=cpu_seconds,
+            peak_rss=peak_rss,
+            date_added=datetime.datetime.utcnow()
+        ))
+        session.commit()
+        session.close()
+
+    def get_stage_statistics(self, since):
+        """Return the sums needed to fit the ETA model, for each stage and game.
+
+        Args:
+            since (datetime): Only use stages finished after this date
+
+        Returns:
+            list: [StageStatistics...]
+        """
+        session = self.Session()
+        statistics = eta.query_stage_statistics(session, Stage_timing, since)
+        session.close()
+        return statistics
+
+    def get_running_replays(self):
+        """Return the replays with a running job, and the stages they have finished.
+
+        Returns:
+            list: [RunningReplay...], see fcreplay.eta.query_running_replays
+        """
+        session = self.Session(expire_on_commit=False)
+        running = eta.query_running_replays(session, Replays, Job, Stage_timing)
+        session.close()
+        return running
+
+    def get_queue_ahead(self, replay):
+        """Return the pending replays that will be claimed before a replay, grouped by game.
+
+        Args:
+            replay (Replays): Pending replay
+
+        Returns:
+            list: [QueuedGroup...], see fcreplay.eta.query_queue_ahead
+        """
+        session = self.Session()
+        groups = eta.query_queue_ahead(session, Replays, replay)
+        session.close()
+        return groups
+
     def get_job_count(self):
         """Return the number of jobs in the database.
 
@@ -240,7 +894,9 @@ class Database:
             str: Number of failed replays.
         """
         session = self.Session()
-        count = session.execute('select count(id) from replays where failed = true').first()[0]
+        count = session.query(func.count(Replays.id)).filter(
+            Replays.failed == True
+        ).scalar()
         session.close()
         return count
 
@@ -251,7 +907,11 @@ class Database:
             str: Number of broken replays
         """
         session = self.Session()
-        count = session.execute("select count(id) from replays where status not like 'ADDED' and status not like 'FINISHED' and failed is false").first()[0]
+        count = session.query(func.count(Replays.id)).filter(
+            Replays.failed == False,
+            Replays.status != 'ADDED',
+            Replays.status != 'FINISHED'
+        ).scalar()
         session.close()
         return count
 
@@ -262,7 +922,10 @@ class Database:
             str: Number of pending replays
         """
         session = self.Session()
-        count = session.execute("select count(id) from replays where created = false and failed = false").first()[0]
+        count = session.query(func.count(Replays.id)).filter(
+            Replays.created == False,
+            Replays.failed == False
+        ).scalar()
         session.close()
         return count
 
@@ -273,10 +936,30 @@ class Database:
             str: Number of completed replays
         """
         session = self.Session()
-        count = session.execute("select count(id) from replays where created = true and failed = false").first()[0]
+        count = session.query(func.count(Replays.id)).filter(
+            Replays.created == True,
+            Replays.failed == False
+        ).scalar()
         session.close()
         return count
 
+    def get_replay_counts(self, since=None):
+        """Return the replay counts used for metrics, see metrics.query_replay_counts.
+
+        Args:
+            since (datetime, optional): Count replays finished after this date. Defaults to an hour ago.
+
+        Returns:
+            metrics.ReplayCounts: Pending and failed replays by status, replays finished since, and running jobs
+        """
+        if since is None:
+            since = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+
+        session = self.Session()
+        counts = metrics.query_replay_counts(session, Replays, Job, since)
+        session.close()
+        return counts
+
     def update_status(self, challenge_id, status):
         """Update the status of a replay.
 
@@ -292,6 +975,7 @@ class Database:
         ).update(
             {'status': status}
         )
+        notify.publish(session, challenge_id, status)
         session.commit()
         session.close()
 
@@ -307,6 +991,7 @@ class Database:
             id=challenge_id,
             description=description
         ))
+        self._index_search_text(session, 'description', challenge_id, description)
         session.commit()
         session.close()
 
@@ -345,6 +1030,131 @@ class Database:
 
         return day_log
 
+    def claim_next_replay(self, worker_id, player_replay_first=True, random_replay=False):
+        """Atomically claim the next replay to be encoded.
+
+        The replay is selected with SELECT ... FOR UPDATE SKIP LOCKED, so
+        multiple instances never claim the same replay. Databases without
+        row locking (sqlite) rely on the status check in the UPDATE instead.
+
+        Args:
+            worker_id (str): Id of the instance claiming the replay, usually the hostname
+            player_replay_first (bool, optional): Claim player requested replays first. Defaults to True.
+            random_replay (bool, optional): Claim a random replay, otherwise the oldest. Defaults to False.
+
+        Returns:
+            sqlalchemy.object: Contains the claimed replay, or None when there is nothing to claim
+        """
+        session = self.Session(expire_on_commit=False)
+
+        pending = session.query(Replays).filter_by(
+            failed=False,
+            created=False,
+            status=status.ADDED
+        )
+
+        candidates = []
+        if player_replay_first:
+            candidates.append(pending.filter_by(player_requested=True).order_by(Replays.date_added.desc(), Replays.id.desc()))
+
+        if random_replay:
+            candidates += self._random_replay_queries(pending)
+        else:
+            candidates.append(pending.order_by(Replays.date_added.desc(), Replays.id.desc()))
+
+        try:
+            for query in candidates:
+                while True:
+                    replay = query.with_for_update(skip_locked=True).first()
+                    if replay is None:
+                        break
+
+                    claimed = session.query(Replays).filter_by(
+                        id=replay.id,
+                        status=status.ADDED
+                    ).update(
+                        {
+                            'status': status.CLAIMED,
+                            'claimed_by': worker_id,
+                            'claimed_at': datetime.datetime.utcnow()
+                        }
+                    )
+                    if claimed == 1:
+                        notify.publish(session, replay.id, status.CLAIMED)
+                    session.commit()
+
+                    if claimed == 1:
+                        log.info(f"Claimed replay {replay.id} for {worker_id}")
+                        return replay
+
+                    # Another instance claimed the replay first
+                    log.debug(f"Replay {replay.id} was claimed by another instance")
+        finally:
+            session.close()
+
+        return None
+
+    def claim_replay(self, challenge_id, worker_id):
+        """Claim a replay, if it is still waiting to be encoded.
+
+        Args:
+            challenge_id (str): Challenge id
+            worker_id (str): Id of the instance claiming the replay, usually the hostname
+
+        Returns:
+            sqlalchemy.object: Contains the claimed replay, or None if it was already claimed
+        """
+        session = self.Session(expire_on_commit=False)
+        claimed = session.query(Replays).filter_by(
+            id=challenge_id,
+            failed=False,
+            created=False,
+            status=status.ADDED
+        ).update(
+            {
+                'status': status.CLAIMED,
+                'claimed_by': worker_id,
+                'claimed_at': datetime.datetime.utcnow()
+            }
+        )
+        if claimed == 1:
+            notify.publish(session, challenge_id, status.CLAIMED)
+        session.commit()
+
+        replay = None
+        if claimed == 1:
+            replay = session.query(Replays).filter_by(id=challenge_id).first()
+            log.info(f"Claimed replay {challenge_id} for {worker_id}")
+        session.close()
+        return replay
+
+    def get_pending_replays(self, limit, exclude=()):
+        """Get the replays next in line to be encoded, player requested replays first, like claim_next_replay.
+
+        Args:
+            limit (int): Maximum number of replays to return
+            exclude (list, optional): Challenge ids to leave out, eg. replays an instance was started for
+
+        Returns:
+            list: Replays
+        """
+        session = self.Session()
+        query = session.query(Replays).filter_by(
+            failed=False,
+            created=False,
+            status=status.ADDED
+        )
+        if exclude:
+            query = query.filter(Replays.id.notin_(list(exclude)))
+
+        replays = query.order_by(
+            case((Replays.player_requested == True, 0), else_=1),
+            Replays.date_added.desc(),
+            Replays.id.desc()
+        ).limit(limit).all()
+        session.close()
+        return replays
+
     def get_oldest_player_replay(self):
         """Get the oldest player that is waiting to be encoded.
 
@@ -372,15 +1182,19 @@ class Database:
             sqlalchemy.object: Contains the replay as a sqlalchemy.object
         """
         session = self.Session()
-        replay = session.query(
+        pending = session.query(
             Replays
         ).filter_by(
             failed=False,
             created=False,
             status='ADDED'
-        ).order_by(
-            func.random()
-        ).first()
+        )
+
+        replay = None
+        for query in self._random_replay_queries(pending):
+            replay = query.first()
+            if replay is not None:
+                break
         session.close()
 
         return replay
@@ -432,23 +1246,34 @@ class Database:
         session.close()
 
     def update_created_replay(self, challenge_id):
-        """Marks the replay as created
+        """Marks the replay as created, and adds it to the game counts.
+
+        The site cache is invalidated the first time a replay is marked created.
 
         Args:
             challenge_id (str): Challenge id
         """
         session = self.Session()
-        session.query(Replays).filter_by(
-            id=challenge_id
+        updated = session.query(Replays).filter(
+            Replays.id == challenge_id,
+            or_(Replays.created == False, Replays.created.is_(None))
         ).update(
             {
-                'created': True
-            }
+                'created': True,
+                'date_finished': datetime.datetime.utcnow()
+            },
+            synchronize_session=False
         )
+
+        # Only count the replay the first time it's marked as created
+        if updated == 1:
+            game = session.query(Replays.game).filter_by(id=challenge_id).scalar()
+            self._adjust_game_count(session, game, 1)
+            self._bump_cache_generation(session)
+
         session.commit()
         session.close()
 
-
     def get_unprocessed_replays(self):
         """Get all replays that are unprocessed.
 
@@ -478,8 +1303,33 @@ class Database:
         ).update(
             {'video_processed': True, "date_added": datetime.datetime.now()}
         )
+        self._bump_cache_generation(session)
+        session.commit()
+        session.close()
+
+    def set_replays_processed(self, challenge_ids):
+        """Set many replays as processed, with one UPDATE.
+
+        Args:
+            challenge_ids (list): Challenge ids
+
+        Returns:
+            int: Number of replays updated
+        """
+        if not challenge_ids:
+            return 0
+
+        session = self.Session()
+        updated = session.query(Replays).filter(
+            Replays.id.in_(challenge_ids)
+        ).update(
+            {'video_processed': True, 'date_added': datetime.datetime.now()},
+            synchronize_session=False
+        )
+        self._bump_cache_generation(session)
         session.commit()
         session.close()
+        return updated
 
     def set_youtube_uploaded(self, challenge_id, yt_bool):
         """Set whether or not video has been uploaded to youtube.
@@ -520,11 +1370,13 @@ class Database:
             challenge_id (str): Challenge id
         """
         session = self.Session()
+        self._uncount_created_replay(session, challenge_id)
+
         # Set replay to original status
         session.query(Replays).filter_by(
             id=challenge_id
         ).update(
-            {'failed': False, 'created': False, 'status': 'ADDED'}
+            {'failed': False, 'created': False, 'status': 'ADDED', 'claimed_by': None, 'claimed_at': None}
         )
         session.commit()
 
@@ -532,6 +1384,7 @@ class Database:
         session.query(Descriptions).filter_by(
             id=challenge_id
         ).delete()
+        self._unindex_search_text(session, 'description', challenge_id)
         session.commit()
 
         # Remove job if it exists
@@ -554,16 +1407,22 @@ class Database:
             challenge_id (str): Challenge id
         """
         session = self.Session()
-        # Remove replay if it exists
+        self._uncount_created_replay(session, challenge_id)
+
+        # Remove replay if it exists, and its players if they have no other replays
+        players = session.query(Replays.p1, Replays.p2).filter_by(id=challenge_id).first()
         session.query(Replays).filter_by(
             id=challenge_id,
         ).delete()
+        if players is not None:
+            self._prune_players(session, players)
         session.commit()
 
         # Remove description if it exists
         session.query(Descriptions).filter_by(
             id=challenge_id
         ).delete()
+        self._unindex_search_text(session, 'description', challenge_id)
         session.commit()
 
         # Remove job if it exists
@@ -579,6 +1438,129 @@ class Database:
         session.commit()
         session.close()
 
+    def _failed_replays(self, max_fails, retry):
+        """Return the condition for failed replays to retry or purge.
+
+        Args:
+            max_fails (int): Replays failing this many times are purged, the rest retried.
+                None matches every failed replay.
+            retry (bool): Match replays to retry, otherwise replays to purge
+        """
+        if max_fails is None:
+            return Replays.failed == True
+        if retry:
+            return (Replays.failed == True) & or_(Replays.fail_count < max_fails, Replays.fail_count == None)
+        return (Replays.failed == True) & (Replays.fail_count >= max_fails)
+
+    def _clear_failed_replays(self, session, condition):
+        """Remove the descriptions, jobs, character detections and game counts of matching replays.
+
+        Args:
+            session (sqlalchemy.orm.Session): Session to use, not committed
+            condition: Replays filter, from _failed_replays
+
+        Returns:
+            dict: Number of rows removed from each table
+        """
+        failed_ids = select(Replays.id).where(condition)
+
+        created = session.query(Replays.game, func.count()).filter(
+            condition,
+            Replays.created == True
+        ).group_by(Replays.game).all()
+        for game, count in created:
+            self._adjust_game_count(session, game, -count)
+        if created:
+            self._bump_cache_generation(session)
+
+        self._unindex_search_keys(session, 'description', failed_ids)
+        return {
+            'descriptions': session.query(Descriptions).filter(
+                Descriptions.id.in_(failed_ids)
+            ).delete(synchronize_session=False),
+            'job': session.query(Job).filter(
+                Job.id.in_(failed_ids)
+            ).delete(synchronize_session=False),
+            'character_detect': session.query(Character_detect).filter(
+                Character_detect.challenge_id.in_(failed_ids)
+            ).delete(synchronize_session=False),
+        }
+
+    def _change_replays(self, session, statement, condition):
+        """Run an UPDATE or DELETE of the replays matching condition, returning their ids.
+
+        Postgres returns the ids with RETURNING. Other databases select them
+        first, after the statements in _clear_failed_replays have locked the
+        database for the transaction.
+
+        Args:
+            session (sqlalchemy.orm.Session): Session to use, not committed
+            statement: update(Replays) or delete(Replays), filtered by condition
+            condition: Replays filter, from _failed_replays
+
+        Returns:
+            list: Ids of the changed replays
+        """
+        if self.engine.dialect.name == 'postgresql':
+            return [row.id for row in session.execute(statement.returning(Replays.id))]
+
+        ids = [row.id for row in session.execute(select(Replays.id).where(condition))]
+        session.execute(statement)
+        return ids
+
+    def retry_failed(self, max_fails=None):
+        """Mark failed replays to be recorded again, like rerecord_replay for each one.
+
+        Runs a statement per table in one transaction, for every matching replay.
+
+        Args:
+            max_fails (int, optional): Only retry replays that failed fewer times. Defaults to every failed replay.
+
+        Returns:
+            dict: Number of rows changed in each table, 'replays' is the number of replays retried
+                and 'ids' their challenge ids
+        """
+        session = self.Session()
+        condition = self._failed_replays(max_fails, retry=True)
+        counts = self._clear_failed_replays(session, condition)
+        statement = update(Replays).where(condition).values(
+            failed=False, created=False, status='ADDED', claimed_by=None, claimed_at=None
+        ).execution_options(synchronize_session=False)
+        counts['ids'] = self._change_replays(session, statement, condition)
+        counts['replays'] = len(counts['ids'])
+        session.commit()
+        session.close()
+        return counts
+
+    def purge_failed(self, max_fails=None):
+        """Delete failed replays, like delete_replay for each one.
+
+        Runs a statement per table in one transaction, for every matching replay.
+        Players left without any replays are removed.
+
+        Args:
+            max_fails (int, optional): Only delete replays that failed at least this many times.
+                Defaults to every failed replay.
+
+        Returns:
+            dict: Number of rows deleted from each table, 'replays' is the number of replays deleted
+                and 'ids' their challenge ids
+        """
+        session = self.Session()
+        condition = self._failed_replays(max_fails, retry=False)
+        counts = self._clear_failed_replays(session, condition)
+        players = session.execute(union(
+            select(Replays.p1).where(condition),
+            select(Replays.p2).where(condition)
+        )).scalars().all()
+        statement = delete(Replays).where(condition).execution_options(synchronize_session=False)
+        counts['ids'] = self._change_replays(session, statement, condition)
+        counts['replays'] = len(counts['ids'])
+        self._prune_players(session, players)
+        session.commit()
+        session.close()
+        return counts
+
     def get_all_failed_replays(self, limit=10):
         """Get all failed replays.
 
@@ -639,16 +1621,10 @@ class Database:
             list: List of play names
         """
         session = self.Session()
-        replays = session.query(Replays).limit(limit).all()
+        players = session.query(Players.name).order_by(Players.name).limit(limit).all()
         session.close()
 
-        players = set()
-
-        for replay in replays:
-            players.add(replay.p1)
-            players.add(replay.p2)
-
-        return list(players)
+        return [p.name for p in players]
 
     def get_all_broken_replays(self, limit=10):
         """Get broken replays.
@@ -0,0 +1,277 @@
+"""Predict how long replays take to process.
+
+Replay records how long each stage took in the stage_timing table. For each
+stage the duration is modelled as a linear function of the replay length,
+fitted with least squares from sums computed in the database (see
+Database.get_stage_statistics). Games with fewer than MIN_SAMPLES timings
+use the fit over every game.
+
+Stages without any history are predicted to take no time, except recording,
+which runs in real time and so takes the replay length.
+
+The query_* functions take the session and models to use, so the site can
+run them with its own models and session, like metrics.query_replay_counts.
+"""
+from fcreplay.status import status
+from sqlalchemy import func, or_, tuple_
+
+import collections
+import decimal
+
+# Stages timed by Replay, in processing order
+STAGES = ['record', 'characters', 'encode', 'thumbnail', 'update_thumbnail', 'description', 'upload_to_ia', 'upload_to_yt']
+
+# Timings needed before a game gets its own fit
+MIN_SAMPLES = 5
+
+# Days of history used for predictions
+HISTORY_DAYS = 30
+
+StageStatistics = collections.namedtuple('StageStatistics', ['stage', 'game', 'count', 'sum_length', 'sum_duration', 'sum_length_squared', 'sum_length_duration'])
+RunningReplay = collections.namedtuple('RunningReplay', ['replay', 'job_start_time', 'completed_stages', 'last_stage_finished'])
+QueuedGroup = collections.namedtuple('QueuedGroup', ['game', 'count', 'total_length'])
+
+
+def _fit(count, sum_length, sum_duration, sum_length_squared, sum_length_duration):
+    """Return (intercept, slope) of the least squares line through the timings."""
+    variance = count * sum_length_squared - sum_length ** 2
+    if count < 2 or variance <= 0:
+        # Every replay had the same length, use the mean duration
+        return sum_duration / count, 0.0
+
+    slope = (count * sum_length_duration - sum_length * sum_duration) / variance
+    intercept = (sum_duration - slope * sum_length) / count
+    return intercept, slope
+
+
+class EtaModel:
+    def __init__(self, statistics):
+        """Build the model.
+
+        Args:
+            statistics (list): StageStatistics for each stage and game
+        """
+        self._fits = {}
+        totals = collections.defaultdict(lambda: [0, 0, 0, 0, 0])
+
+        for s in statistics:
+            sums = [s.count, s.sum_length, s.sum_duration, s.sum_length_squared, s.sum_length_duration]
+            if s.count >= MIN_SAMPLES:
+                self._fits[(s.stage, s.game)] = _fit(*sums)
+            totals[s.stage] = [a + b for a, b in zip(totals[s.stage], sums)]
+
+        for stage, sums in totals.items():
+            if sums[0] > 0:
+                self._fits[(stage, None)] = _fit(*sums)
+
+    def stage_duration(self, stage, game, length):
+        """Return the predicted seconds a stage takes for a replay.
+
+        Args:
+            stage (str): Stage, one of STAGES
+            game (str): Game id
+            length (int): Replay length in seconds
+
+        Returns:
+            float: Seconds
+        """
+        fit = self._fits.get((stage, game)) or self._fits.get((stage, None))
+        if fit is None:
+            return float(length) if stage == 'record' else 0.0
+
+        intercept, slope = fit
+        return max(0.0, intercept + slope * length)
+
+    def group_duration(self, game, count, total_length, stages=STAGES):
+        """Return the predicted seconds to process count replays of a game, one after another.
+
+        Args:
+            game (str): Game id
+            count (int): Number of replays
+            total_length (int): Sum of the replay lengths
+            stages (list, optional): Stages to include. Defaults to STAGES.
+
+        Returns:
+            float: Seconds
+        """
+        if count == 0:
+            return 0.0
+
+        # The model is linear, so the sum of the predictions is the prediction at the mean length, times count
+        return sum(self.stage_duration(stage, game, total_length / count) for stage in stages) * count
+
+    def remaining_duration(self, game, length, completed_stages, elapsed):
+        """Return the predicted seconds left for a replay that is being processed.
+
+        Args:
+            game (str): Game id
+            length (int): Replay length in seconds
+            completed_stages (list): Stages that have finished
+            elapsed (float): Seconds since the last stage finished, or the job started
+
+        Returns:
+            float: Seconds
+        """
+        remaining = [s for s in STAGES if s not in completed_stages]
+        if not remaining:
+            return 0.0
+
+        # Stages are recorded with the next status change, so elapsed can cover
+        # stages that have finished but aren't in completed_stages yet
+        total = sum(self.stage_duration(stage, game, length) for stage in remaining)
+        return max(0.0, total - elapsed)
+
+
+def query_stage_statistics(session, stage_timing, since):
+    """Return the sums needed to fit the model, for each stage and game.
+
+    Args:
+        session (sqlalchemy.orm.Session): Session to query with
+        stage_timing: Stage_timing model, from fcreplay.models or fcreplay.site.models
+        since (datetime): Only use stages finished after this date
+
+    Returns:
+        list: [StageStatistics...]
+    """
+    length = stage_timing.replay_length
+    duration = stage_timing.duration
+
+    rows = session.query(
+        stage_timing.stage,
+        stage_timing.game,
+        func.count(),
+        func.sum(length),
+        func.sum(duration),
+        func.sum(length * length),
+        func.sum(length * duration)
+    ).filter(
+        stage_timing.date_added >= since,
+        length.isnot(None),
+        duration.isnot(None)
+    ).group_by(
+        stage_timing.stage,
+        stage_timing.game
+    ).all()
+
+    return [StageStatistics(*[float(v) if isinstance(v, decimal.Decimal) else v for v in row]) for row in rows]
+
+
+def query_running_replays(session, replays, job, stage_timing):
+    """Return the replays with a running job, and the stages they have finished.
+
+    Args:
+        session (sqlalchemy.orm.Session): Session to query with
+        replays: Replays model
+        job: Job model
+        stage_timing: Stage_timing model
+
+    Returns:
+        list: [RunningReplay...], oldest job first. last_stage_finished is
+            the time the last stage finished, or the job start time.
+    """
+    rows = session.query(
+        replays, job.start_time
+    ).join(
+        job, job.id == replays.id
+    ).order_by(
+        job.start_time.asc()
+    ).all()
+
+    # Stages finished since the job started, earlier runs of a re-recorded replay are ignored
+    timings = session.query(
+        stage_timing.challenge_id, stage_timing.stage, stage_timing.date_added
+    ).join(
+        job, job.id == stage_timing.challenge_id
+    ).filter(
+        stage_timing.date_added >= job.start_time
+    ).all()
+
+    completed = collections.defaultdict(list)
+    for t in timings:
+        completed[t.challenge_id].append(t)
+
+    running = []
+    for replay, start_time in rows:
+        stages = completed[replay.id]
+        running.append(RunningReplay(
+            replay=replay,
+            job_start_time=start_time,
+            completed_stages=[t.stage for t in stages],
+            last_stage_finished=max([start_time] + [t.date_added for t in stages])
+        ))
+    return running
+
+
+def query_queue_ahead(session, replays, replay):
+    """Return the pending replays that will be claimed before a replay, grouped by game.
+
+    Replays are claimed newest first, player replays before any other, so
+    the newer replays are ahead, matching the queue position.
+
+    Args:
+        session (sqlalchemy.orm.Session): Session to query with
+        replays: Replays model
+        replay: Pending replay
+
+    Returns:
+        list: [QueuedGroup...]
+    """
+    query = session.query(
+        replays.game, func.count(), func.coalesce(func.sum(replays.length), 0)
+    ).filter(
+        replays.failed == False,
+        replays.created == False,
+        replays.status == status.ADDED,
+        replays.id != replay.id
+    )
+
+    if replay.player_requested:
+        query = query.filter(
+            replays.player_requested == True,
+            tuple_(replays.date_added, replays.id) > tuple_(replay.date_added, replay.id)
+        )
+    else:
+        query = query.filter(or_(
+            replays.player_requested == True,
+            tuple_(replays.date_added, replays.id) > tuple_(replay.date_added, replay.id)
+        ))
+
+    return [QueuedGroup(game, count, int(total_length)) for game, count, total_length in query.group_by(replays.game).all()]
+
+
+def predict(model, replay, running, queue_ahead, now):
+    """Return the predicted seconds until a replay is finished.
+
+    Replays being processed use the predicted duration of their remaining
+    stages. Queued replays wait for the running jobs and the replays ahead of
+    them in the queue, shared between the running instances, and then for
+    their own processing.
+
+    Args:
+        model (EtaModel): Model to predict with
+        replay: Replay to predict
+        running (list): [RunningReplay...]
+        queue_ahead (callable): Returns the [QueuedGroup...] ahead of the replay, only called for unclaimed replays
+        now (datetime): Current UTC time
+
+    Returns:
+        int: Seconds, or None if the replay is finished or failed
+    """
+    if replay.created or replay.failed:
+        return None
+
+    remaining = {}
+    for r in running:
+        elapsed = (now - r.last_stage_finished).total_seconds()
+        remaining[r.replay.id] = model.remaining_duration(r.replay.game, r.replay.length, r.completed_stages, elapsed)
+
+    if replay.id in remaining:
+        eta = remaining[replay.id]
+    else:
+        eta = model.group_duration(replay.game, 1, replay.length)
+        if replay.status == status.ADDED:
+            # Not claimed yet
+            queued = sum(model.group_duration(g.game, g.count, g.total_length) for g in queue_ahead())
+            eta += (sum(remaining.values()) + queued) / max(1, len(remaining))
+
+    return int(eta)
@@ -56,12 +56,16 @@ class Instance:
                 if self.config.upload_to_yt:
                     if replay.check_bad_words():
                         replay.upload_to_yt()
-                replay.remove_job()
-                replay.db.update_created_replay(challenge_id=replay.replay.id)
-                replay.set_created()
+                with replay.db.transaction():
+                    replay.remove_job()
+                    replay.set_created()
             except Exception as e:
                 replay.handle_fail(e)
 
+            # The replay is finished by now, so these can't fail it
+            replay.log_round_trips()
+            replay.write_metrics()
+
         else:
             log.info("No more replays. Waiting for replay submission")
             time.sleep(5)
@@ -2,79 +2,118 @@ import datetime
 import logging
 
 from fcreplay.database import Database
+from fcreplay.eta import EtaModel, HISTORY_DAYS, predict
 
 log = logging.getLogger('fcreplay')
 
 
+def get_status(challenge_id):
+    """Return the replay, job start time and queue position, see Database.get_replay_status.
+
+    Pass the result to the other helpers to avoid fetching the replay again.
+    """
+    return Database().get_replay_status(challenge_id=challenge_id)
+
+
 def get_current_job_id():
     db = Database()
     job = db.get_current_job()
-    log.info(f"Current job ID is: {job.challenge_id}")
-    return(job.challenge_id)
+    if job is None:
+        log.info("No current job")
+        return None
+    log.info(f"Current job ID is: {job.id}")
+    return(job.id)
 
 
-def get_replay_status(challenge_id):
-    db = Database()
-    replay = db.get_single_replay(challenge_id=challenge_id)
-    log.info(f"Current job STATUS is: {replay.status}")
-    return(replay.status)
+def get_replay_status(challenge_id, replay_status=None):
+    if replay_status is None:
+        replay_status = get_status(challenge_id)
+    log.info(f"Current job STATUS is: {replay_status.replay.status}")
+    return(replay_status.replay.status)
 
 
-def get_current_job_remaining():
-    # Returns the time left to complete current job
+def get_eta_model(db=None):
+    """Return an EtaModel fitted to the last HISTORY_DAYS of stage timings."""
+    if db is None:
+        db = Database()
+    since = datetime.datetime.utcnow() - datetime.timedelta(days=HISTORY_DAYS)
+    return EtaModel(db.get_stage_statistics(since))
+
+
+def get_eta(challenge_id, replay_status=None):
+    """Return the predicted seconds until a replay is finished, see fcreplay.eta.predict.
+
+    Returns:
+        int: Seconds, or None if the replay doesn't exist, is finished or failed
+    """
+    if replay_status is None:
+        replay_status = get_status(challenge_id)
+    if replay_status is None:
+        return None
+
+    replay = replay_status.replay
+    if replay.created or replay.failed:
+        return None
+
     db = Database()
+    eta = predict(get_eta_model(db), replay, db.get_running_replays(), lambda: db.get_queue_ahead(replay),
+                  datetime.datetime.utcnow())
 
-    job = db.get_current_job()
-    current_time = datetime.datetime.utcnow()
-    start_time = job.start_time
-    length = job.length
+    log.info(f"ETA for {challenge_id} is {eta} seconds")
+    return eta
 
-    running_time = int((current_time - start_time).seconds)
-    time_left = length - running_time
 
-    log.info(f"Current job status: running_time: {running_time}, time_left: {time_left}")
+def get_current_job_remaining():
+    # Returns the time left to complete current job
+    challenge_id = get_current_job_id()
+    if challenge_id is None:
+        return 0
 
-    if time_left <= 0:
-        # Time left is less than 0, probably uploading or doing something
+    time_left = get_eta(challenge_id)
+    if time_left is None:
+        # Job finished since it was fetched
         return 0
-    else:
-        return time_left
+
+    log.info(f"Current job status: time_left: {time_left}")
+    return time_left
 
 
 def get_current_job_details():
     challenge_id = get_current_job_id()
-    db = Database()
-    replay = db.get_single_replay(challenge_id=challenge_id)
+    if challenge_id is None:
+        return None
+    replay_status = get_status(challenge_id)
+    if replay_status is None:
+        return None
+    replay = replay_status.replay
     log.info(f"Current job rowdata is: {replay}")
     return(replay)
 
 
-def challenge_exists(challenge_id):
+def challenge_exists(challenge_id, replay_status=None):
     # Checks to see if current challenge exists
-    db = Database()
-    replay = db.get_single_replay(challenge_id=challenge_id)
-    if replay is None:
-        return False
-    else:
-        return True
+    if replay_status is None:
+        replay_status = get_status(challenge_id)
+    return replay_status is not None
 
 
-def player_replay(challenge_id):
+def player_replay(challenge_id, replay_status=None):
     # Check to see if replay is a player requested one
-    db = Database()
-    replay = db.get_single_replay(challenge_id=challenge_id)
-    if replay.player_requested:
+    if replay_status is None:
+        replay_status = get_status(challenge_id)
+    if replay_status.replay.player_requested:
         return True
     else:
         return False
 
 
-def check_if_finished(challenge_id):
-    if challenge_exists(challenge_id):
+def check_if_finished(challenge_id, replay_status=None):
+    if replay_status is None:
+        replay_status = get_status(challenge_id)
+
+    if challenge_exists(challenge_id, replay_status):
         # Checks to see if challenge is already finished
-        db = Database()
-        replay = db.get_single_replay(challenge_id=challenge_id)
-        if replay.status == 'FINISHED':
+        if replay_status.replay.status == 'FINISHED':
             return('FINISHED')
         else:
             return('NOT_FINISHED')
@@ -82,26 +121,20 @@ def check_if_finished(challenge_id):
         return("NO_DATA")
 
 
-def get_queue_position(challenge_id):
+def get_queue_position(challenge_id, replay_status=None):
     # Returns the 'queue position' for a requested replay
-    if challenge_exists(challenge_id):
-        if get_current_job_id() == challenge_id:
+    if replay_status is None:
+        replay_status = get_status(challenge_id)
+
+    if challenge_exists(challenge_id, replay_status):
+        if replay_status.job_start_time is not None:
+            # Replay is being recorded
             return(0)
-        if player_replay(challenge_id):
-            # Get all player replays, then find my position in replays:
-            # Get all unfinished player replays, sorted by date added
-            db = Database()
-
-            replays = db.get_all_queued_player_replays()
-            position = 0
-            log.debug(f"Looking for player replay {challenge_id}")
-            for replay in replays:
-                log.debug(f"Row id: {replay.id}")
-                position += 1
-                if replay.id == challenge_id:
-                    return position
-            # This shouldn't happen, ID was already verified. Maybe database modified while in use?
-            raise IndexError
+        if player_replay(challenge_id, replay_status):
+            if replay_status.queue_position is None:
+                # Finished or failed since it was requested
+                raise IndexError
+            return replay_status.queue_position
         else:
             # Not a player replay
             return("NOT_PLAYER_REPLAY")
@@ -0,0 +1,207 @@
+"""Prometheus metrics in the text exposition format.
+
+Metrics are rendered by hand, the format is simple and it avoids another
+dependency for the site, tasker and recorder instances.
+
+Counters and histograms are kept in memory for this process. Replay gauges
+are counted from the database when metrics are scraped, with one aggregated
+query (see query_replay_counts):
+    fcreplay_queue_depth{status}             Pending replays by status
+    fcreplay_failed_replays{status}          Failed replays by status
+    fcreplay_replays_finished_per_hour       Replays finished in the last hour
+    fcreplay_running_instances               Replays with a running job
+
+The tasker serves its metrics with start_exporter, and the site from /metrics.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from sqlalchemy import func, literal, select, union_all
+
+import bisect
+import collections
+import logging
+import threading
+
+log = logging.getLogger('fcreplay')
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Request latency buckets in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+ReplayCounts = collections.namedtuple('ReplayCounts', ['queued', 'failed', 'finished_per_hour', 'running'])
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _sample(name, labels, value):
+    if labels:
+        label_text = ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+        return f"{name}{{{label_text}}} {value}"
+    return f"{name} {value}"
+
+
+def format_metric(name, metric_type, help_text, samples):
+    """Return a metric in the text format.
+
+    Args:
+        name (str): Metric name
+        metric_type (str): 'gauge' or 'counter'
+        help_text (str): Description of the metric
+        samples (list): [(labels, value)...], labels is a dict
+
+    Returns:
+        str: Metric text, ending with a newline
+    """
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+    lines += [_sample(name, labels, value) for labels, value in samples]
+    return '\n'.join(lines) + '\n'
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._values = collections.defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] += amount
+
+    def render(self):
+        with self._lock:
+            samples = [(dict(key), value) for key, value in sorted(self._values.items())]
+        return format_metric(self.name, 'counter', self.help_text, samples)
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        """Add an observation, eg. the seconds a request took."""
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            values = sorted((key, list(counts), total) for key, (counts, total) in self._values.items())
+
+        for key, counts, total in values:
+            labels = dict(key)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(_sample(f"{self.name}_bucket", dict(labels, le=bound), cumulative))
+            lines.append(_sample(f"{self.name}_sum", labels, total))
+            lines.append(_sample(f"{self.name}_count", labels, cumulative))
+        return '\n'.join(lines) + '\n'
+
+
+def query_replay_counts(session, replays, job, since):
+    """Count pending, failed and recently finished replays, and running jobs.
+
+    The replay counts are one query, a UNION ALL of a grouped query for each
+    kind of replay, so each part reads its own partial index instead of the
+    whole table.
+
+    Args:
+        session (sqlalchemy.orm.Session): Session to query with
+        replays: Replays model, from fcreplay.models or fcreplay.site.models
+        job: Job model
+        since (datetime): Count replays finished after this date
+
+    Returns:
+        ReplayCounts: queued and failed are {status: count}
+    """
+    pending = select(replays.status, func.count(), literal('queued')).where(
+        replays.created == False,
+        replays.failed == False
+    ).group_by(replays.status)
+
+    failed = select(replays.status, func.count(), literal('failed')).where(
+        replays.failed == True
+    ).group_by(replays.status)
+
+    finished = select(replays.status, func.count(), literal('finished')).where(
+        replays.date_finished >= since,
+        replays.created == True,
+        replays.failed == False
+    ).group_by(replays.status)
+
+    counts = {'queued': collections.Counter(), 'failed': collections.Counter(), 'finished': collections.Counter()}
+    for status, count, kind in session.execute(union_all(pending, failed, finished)):
+        counts[kind][status] += count
+
+    running = session.query(func.count(job.id)).scalar()
+    return ReplayCounts(dict(counts['queued']), dict(counts['failed']), sum(counts['finished'].values()), running)
+
+
+def replay_gauges(counts):
+    """Return ReplayCounts as gauges in the text format, see the module docstring."""
+    return ''.join([
+        format_metric('fcreplay_queue_depth', 'gauge', 'Pending replays by status',
+                      [({'status': s}, c) for s, c in sorted(counts.queued.items())]),
+        format_metric('fcreplay_failed_replays', 'gauge', 'Failed replays by status',
+                      [({'status': s}, c) for s, c in sorted(counts.failed.items())]),
+        format_metric('fcreplay_replays_finished_per_hour', 'gauge', 'Replays finished in the last hour',
+                      [({}, counts.finished_per_hour)]),
+        format_metric('fcreplay_running_instances', 'gauge', 'Replays with a running job',
+                      [({}, counts.running)]),
+    ])
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        try:
+            body = self.server.collect().encode()
+        except Exception as e:
+            log.exception(e)
+            self.send_error(500)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(f"Metrics request: {format % args}")
+
+
+def start_exporter(port, collect, host='0.0.0.0'):
+    """Serve metrics from /metrics in a daemon thread.
+
+    Args:
+        port (int): Port to listen on, 0 picks a free port
+        collect (function): Returns the metrics text, called for each request
+        host (str, optional): Address to listen on. Defaults to all addresses.
+
+    Returns:
+        http.server.ThreadingHTTPServer: Server, call shutdown() to stop it
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    server.collect = collect
+
+    thread = threading.Thread(target=server.serve_forever, name='metrics-exporter', daemon=True)
+    thread.start()
+    log.info(f"Serving metrics on port {server.server_address[1]}")
+    return server
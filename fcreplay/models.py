@@ -1,9 +1,15 @@
-from sqlalchemy import Column, String, Integer, DateTime, Boolean, Text
+from sqlalchemy import BigInteger, Column, String, Integer, DateTime, Boolean, Float, Index, Text, and_
 from sqlalchemy.ext.declarative import declarative_base
+import random
 
 Base = declarative_base()
 
 
+def partial_index(name, *columns, where):
+    """Return an index that only covers rows matching where, on postgres and sqlite."""
+    return Index(name, *columns, postgresql_where=where, sqlite_where=where)
+
+
 class Job(Base):
     __tablename__ = 'job'
 
@@ -43,6 +49,59 @@ class Replays(Base):
     video_youtube_id = Column(String)
     fail_count = Column(Integer)
     ia_filename = Column(String)
+    claimed_by = Column(String)  # Hostname of the instance recording the replay
+    claimed_at = Column(DateTime)
+    sample_key = Column(Float, default=random.random)  # Random key used by random replay selection
+    date_finished = Column(DateTime)  # Date the replay was marked created
+
+    __table_args__ = (
+        # Used to pick a random pending replay without sorting the table
+        partial_index('ix_replays_pending_sample_key', sample_key,
+                      where=and_(created == False, failed == False, status == 'ADDED')),
+
+        # Recorder queue and pending counts
+        partial_index('ix_replays_queued', date_added,
+                      where=and_(created == False, failed == False)),
+        partial_index('ix_replays_queued_player', date_added,
+                      where=and_(player_requested == True, created == False, failed == False)),
+
+        # Replays that are recording, encoding or uploading
+        partial_index('ix_replays_in_progress', status,
+                      where=and_(failed == False, status != 'ADDED', status != 'FINISHED')),
+
+        partial_index('ix_replays_failed', fail_count, where=failed == True),
+
+        # Finished replays, waiting for the video to be processed
+        partial_index('ix_replays_unprocessed', id,
+                      where=and_(created == True, failed == False, video_processed == False)),
+
+        # Finished replays, used by feeds and per game counts
+        partial_index('ix_replays_finished', date_added,
+                      where=and_(created == True, failed == False)),
+        partial_index('ix_replays_finished_game', game, date_added,
+                      where=and_(created == True, failed == False)),
+        partial_index('ix_replays_created_game', game, where=created == True),
+        Index('ix_replays_date_finished', date_finished),
+
+        # Replays shown on the site, one index for each sort order
+        partial_index('ix_replays_visible_date_added', date_added, id,
+                      where=and_(created == True, failed == False, video_processed == True)),
+        partial_index('ix_replays_visible_date_replay', date_replay, id,
+                      where=and_(created == True, failed == False, video_processed == True)),
+        partial_index('ix_replays_visible_length', length, id,
+                      where=and_(created == True, failed == False, video_processed == True)),
+
+        # Replays shown on the site for a single game, used by advanced search
+        partial_index('ix_replays_visible_game_date_added', game, date_added, id,
+                      where=and_(created == True, failed == False, video_processed == True)),
+        partial_index('ix_replays_visible_game_date_replay', game, date_replay, id,
+                      where=and_(created == True, failed == False, video_processed == True)),
+        partial_index('ix_replays_visible_game_length', game, length, id,
+                      where=and_(created == True, failed == False, video_processed == True)),
+
+        Index('ix_replays_p1', p1),
+        Index('ix_replays_p2', p2),
+    )
 
 
 class Youtube_day_log(Base):
@@ -54,12 +113,81 @@ class Youtube_day_log(Base):
     # Need to init count somehow
 
 
+class Players(Base):
+    __tablename__ = 'players'
+
+    name = Column(String, primary_key=True)
+
+
+class Search_trigram(Base):
+    """Trigram index used for substring search when pg_trgm isn't available."""
+    __tablename__ = 'search_trigram'
+
+    trigram = Column(String, primary_key=True)
+    source = Column(String, primary_key=True)  # 'description' or 'player'
+    key = Column(String, primary_key=True)  # Challenge id or player name
+
+    __table_args__ = (
+        Index('ix_search_trigram_key', source, key),
+    )
+
+
+class Search_trigram_count(Base):
+    __tablename__ = 'search_trigram_count'
+
+    trigram = Column(String, primary_key=True)
+    source = Column(String, primary_key=True)
+    count = Column(Integer)  # Number of keys the trigram occurs in
+
+
+class Game_count(Base):
+    __tablename__ = 'game_count'
+
+    id = Column(String, primary_key=True)  # Game id
+    count = Column(Integer)  # Number of created replays
+
+
+class Cache_generation(Base):
+    __tablename__ = 'cache_generation'
+
+    id = Column(String, primary_key=True)
+    generation = Column(Integer)  # Incremented when replays shown on the site change
+
+
 class Character_detect(Base):
     __tablename__ = 'character_detect'
 
     id = Column(Integer, primary_key=True)
-    challenge_id = Column(String)
+    challenge_id = Column(String, index=True)
     p1_char = Column(String)
     p2_char = Column(String)
-    vid_time = Column(String)
+    vid_time = Column(String)  # h:mm:ss
+    vid_seconds = Column(Integer)  # vid_time in seconds
+    game = Column(String)
+
+    __table_args__ = (
+        # Character filters in advanced search, with and without a game. The
+        # p2_char index covers a single character matched against either player
+        Index('ix_character_detect_game_chars', game, p1_char, p2_char),
+        Index('ix_character_detect_chars', p1_char, p2_char),
+        Index('ix_character_detect_p2_char', p2_char),
+    )
+
+
+class Stage_timing(Base):
+    __tablename__ = 'stage_timing'
+
+    id = Column(Integer, primary_key=True)
+    challenge_id = Column(String, index=True)
     game = Column(String)
+    stage = Column(String)  # See fcreplay.eta.STAGES
+    replay_length = Column(Integer)  # Length of the replay in seconds
+    duration = Column(Float)  # Seconds the stage took
+    cpu_seconds = Column(Float)  # CPU time, including child processes
+    peak_rss = Column(BigInteger)  # Peak resident set size in bytes, see fcreplay.span
+    date_added = Column(DateTime)  # Date the stage finished
+
+    __table_args__ = (
+        # Recent history used by the ETA model
+        Index('ix_stage_timing_date_added', date_added),
+    )
@@ -0,0 +1,170 @@
+"""Push notifications of replay status changes.
+
+On postgres, Database.update_status sends a NOTIFY on the replay_status
+channel in the same transaction, so listeners only see committed changes.
+
+Other databases (sqlite) have no notifications, so a local stand-in is used:
+each listener binds a unix datagram socket in NOTIFY_DIR, and publishers
+send to every socket there once the transaction commits. This only reaches
+processes on the same host, which is fine for development and tests.
+
+Example:
+    with StatusListener(engine) as listener:
+        for challenge_id, status in listener.wait(timeout=15):
+            ...
+"""
+from sqlalchemy import event, func, select
+from sqlalchemy.orm import Session
+
+import errno
+import json
+import logging
+import os
+import select as select_module
+import socket
+import tempfile
+import uuid
+
+log = logging.getLogger('fcreplay')
+
+CHANNEL = 'replay_status'
+
+# Directory for the local socket stand-in
+NOTIFY_DIR = os.path.join(tempfile.gettempdir(), 'fcreplay_notify')
+
+
+def _payload(challenge_id, status):
+    return json.dumps({'id': challenge_id, 'status': status})
+
+
+def publish(session, challenge_id, status):
+    """Notify listeners of a status change when the session commits.
+
+    Args:
+        session (sqlalchemy.orm.Session): Session making the change
+        challenge_id (str): Challenge id
+        status (str): New status
+    """
+    if session.bind.dialect.name == 'postgresql':
+        session.execute(select(func.pg_notify(CHANNEL, _payload(challenge_id, status))))
+    else:
+        session.info.setdefault('status_notifications', []).append((challenge_id, status))
+
+
+@event.listens_for(Session, 'after_commit')
+def _send_local(session):
+    """Send notifications queued by publish to local listeners."""
+    notifications = session.info.pop('status_notifications', [])
+    if not notifications or not os.path.isdir(NOTIFY_DIR):
+        return
+
+    payloads = [_payload(challenge_id, status) for challenge_id, status in notifications]
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sender:
+        sender.setblocking(False)
+        for name in os.listdir(NOTIFY_DIR):
+            path = os.path.join(NOTIFY_DIR, name)
+            for payload in payloads:
+                try:
+                    sender.sendto(payload.encode(), path)
+                except ConnectionRefusedError:
+                    # Listener exited without removing its socket
+                    _remove(path)
+                    break
+                except OSError as e:
+                    if e.errno not in (errno.ENOENT, errno.EAGAIN):
+                        raise
+                    log.debug(f"Unable to notify {path}: {e}")
+                    break
+
+
+@event.listens_for(Session, 'after_rollback')
+def _clear_local(session):
+    """Drop notifications queued by publish."""
+    session.info.pop('status_notifications', None)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class StatusListener:
+    """Receive replay status changes, see the module docstring."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self._connection = None
+        self._socket = None
+        self._socket_path = None
+
+    def __enter__(self):
+        if self.engine.dialect.name == 'postgresql':
+            self._connection = self.engine.raw_connection()
+            dbapi_connection = self._connection.connection
+            dbapi_connection.autocommit = True
+            with dbapi_connection.cursor() as cursor:
+                cursor.execute(f"LISTEN {CHANNEL}")
+        else:
+            os.makedirs(NOTIFY_DIR, exist_ok=True)
+            self._socket_path = os.path.join(NOTIFY_DIR, f"{uuid.uuid4().hex}.sock")
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._socket.bind(self._socket_path)
+        return self
+
+    def __exit__(self, *exc):
+        if self._connection is not None:
+            dbapi_connection = self._connection.connection
+            with dbapi_connection.cursor() as cursor:
+                cursor.execute('UNLISTEN *')
+            dbapi_connection.autocommit = False
+            self._connection.close()
+            self._connection = None
+
+        if self._socket is not None:
+            self._socket.close()
+            _remove(self._socket_path)
+            self._socket = None
+
+    def fileno(self):
+        if self._connection is not None:
+            return self._connection.connection.fileno()
+        return self._socket.fileno()
+
+    def _receive(self):
+        if self._connection is not None:
+            dbapi_connection = self._connection.connection
+            dbapi_connection.poll()
+            payloads = [n.payload for n in dbapi_connection.notifies]
+            dbapi_connection.notifies.clear()
+            return payloads
+
+        payloads = []
+        self._socket.setblocking(False)
+        try:
+            while True:
+                payloads.append(self._socket.recv(8192).decode())
+        except BlockingIOError:
+            pass
+        return payloads
+
+    def wait(self, timeout):
+        """Wait for status changes.
+
+        Args:
+            timeout (float): Seconds to wait for the first change
+
+        Returns:
+            list: [(challenge_id, status)...], empty if nothing changed before the timeout
+        """
+        readable, _, _ = select_module.select([self], [], [], timeout)
+        if not readable:
+            return []
+
+        changes = []
+        for payload in self._receive():
+            data = json.loads(payload)
+            changes.append((data['id'], data['status']))
+        return changes
@@ -1,6 +1,7 @@
 from fcreplay.config import Config
-from fcreplay.database import Database
+from fcreplay.database import Database, round_trips
 from fcreplay.record import Record
+from fcreplay.span import Span, prometheus_text
 from fcreplay.status import status
 from fcreplay.thumbnail import Thumbnail
 from fcreplay.updatethumbnail import UpdateThumbnail
@@ -12,12 +13,14 @@ from internetarchive import get_item
 from retrying import retry
 
 import datetime
+import functools
 import glob
 import json
 import logging
 import os
 import pkg_resources
 import re
+import socket
 import subprocess
 import time
 import sys
@@ -25,6 +28,27 @@ import sys
 log = logging.getLogger('fcreplay')
 
 
+def timed_stage(stage):
+    """Measure a Replay method with a Span, and record it when the method succeeds.
+
+    The stage_timing row is written with the next status change, see Replay.update_status.
+
+    Args:
+        stage (str): Stage name, see fcreplay.eta.STAGES
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with Span(stage) as span:
+                result = method(self, *args, **kwargs)
+
+            self.spans.append(span)
+            self.unrecorded_spans.append(span)
+            return result
+        return wrapper
+    return decorator
+
+
 class Replay:
     """Class for FightCade replays."""
 
@@ -32,9 +56,12 @@ class Replay:
         """Initaliser for Replay class."""
         self.config = Config()
         self.db = Database()
+        self.round_trips_start = round_trips()
         self.replay = self.get_replay()
         self.description_text = ""
         self.detected_characters = []
+        self.spans = []
+        self.unrecorded_spans = []  # Spans without a stage_timing row yet
 
         with open(pkg_resources.resource_filename('fcreplay', 'data/supported_games.json')) as f:
             self.supported_games = json.load(f)
@@ -47,8 +74,11 @@ class Replay:
         """Handle failures."""
         log.exception(e)
         log.info(f"Setting {self.replay.id} to failed")
-        self.db.update_failed_replay(challenge_id=self.replay.id)
-        self.update_status(status.FAILED)
+        with self.db.transaction():
+            self.db.update_failed_replay(challenge_id=self.replay.id)
+            self.update_status(status.FAILED)
+        self.log_round_trips()
+        self.write_metrics()
 
         # Hacky as hell, but ensures everything gets killed
         if self.config.kill_all:
@@ -66,66 +96,84 @@ class Replay:
         sys.exit(1)
 
     def get_replay(self) -> Replays:
-        """Get a replay from the database."""
+        """Claim a replay from the database.
+
+        The tasker sets FCREPLAY_CHALLENGE_ID to the replay the instance was started for. If another
+        instance claimed it first, the next replay is claimed instead.
+        """
         log.info('Getting replay from database')
-        if self.config.player_replay_first:
-            replay = self.db.get_oldest_player_replay()
+        if os.environ.get('FCREPLAY_CHALLENGE_ID'):
+            replay = self.db.claim_replay(os.environ['FCREPLAY_CHALLENGE_ID'], worker_id=socket.gethostname())
             if replay is not None:
-                log.info('Found player replay to encode')
                 return replay
-            else:
-                log.info('No more player replays')
+            log.info(f"Replay {os.environ['FCREPLAY_CHALLENGE_ID']} was already claimed")
 
-        if self.config.random_replay:
-            log.info('Getting random replay')
-            replay = self.db.get_random_replay()
-            return replay
-        else:
-            log.info('Getting oldest replay')
-            replay = self.db.get_oldest_replay()
+        replay = self.db.claim_next_replay(
+            worker_id=socket.gethostname(),
+            player_replay_first=self.config.player_replay_first,
+            random_replay=self.config.random_replay
+        )
+
+        if replay is None:
+            log.info('No replays to encode')
 
         return replay
 
+    @timed_stage('characters')
     def get_characters(self):
         """Get characters (if they exist) from pickle file."""
         c = CharacterDetection()
         self.detected_characters = c.get_characters()
 
-        for i in self.detected_characters:
-            self.db.add_detected_characters(
-                challenge_id=self.replay.id,
-                p1_char=i[0],
-                p2_char=i[1],
-                vid_time=i[2],
-                game=self.replay.game
-            )
+        self.db.add_detected_characters_bulk(
+            challenge_id=self.replay.id,
+            game=self.replay.game,
+            timeline=self.detected_characters
+        )
 
     def add_job(self):
         """Update jobs database table with the current replay."""
         start_time = datetime.datetime.utcnow()
-        self.update_status(status.JOB_ADDED)
-        self.db.add_job(
-            challenge_id=self.replay.id,
-            start_time=start_time,
-            length=self.replay.length
-        )
+        with self.db.transaction():
+            self.update_status(status.JOB_ADDED)
+            self.db.add_job(
+                challenge_id=self.replay.id,
+                start_time=start_time,
+                length=self.replay.length
+            )
 
     def remove_job(self):
         """Remove job from database."""
-        self.update_status(status.REMOVED_JOB)
-        self.db.remove_job(challenge_id=self.replay.id)
+        with self.db.transaction():
+            self.update_status(status.REMOVED_JOB)
+            self.db.remove_job(challenge_id=self.replay.id)
 
     def update_status(self, status):
-        """Update the replay status."""
+        """Update the replay status, and record the stages finished since the last update."""
         log.info(f"Set status to {status}")
         # This file is legacy?
         with open('/tmp/fcreplay_status', 'w') as f:
             f.write(f"{self.replay.id} {status}")
-        self.db.update_status(
-            challenge_id=self.replay.id,
-            status=status
-        )
 
+        # Timings share the status change's commit, instead of a commit for each stage
+        with self.db.transaction():
+            for span in self.unrecorded_spans:
+                self.db.add_stage_timing(
+                    challenge_id=self.replay.id,
+                    game=self.replay.game,
+                    stage=span.name,
+                    replay_length=self.replay.length,
+                    duration=span.duration,
+                    cpu_seconds=span.cpu_seconds,
+                    peak_rss=span.peak_rss
+                )
+            self.db.update_status(
+                challenge_id=self.replay.id,
+                status=status
+            )
+        self.unrecorded_spans = []
+
+    @timed_stage('record')
     def record(self):
         """Start recording a replay."""
         log.info(
@@ -220,6 +268,7 @@ class Replay:
         desired_resolution = [int(a) for a in desired_resolution]
         return desired_resolution
 
+    @timed_stage('encode')
     def encode(self):
         """Encode avi files.
 
@@ -303,6 +352,7 @@ class Replay:
 
         return ranks[str(rank)]
 
+    @timed_stage('description')
     def set_description(self):
         """Set the description of the video.
 
@@ -358,13 +408,14 @@ class Replay:
                 with open(self.config.description_append_file[1], 'r') as description_append:
                     self.description_text += "\n" + description_append.read()
 
-        self.update_status(status.DESCRIPTION_CREATED)
         log.info("Finished creating description")
 
         # Add description to database
         log.info('Adding description to database')
-        self.db.add_description(
-            challenge_id=self.replay.id, description=self.description_text)
+        with self.db.transaction():
+            self.update_status(status.DESCRIPTION_CREATED)
+            self.db.add_description(
+                challenge_id=self.replay.id, description=self.description_text)
 
         log.debug(
             f"Description Text is: {self.description_text.encode('unicode-escape')}")
@@ -393,6 +444,7 @@ class Replay:
         log.info("Finished checking bad words")
         return True
 
+    @timed_stage('thumbnail')
     def create_thumbnail(self):
         """Create thumbnail from video."""
         log.info("Making thumbnail")
@@ -402,12 +454,14 @@ class Replay:
         self.update_status(status.THUMBNAIL_CREATED)
         log.info("Finished making thumbnail")
 
+    @timed_stage('update_thumbnail')
     def update_thumbnail(self):
         """Add text, country and ranks to thumbnail."""
         log.info("Updating thumbnail")
 
         UpdateThumbnail().update_thumbnail(self.replay, self.thumbnail)
 
+    @timed_stage('upload_to_ia')
     @retry(wait_random_min=30000, wait_random_max=60000, stop_max_attempt_number=3)
     def upload_to_ia(self):
         """Upload to internet archive.
@@ -441,11 +495,12 @@ class Replay:
         fc_video.upload(f"{self.config.fcadefbneo_path}/avi/{filename}",
                         metadata=metadata, verbose=True)
 
-        self.db.add_ia_filename(str(self.replay.id), filename)
-
-        self.update_status(status.UPLOADED_TO_IA)
+        with self.db.transaction():
+            self.db.add_ia_filename(str(self.replay.id), filename)
+            self.update_status(status.UPLOADED_TO_IA)
         log.info("Finished upload to archive.org")
 
+    @timed_stage('upload_to_yt')
     def upload_to_yt(self):
         """Upload video to youtube."""
         self.update_status(status.UPLOADING_TO_YOUTUBE)
@@ -495,17 +550,40 @@ class Replay:
 
         log.info(f"Youtube id: {youtube_id}")
 
-        if type(youtube_id) is bool or len(youtube_id) < 4:
-            log.info('Unable to upload to youtube')
-            self.db.set_youtube_uploaded(self.replay.id, False)
-        else:
-            self.db.set_youtube_uploaded(self.replay.id, True)
-            self.db.set_youtube_id(self.replay.id, youtube_id)
+        with self.db.transaction():
+            if type(youtube_id) is bool or len(youtube_id) < 4:
+                log.info('Unable to upload to youtube')
+                self.db.set_youtube_uploaded(self.replay.id, False)
+            else:
+                self.db.set_youtube_uploaded(self.replay.id, True)
+                self.db.set_youtube_id(self.replay.id, youtube_id)
 
-        self.update_status(status.UPLOADED_TO_YOUTUBE)
+            self.update_status(status.UPLOADED_TO_YOUTUBE)
         log.info('Finished uploading to Youtube')
 
     def set_created(self):
         """Update the video status to created."""
-        self.update_status(status.FINISHED)
-        self.db.update_created_replay(challenge_id=self.replay.id)
+        with self.db.transaction():
+            self.update_status(status.FINISHED)
+            self.db.update_created_replay(challenge_id=self.replay.id)
+
+    def log_round_trips(self):
+        """Log the number of database round trips made while processing the replay."""
+        log.info(f"Replay {self.replay.id} made {round_trips() - self.round_trips_start} database round trips")
+
+    def write_metrics(self):
+        """Log the stage timings, and write them to metrics_textfile in the prometheus text format if it's set."""
+        for span in self.spans:
+            log.info(f"Stage {span.name} took {span.duration:.1f}s, {span.cpu_seconds:.1f}s CPU, {span.peak_rss // 2 ** 20}MiB peak RSS")
+
+        if not self.config.metrics_textfile:
+            return
+
+        # Written to a temporary file first, so the metrics are never read half written
+        temp_path = f"{self.config.metrics_textfile}.tmp"
+        try:
+            with open(temp_path, 'w') as f:
+                f.write(prometheus_text(self.spans, labels={'game': self.replay.game}))
+            os.replace(temp_path, self.config.metrics_textfile)
+        except OSError as e:
+            log.error(f"Unable to write metrics to {self.config.metrics_textfile}: {e}")
@@ -0,0 +1,161 @@
+"""Admit new recorder instances based on the resources left on the host.
+
+Before the tasker starts an fcrecord container it checks:
+ - CPU: the 1 minute load average, plus CPUS for each instance started in
+   the last minute (they aren't in the load average yet), plus CPUS for the
+   new instance, must fit in the host's cpus.
+ - Memory: MemAvailable must hold MEMORY for the new instance and for each
+   instance started in the last minute, plus MEMORY_MARGIN.
+ - Disk: free space in the AVI directory must hold the AVI files of the new
+   replay, plus what running instances are still expected to write, plus
+   DISK_MARGIN.
+
+AVI files are estimated from the replay length and the game's aspect ratio,
+see avi_footprint. The host figures come from /proc and os.getloadavg, which
+report the host even from inside the tasker container.
+"""
+import collections
+import os
+import shutil
+import time
+
+# Seconds before a new instance shows up in the load average and memory use
+WARMUP = 60
+
+MEMORY_MARGIN = 512 * 2 ** 20
+DISK_MARGIN = 2 * 2 ** 30
+
+# fcadefbneo writes uncompressed 24 bit frames at 60fps, of about 240 lines
+AVI_LINES = 240
+AVI_BYTES_PER_PIXEL = 3
+AVI_FPS = 60
+
+Resources = collections.namedtuple('Resources', ['cpus', 'load', 'memory_available', 'disk_free'])
+
+_Instance = collections.namedtuple('_Instance', ['directory', 'footprint', 'started'])
+
+
+def parse_size(size):
+    """Return a docker style size, eg. '4g', in bytes."""
+    size = str(size).strip().lower()
+    units = {'b': 1, 'k': 2 ** 10, 'm': 2 ** 20, 'g': 2 ** 30}
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def avi_footprint(length, aspect_ratio):
+    """Return the estimated size in bytes of the AVI files recorded for a replay.
+
+    Args:
+        length (int): Replay length in seconds
+        aspect_ratio (list): [width, height] of the game, from supported_games.json
+
+    Returns:
+        int: Bytes
+    """
+    width, height = aspect_ratio
+    # The short side of the screen is AVI_LINES, for both horizontal and vertical games
+    pixels = AVI_LINES * AVI_LINES * max(width, height) / min(width, height)
+    return int(length * AVI_FPS * pixels * AVI_BYTES_PER_PIXEL)
+
+
+def directory_size(path):
+    """Return the size in bytes of the files under path, 0 if it doesn't exist."""
+    total = 0
+    try:
+        entries = list(os.scandir(path))
+    except FileNotFoundError:
+        return 0
+
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                total += directory_size(entry.path)
+            else:
+                total += entry.stat(follow_symlinks=False).st_size
+        except FileNotFoundError:
+            pass
+    return total
+
+
+def _memory_available():
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+def measure(path):
+    """Return the host's cpus, load, available memory and free disk space under path."""
+    return Resources(
+        cpus=os.cpu_count(),
+        load=os.getloadavg()[0],
+        memory_available=_memory_available(),
+        disk_free=shutil.disk_usage(path).free
+    )
+
+
+class RecorderScheduler:
+    def __init__(self, avi_dir, cpus_per_instance, memory_per_instance, measure=measure, clock=time.monotonic):
+        """Decide when a new recorder instance can start, see the module docstring.
+
+        Args:
+            avi_dir (str): Directory the instances write AVI files to
+            cpus_per_instance (int): CPUS given to each instance
+            memory_per_instance (int): MEMORY given to each instance, in bytes
+            measure (function, optional): Returns the host Resources for a path
+            clock (function, optional): Returns the time in seconds
+        """
+        self.avi_dir = avi_dir
+        self.cpus_per_instance = cpus_per_instance
+        self.memory_per_instance = memory_per_instance
+        self.measure = measure
+        self.clock = clock
+        self.instances = {}
+
+    def started(self, hostname, directory, footprint):
+        """Track a started instance.
+
+        Args:
+            hostname (str): Container hostname
+            directory (str): Directory the instance writes AVI files to
+            footprint (int): Estimated bytes of AVI files it will write
+        """
+        self.instances[hostname] = _Instance(directory, footprint, self.clock())
+
+    def stopped(self, hostname):
+        """Stop tracking an instance once its files are removed."""
+        self.instances.pop(hostname, None)
+
+    def reserved_disk(self):
+        """Return the bytes running instances are still expected to write."""
+        return sum(max(0, i.footprint - directory_size(i.directory)) for i in self.instances.values())
+
+    def admit(self, footprint):
+        """Check if an instance recording footprint bytes of AVI files can start.
+
+        Returns:
+            tuple: (admitted, reason), reason describes the resource that is short
+        """
+        resources = self.measure(self.avi_dir)
+        now = self.clock()
+        warming_up = len([i for i in self.instances.values() if now - i.started < WARMUP])
+
+        load = resources.load + self.cpus_per_instance * (warming_up + 1)
+        if load > resources.cpus:
+            return False, f"Projected load {load:.1f} is more than {resources.cpus} cpus"
+
+        memory = self.memory_per_instance * (warming_up + 1) + MEMORY_MARGIN
+        if memory > resources.memory_available:
+            return False, f"Needs {memory // 2 ** 20}MiB memory, {resources.memory_available // 2 ** 20}MiB available"
+
+        disk = footprint + self.reserved_disk() + DISK_MARGIN
+        if disk > resources.disk_free:
+            return False, f"Needs {disk // 2 ** 20}MiB disk, {resources.disk_free // 2 ** 20}MiB free"
+
+        return True, 'Resources available'
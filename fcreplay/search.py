@@ -0,0 +1,158 @@
+"""Substring search helpers.
+
+The search path is chosen from the database dialect, see uses_trigram_table.
+
+On postgres, `ilike('%...%')` searches are served by pg_trgm GIN indexes,
+created by Database.migrate. If the pg_trgm extension isn't available, the
+migration logs an error and searches scan the tables until it's installed
+and the migration is run again.
+
+SQLite (development and tests) uses the search_trigram table, an inverted
+index from trigram to the description or player it occurs in, which is
+maintained by Database when descriptions and players are added. The
+search_trigram_count table holds the number of rows each trigram occurs in,
+so searches only intersect the rarest trigrams of the query.
+"""
+from collections import namedtuple
+from sqlalchemy import and_, func, select, text
+
+# Characters that are wildcards in a LIKE pattern
+LIKE_WILDCARDS = ('%', '_')
+
+# Number of trigrams of a search query looked up in the search_trigram table
+LOOKUP_TRIGRAMS = 2
+
+# The search_trigram and search_trigram_count tables
+TrigramIndex = namedtuple('TrigramIndex', ['trigrams', 'counts'])
+
+# (index name, table, column) of the pg_trgm indexes created on postgres
+POSTGRES_TRIGRAM_INDEXES = [
+    ('ix_descriptions_description_trgm', 'descriptions', 'description'),
+    ('ix_players_name_trgm', 'players', 'name'),
+    ('ix_replays_p1_trgm', 'replays', 'p1'),
+    ('ix_replays_p2_trgm', 'replays', 'p2'),
+]
+
+
+def uses_trigram_table(engine):
+    """Return True if search uses the search_trigram tables, which is every database except postgres.
+
+    Args:
+        engine (sqlalchemy.engine.Engine): Engine to check
+
+    Returns:
+        bool: True if the search_trigram tables are maintained and searched
+    """
+    return engine.dialect.name != 'postgresql'
+
+
+def has_pg_trgm(engine):
+    """Return True if the database has the pg_trgm extension installed.
+
+    Args:
+        engine (sqlalchemy.engine.Engine): Engine to check
+
+    Returns:
+        bool: True if pg_trgm is installed
+    """
+    if engine.dialect.name != 'postgresql':
+        return False
+
+    with engine.connect() as connection:
+        return connection.execute(
+            text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+        ).first() is not None
+
+
+def trigrams(value):
+    """Return the set of lower case, three character substrings of value.
+
+    Args:
+        value (str): Text to split
+
+    Returns:
+        set: Trigrams, empty if value is shorter than three characters
+    """
+    value = (value or '').lower()
+    return {value[i:i + 3] for i in range(len(value) - 2)}
+
+
+def trigram_rows(source, key, value):
+    """Return search_trigram rows indexing value.
+
+    Args:
+        source (str): What is indexed, 'description' or 'player'
+        key (str): Key of the indexed row, challenge id or player name
+        value (str): Text to index
+
+    Returns:
+        list: List of dicts, for use with insert
+    """
+    return [{'trigram': t, 'source': source, 'key': key} for t in trigrams(value)]
+
+
+def trigram_candidates(index, source, search_query):
+    """Return a select of keys that may contain search_query.
+
+    Only the LOOKUP_TRIGRAMS rarest trigrams of search_query are looked up, so
+    not every candidate contains search_query and the ilike filter still
+    needs to be applied.
+
+    Args:
+        index (TrigramIndex): The search_trigram and search_trigram_count tables
+        source (str): What to search, 'description' or 'player'
+        search_query (str): Text to search for
+
+    Returns:
+        sqlalchemy.sql.Select: Select of keys, or None if the index can't be used
+    """
+    if any(w in search_query for w in LIKE_WILDCARDS):
+        return None
+
+    query_trigrams = trigrams(search_query)
+    if not query_trigrams:
+        return None
+
+    # A trigram that isn't in the counts table doesn't occur anywhere, so it
+    # leaves fewer than lookup trigrams, and no candidates
+    lookup = min(LOOKUP_TRIGRAMS, len(query_trigrams))
+    rarest = select(index.counts.c.trigram).where(
+        index.counts.c.source == source,
+        index.counts.c.trigram.in_(query_trigrams)
+    ).order_by(
+        index.counts.c.count
+    ).limit(lookup)
+
+    return select(index.trigrams.c.key).where(
+        index.trigrams.c.source == source,
+        index.trigrams.c.trigram.in_(rarest)
+    ).group_by(
+        index.trigrams.c.key
+    ).having(
+        func.count() == lookup
+    )
+
+
+def search_filter(column, pattern, key=None, source=None, search_query=None, index=None):
+    """Return an ilike filter, narrowed by the search_trigram table if given.
+
+    Args:
+        column (sqlalchemy.Column): Column to search
+        pattern (str): ilike pattern
+        key (sqlalchemy.Column, optional): Column holding the search_trigram key
+        source (str, optional): search_trigram source
+        search_query (str, optional): Text contained in every match of pattern
+        index (TrigramIndex, optional): Trigram tables, None on postgres
+
+    Returns:
+        sqlalchemy.sql.ClauseElement: Filter
+    """
+    condition = column.ilike(pattern)
+    if index is None:
+        return condition
+
+    candidates = trigram_candidates(index, source, search_query)
+    if candidates is None:
+        return condition
+
+    return and_(key.in_(candidates), condition)
@@ -1,28 +1,85 @@
+from fcreplay import metrics
+from fcreplay.notify import StatusListener
 from fcreplay.site import queries
+from fcreplay.site.cache import cache
 from fcreplay.site.database import db
 from fcreplay.site.forms import AdvancedSearchForm, SearchForm, SubmitForm
-from fcreplay.site.feed import Feed
+from fcreplay.site.feed import feed_response
+from fcreplay.site.pagination import paginate
+from fcreplay.site.sitemap import site_sitemap
+from fcreplay.site.status import Status
 
 from flask import Blueprint
-from flask import abort, jsonify, render_template, request, session, redirect, send_from_directory, url_for
+from flask import Response, abort, current_app, g, jsonify, make_response, render_template, request, session, redirect, send_file, send_from_directory, url_for
 
 import datetime
 import json
 import logging
 import pkg_resources
 import pytz
+import threading
+import time
 
 app = Blueprint('blueprint', __name__, static_folder='static')
 
 with open(pkg_resources.resource_filename('fcreplay', 'data/supported_games.json')) as f:
     supported_games = json.load(f)
 
+# Maximum number of players returned by /api/playerlist per request
+PLAYERLIST_LIMIT = 1000
+
+# Maximum number of ids in one /api/video request
+VIDEO_BATCH_LIMIT = 100
+
+# Seconds a status long poll waits for a change. Each waiting request holds a
+# server thread and, on postgres, a database connection, so at most
+# STATUS_MAX_WAITERS (in the site config) wait at once and the rest are told
+# to retry later.
+STATUS_WAIT_TIMEOUT = 5
+STATUS_RETRY_AFTER = 5
+
+# Statuses that don't change any more
+FINAL_STATUSES = ['FINISHED', 'FAILED']
+
+status_descriptions = Status().status_description
+
+# Latency of the requests handled by this process, served from /metrics
+request_latency = metrics.Histogram('fcreplay_site_request_seconds', 'Site request latency by route')
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def observe_request_latency(response):
+    if request.url_rule is not None and 'request_start' in g:
+        request_latency.observe(
+            time.perf_counter() - g.request_start,
+            route=request.url_rule.rule,
+            method=request.method,
+            status=response.status_code
+        )
+    return response
+
+
+def _paginate(query, order_by):
+    """Return the page of query given by the page, after and before arguments, see pagination.paginate."""
+    return paginate(
+        query,
+        queries.order_column(order_by),
+        request.args.get('page', 1, type=int),
+        after=request.args.get('after'),
+        before=request.args.get('before')
+    )
+
 
 @app.route('/')
+@cache.cached(60, query_args=('page', 'after', 'before'))
 def index():
     searchForm = SearchForm()
-    page = request.args.get('page', 1, type=int)
-    pagination = queries.all_replays().paginate(page, per_page=9)
+    pagination = _paginate(queries.all_replays(), 'date_added')
     replays = pagination.items
 
     return render_template('start.j2.html', pagination=pagination, replays=replays, form=searchForm, games=supported_games)
@@ -42,16 +99,97 @@ def videolinks():
     return jsonify(replay_data)
 
 
+def _characters_json(replay):
+    return [
+        {
+            'p1_char': c.p1_char,
+            'p2_char': c.p2_char,
+            'vid_time': c.vid_time,
+            'seek_time': c.vid_seconds
+        } for c in replay.characters
+    ]
+
+
+def _video_json(replay):
+    if replay.video_youtube_uploaded:
+        video_url = f"https://www.youtube.com/watch?v={replay.video_youtube_id}"
+    else:
+        video_url = f"https://archive.org/details/{replay.id.replace('@', '-')}"
+
+    return {
+        'id': replay.id,
+        'url': f"https://fightcadevids.com/video/{replay.id}",
+        'video_url': video_url,
+        'game': replay.game,
+        'p1': replay.p1,
+        'p2': replay.p2,
+        'p1_loc': replay.p1_loc,
+        'p2_loc': replay.p2_loc,
+        'p1_rank': replay.p1_rank,
+        'p2_rank': replay.p2_rank,
+        'date_replay': replay.date_replay.isoformat() if replay.date_replay else None,
+        'date_added': replay.date_added.isoformat() if replay.date_added else None,
+        'length': replay.length,
+        'description': replay.description.description if replay.description else None,
+        'characters': _characters_json(replay),
+    }
+
+
+@app.route('/api/video/<challenge_id>')
+def video(challenge_id):
+    replays = queries.video_details([challenge_id])
+    if not replays:
+        abort(404)
+
+    return jsonify(_video_json(replays[0]))
+
+
+@app.route('/api/video', methods=['POST'])
+def videos():
+    if 'ids' not in request.json:
+        abort(404)
+
+    if len(request.json['ids']) > VIDEO_BATCH_LIMIT:
+        abort(400)
+
+    replays = queries.video_details(request.json['ids'])
+
+    return jsonify({r.id: _video_json(r) for r in replays})
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Replay gauges and request latency in the prometheus text format, see fcreplay/metrics.py."""
+    since = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+    text = metrics.replay_gauges(queries.replay_counts(since)) + request_latency.render()
+    return Response(text, content_type=metrics.CONTENT_TYPE)
+
+
 @app.route('/api/supportedgames')
+@cache.cached(86400)
 def supportedgames():
     return jsonify(supported_games)
 
 
+@app.route('/api/cachestats')
+def cachestats():
+    return jsonify(cache.stats())
+
+
 @app.route('/api/playerlist')
 def playerList():
-    playerlist = queries.playerlist()
-    playerlist = sorted(playerlist)
-    return jsonify(playerlist)
+    after = request.args.get('after', default=None, type=str)
+    limit = max(1, min(request.args.get('limit', default=PLAYERLIST_LIMIT, type=int), PLAYERLIST_LIMIT))
+
+    playerlist = queries.playerlist(after=after, limit=limit)
+
+    response = jsonify(playerlist)
+    if len(playerlist) == limit:
+        next_url = url_for('blueprint.playerList', after=playerlist[-1], limit=limit)
+        response.headers['Link'] = f'<{next_url}>; rel="next"'
+
+    response.add_etag()
+    return response.make_conditional(request)
 
 
 @app.route('/api/playerlist/search', methods=['POST'])
@@ -59,10 +197,100 @@ def playerListSearch():
     if 'player_id' not in request.json:
         abort(404)
     playerlist = queries.playerlist_search(request.json['player_id'])
-    playerlist = sorted(playerlist)
     return jsonify(playerlist)
 
 
+def _status_json(replay_status):
+    replay, job_start_time, queue_position = replay_status
+    return {
+        'id': replay.id,
+        'status': replay.status,
+        'description': status_descriptions.get(replay.status, replay.status),
+        'failed': bool(replay.failed),
+        'recording': job_start_time is not None,
+        'queue_position': queue_position,
+    }
+
+
+@app.route('/api/status/<challenge_id>')
+def replay_status(challenge_id):
+    replay_status = queries.replay_status(challenge_id)
+    if replay_status is None:
+        abort(404)
+    return jsonify(_status_json(replay_status))
+
+
+def _is_final(status):
+    return status['status'] in FINAL_STATUSES or status['failed']
+
+
+@app.record_once
+def create_status_waiters(state):
+    state.app.extensions['status_waiters'] = threading.BoundedSemaphore(state.app.config['STATUS_MAX_WAITERS'])
+
+
+@app.route('/api/status/<challenge_id>/wait')
+def replay_status_wait(challenge_id):
+    """Long poll the status of a replay.
+
+    Returns the status once it differs from the status and queue_position
+    arguments the client already has, or after STATUS_WAIT_TIMEOUT seconds.
+    """
+    status_waiters = current_app.extensions['status_waiters']
+    if not status_waiters.acquire(blocking=False):
+        response = jsonify({'error': 'Too many status requests'})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(STATUS_RETRY_AFTER)
+        return response
+
+    try:
+        known = (request.args.get('status'), request.args.get('queue_position', type=int))
+
+        with StatusListener(db.engine) as listener:
+            # Fetched after listening, so no change is missed
+            replay_status = queries.replay_status(challenge_id)
+            db.session.remove()
+            if replay_status is None:
+                abort(404)
+            current = _status_json(replay_status)
+
+            deadline = time.monotonic() + STATUS_WAIT_TIMEOUT
+            while (current['status'], current['queue_position']) == known and not _is_final(current):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+
+                changes = listener.wait(remaining)
+
+                # Another replay being claimed moves this one up the queue
+                if not any(i == challenge_id or s == 'CLAIMED' for i, s in changes):
+                    continue
+
+                replay_status = queries.replay_status(challenge_id)
+                db.session.remove()
+                if replay_status is None:
+                    abort(404)
+                current = _status_json(replay_status)
+
+        return jsonify(current)
+    finally:
+        status_waiters.release()
+
+
+@app.route('/status/<challenge_id>')
+def status_page(challenge_id):
+    """Show the status of a replay, updated by long polling /api/status/<challenge_id>/wait."""
+    searchForm = SearchForm()
+
+    replay_status = queries.replay_status(challenge_id)
+    if replay_status is None:
+        abort(404)
+
+    eta = queries.replay_eta(replay_status[0])
+    return render_template('status.j2.html', form=searchForm, status=_status_json(replay_status), eta=eta,
+                           final_statuses=FINAL_STATUSES)
+
+
 @app.route('/submit')
 def submit():
     searchForm = SearchForm()
@@ -103,29 +331,28 @@ def send_js(path):
 
 
 @app.route('/about')
+@cache.cached(300)
 def about():
     searchForm = SearchForm()
 
+    gameCounts = queries.game_counts()
+
     sortedGames = sorted(supported_games.items(), key=lambda item: item[1]['game_name'])
     supportedGames = {}
     for game in sortedGames:
         supportedGames[game[0]] = {
             'game_name': supported_games[game[0]]['game_name'],
+            'count': gameCounts.get(game[0], 0)
         }
-        supportedGames[game[0]]['count'] = db.session.execute(f"select count(id) from replays where created = true and game = '{game[0]}'").first()[0]
 
-    numberOfReplays = db.session.execute('select count(id) from replays where created = true').first()[0]
+    numberOfReplays = sum(gameCounts.values())
 
-    toProcess = db.session.execute('select count(id) from replays where created = false and failed = false').first()[0]
+    toProcess = queries.pending_count()
 
     return render_template('about.j2.html', about_active=True, form=searchForm, supportedGames=supportedGames, numberOfReplays=numberOfReplays, toProcess=toProcess)
 
 
-@app.route('/advancedSearch')
-def advancedSearch():
-    searchForm = SearchForm()
-    advancedSearchForm = AdvancedSearchForm()
-
+def all_characters():
     all_characters_sql = db.session.execute('select p1_char as char,game from character_detect union select p2_char as char,game from character_detect')
     all_characters_dict = {}
 
@@ -134,13 +361,17 @@ def advancedSearch():
             all_characters_dict[row.game] = []
         all_characters_dict[row.game].append(row.char)
 
-    players_list = queries.playerlist()
-    players_list = sorted(players_list)
+    return all_characters_dict
+
+
+@app.route('/advancedSearch')
+def advancedSearch():
+    searchForm = SearchForm()
+    advancedSearchForm = AdvancedSearchForm()
 
-    advancedSearchForm.p1_name.choices = players_list
-    advancedSearchForm.p2_name.choices = players_list
+    all_characters_dict = cache.get_or_set('characters', 3600, all_characters)
 
-    return render_template('advancedSearch.j2.html', advancedsearch_active=True, form=searchForm, advancedSearchForm=advancedSearchForm, character_dict=all_characters_dict, players_list=players_list)
+    return render_template('advancedSearch.j2.html', advancedsearch_active=True, form=searchForm, advancedSearchForm=advancedSearchForm, character_dict=all_characters_dict)
 
 
 @app.route('/advancedSearchResult')
@@ -154,20 +385,20 @@ def advancedSearchResult():
     p2_rank = request.args.get('p2_rank')
     order_by = request.args.get('order_by', default='date_added')
     game = request.args.get('game')
-    page = request.args.get('page', 1, type=int)
 
     searchForm = SearchForm()
 
-    pagination = queries.advanced_search(game_id=game,
-                                         p1_rank=p1_rank,
-                                         p2_rank=p2_rank,
-                                         search_query=search,
-                                         order_by=order_by,
-                                         char1=char1,
-                                         char2=char2,
-                                         p1_name=p1_name,
-                                         p2_name=p2_name
-                                         ).paginate(page, per_page=9)
+    results = queries.advanced_search(game_id=game,
+                                      p1_rank=p1_rank,
+                                      p2_rank=p2_rank,
+                                      search_query=search,
+                                      order_by=order_by,
+                                      char1=char1,
+                                      char2=char2,
+                                      p1_name=p1_name,
+                                      p2_name=p2_name
+                                      )
+    pagination = _paginate(results, order_by)
     replays = pagination.items
 
     return render_template('start.j2.html', pagination=pagination, replays=replays, form=searchForm, games=supported_games)
@@ -178,7 +409,6 @@ def search():
     search = request.args.get('search')
     order_by = request.args.get('order_by', default='date_added')
     game = request.args.get('game')
-    page = request.args.get('page', 1, type=int)
 
     searchForm = SearchForm(request.form,
                             search=search,
@@ -187,7 +417,7 @@ def search():
     if game == 'Any':
         game = '%'
 
-    pagination = queries.basic_search(game, search, order_by).paginate(page, per_page=9)
+    pagination = _paginate(queries.basic_search(game, search, order_by), order_by)
     replays = pagination.items
 
     return render_template('start.j2.html', pagination=pagination, replays=replays, form=searchForm, games=supported_games)
@@ -197,8 +427,7 @@ def search():
 def search_player():
     searchForm = SearchForm()
     player = request.args.get('player')
-    page = request.args.get('page', 1, type=int)
-    pagination = queries.player_search(player).paginate(page, per_page=9)
+    pagination = _paginate(queries.player_search(player), 'date_added')
     replays = pagination.items
 
     return render_template('start.j2.html', pagination=pagination, replays=replays, form=searchForm, games=supported_games)
@@ -212,30 +441,45 @@ def robots():
 
 @app.route('/sitemap.xml')
 def sitemap():
+    state = site_sitemap().update_if_stale(current_app.config['SITEMAP_INTERVAL'])
+    update_date = datetime.datetime.fromtimestamp(state['updated'], pytz.utc).isoformat()
+
+    response = make_response(render_template(
+        'sitemap_index.j2.xml',
+        base_url=current_app.config['SITEMAP_URL'],
+        chunks=state['chunks'],
+        update_date=update_date
+    ))
+    response.content_type = 'application/xml'
+    return response
+
+
+@app.route('/sitemap/pages.xml')
+@cache.cached(3600)
+def sitemap_pages():
     tz = pytz.timezone("Pacific/Auckland")
     aware_dt = tz.localize(datetime.datetime.now())
     update_date = aware_dt.isoformat()
-    return render_template('sitemap.j2.xml', update_date=update_date)
+    return render_template('sitemap_pages.j2.xml', update_date=update_date)
+
+
+@app.route('/sitemap/videos-<int:number>.xml')
+def sitemap_videos(number):
+    state = site_sitemap().update_if_stale(current_app.config['SITEMAP_INTERVAL'])
+    if number >= len(state['chunks']):
+        abort(404)
+    return send_file(site_sitemap().video_path(number), mimetype='application/xml')
 
 
 @app.route('/video/<challenge_id>')
 def videopage(challenge_id):
     searchForm = SearchForm()
 
-    replay = queries.single_replay(challenge_id)
-
-    char_detect = queries.character_detect(challenge_id)
+    replay = queries.video_detail(challenge_id)
+    if replay is None:
+        abort(404)
 
-    characters = []
-    for c in char_detect:
-        characters.append(
-            {
-                'p1_char': c.p1_char,
-                'p2_char': c.p2_char,
-                'vid_time': c.vid_time,
-                'seek_time': sum(int(x) * 60 ** i for i, x in enumerate(reversed(c.vid_time.split(":"))))
-            }
-        )
+    characters = _characters_json(replay)
 
     seek = request.args.get('seek', default=0, type=float)
 
@@ -246,9 +490,21 @@ def videopage(challenge_id):
 
 @app.route('/feed/atom')
 def feed_atom():
-    return Feed().render_atom()
+    return feed_response('atom')
 
 
 @app.route('/feed/rss')
 def feed_rss():
-    return Feed().render_rss()
+    return feed_response('rss')
+
+
+@app.route('/feed/game/<game>/<any(atom, rss):kind>')
+def feed_game(game, kind):
+    if game not in supported_games:
+        abort(404)
+    return feed_response(kind, game=game)
+
+
+@app.route('/feed/player/<player>/<any(atom, rss):kind>')
+def feed_player(player, kind):
+    return feed_response(kind, player=player)
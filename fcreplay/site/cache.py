@@ -0,0 +1,272 @@
+"""Response and fragment cache for the site.
+
+The backend is chosen with CACHE_TYPE in the flask config:
+    memory:     Least recently used cache in each process, CACHE_SIZE entries
+    filesystem: Pickled entries in CACHE_DIR, shared between processes. Once
+                there are more than CACHE_SIZE, expired entries are removed,
+                then the entries closest to expiring.
+    null:       Nothing is cached
+
+Cached entries are dropped when the cache_generation row changes, which
+Database does when replays shown on the site change. The generation is
+checked at most every CACHE_GENERATION_INTERVAL seconds.
+"""
+from collections import OrderedDict
+from fcreplay.site.database import db
+from fcreplay.site.models import Cache_generation
+from flask import current_app, request
+from urllib.parse import urlencode
+
+import functools
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+import threading
+import time
+
+log = logging.getLogger('fcreplay')
+
+# Generation before the first check
+_UNCHECKED = object()
+
+# Default for get_or_set, so a cached None is a hit
+_MISSING = object()
+
+
+class NullBackend:
+    def get(self, key, default=None):
+        return default
+
+    def set(self, key, value, ttl):
+        pass
+
+    def clear(self):
+        pass
+
+    def __len__(self):
+        return 0
+
+
+class MemoryBackend:
+    def __init__(self, size):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+
+            expires, value = entry
+            if expires < time.time():
+                del self._entries[key]
+                return default
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.time() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class FileSystemBackend:
+    def __init__(self, directory, size):
+        self.directory = directory
+        self.size = size
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest())
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def get(self, key, default=None):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                expires, value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return default
+
+        if expires < time.time():
+            self._remove(path)
+            return default
+        return value
+
+    def _prune(self):
+        """Remove expired entries if there are more than size, then the entries closest to expiring."""
+        names = [n for n in os.listdir(self.directory) if not n.endswith('.tmp')]
+        if len(names) <= self.size:
+            return
+
+        # Each entry's modification time is set to when it expires
+        expiry = []
+        for name in names:
+            try:
+                expiry.append((os.stat(os.path.join(self.directory, name)).st_mtime, name))
+            except FileNotFoundError:
+                pass
+        expiry.sort()
+
+        now = time.time()
+        excess = len(expiry) - self.size
+        for i, (expires, name) in enumerate(expiry):
+            if expires >= now and i >= excess:
+                break
+            self._remove(os.path.join(self.directory, name))
+
+    def set(self, key, value, ttl):
+        # Write to a temporary file first, so other processes never read a partial entry
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        expires = time.time() + ttl
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((expires, value), f)
+            os.utime(temp_path, (expires, expires))
+            os.replace(temp_path, self._path(key))
+        except OSError as e:
+            # Eg. the temporary file was removed by clear in another process, the entry isn't cached
+            log.debug(f"Unable to cache {key}: {e}")
+            self._remove(temp_path)
+            return
+        self._prune()
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            # Entries being written by another process, removing them would break its replace
+            if name.endswith('.tmp'):
+                continue
+            self._remove(os.path.join(self.directory, name))
+
+    def __len__(self):
+        return len([n for n in os.listdir(self.directory) if not n.endswith('.tmp')])
+
+
+class _CacheState:
+    def __init__(self, backend, generation_interval):
+        self.backend = backend
+        self.generation_interval = generation_interval
+        self.generation = _UNCHECKED
+        self.generation_checked = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+
+class SiteCache:
+    """Cache for responses and fragments, initalised with init_app."""
+
+    def init_app(self, app):
+        cache_type = app.config.get('CACHE_TYPE', 'memory')
+        if cache_type == 'memory':
+            backend = MemoryBackend(app.config.get('CACHE_SIZE', 1000))
+        elif cache_type == 'filesystem':
+            backend = FileSystemBackend(app.config['CACHE_DIR'], app.config.get('CACHE_SIZE', 1000))
+        elif cache_type == 'null':
+            backend = NullBackend()
+        else:
+            raise LookupError(f"Unknown CACHE_TYPE: {cache_type}")
+
+        app.extensions['site_cache'] = _CacheState(backend, app.config.get('CACHE_GENERATION_INTERVAL', 5))
+
+    @property
+    def _state(self):
+        return current_app.extensions['site_cache']
+
+    def _check_generation(self, state):
+        """Clear the backend if the cache generation changed."""
+        now = time.monotonic()
+        if now - state.generation_checked < state.generation_interval:
+            return
+
+        generation = db.session.query(Cache_generation.generation).filter_by(id='site').scalar()
+        with state.lock:
+            state.generation_checked = now
+            if generation != state.generation:
+                if state.generation is not _UNCHECKED:
+                    log.debug(f"Cache generation changed to {generation}, clearing cache")
+                    state.backend.clear()
+                state.generation = generation
+
+    def get(self, key, default=None):
+        """Return a cached value, or default."""
+        state = self._state
+        self._check_generation(state)
+
+        value = state.backend.get(key, default)
+        with state.lock:
+            if value is default:
+                state.misses += 1
+            else:
+                state.hits += 1
+        return value
+
+    def set(self, key, value, ttl):
+        """Cache value for ttl seconds."""
+        self._state.backend.set(key, value, ttl)
+
+    def get_or_set(self, key, ttl, function):
+        """Return a cached value, or cache and return the result of function()."""
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = function()
+            self.set(key, value, ttl)
+        return value
+
+    def cached(self, ttl, query_args=()):
+        """Decorate a view to cache its successful GET responses for ttl seconds.
+
+        Responses are cached by path and the query_args the view reads, other
+        query arguments don't make a new entry.
+        """
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(*args, **kwargs):
+                if request.method != 'GET':
+                    return view(*args, **kwargs)
+
+                key = f"view:{request.path}?{urlencode([(a, request.args[a]) for a in query_args if a in request.args])}"
+                cached_response = self.get(key)
+                if cached_response is not None:
+                    data, status, headers = cached_response
+                    return current_app.response_class(data, status=status, headers=headers)
+
+                response = current_app.make_response(view(*args, **kwargs))
+                if response.status_code == 200 and not response.direct_passthrough and 'Set-Cookie' not in response.headers:
+                    self.set(key, (response.get_data(), response.status_code, list(response.headers.items())), ttl)
+                return response
+            return wrapper
+        return decorator
+
+    def stats(self):
+        """Return hit and miss counters for this process."""
+        state = self._state
+        return {
+            'backend': type(state.backend).__name__,
+            'entries': len(state.backend),
+            'generation': None if state.generation is _UNCHECKED else state.generation,
+            'hits': state.hits,
+            'misses': state.misses,
+        }
+
+
+cache = SiteCache()
@@ -4,6 +4,7 @@ from flask_cors import CORS
 
 from fcreplay.site.filters import convertLength
 from fcreplay.site.blueprint import app as blueprint_app
+from fcreplay.site.cache import cache
 from fcreplay.site.database import db
 
 import os
@@ -28,6 +29,9 @@ def create_app(app_config):
     # Initalise Database
     db.init_app(app)
 
+    # Initalise response cache
+    cache.init_app(app)
+
     # Initalise Jinija2 Filters
     app_filters(app)
 
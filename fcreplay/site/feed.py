@@ -1,31 +1,60 @@
 from feedgen.feed import FeedGenerator
-from fcreplay.database import Database
+from fcreplay.site import queries
+from fcreplay.site.cache import cache
+from flask import make_response, request
+import hashlib
 import json
 import pkg_resources
 
+# Seconds a rendered feed is cached for, feeds are also dropped when a replay finishes
+FEED_TTL = 300
+
+# Number of replays in a feed
+FEED_LENGTH = 25
+
+CONTENT_TYPES = {
+    'atom': 'application/atom+xml',
+    'rss': 'application/rss+xml',
+}
+
 
 class Feed:
-    def __init__(self):
+    def __init__(self, game=None, player=None):
+        self.game = game
+        self.player = player
+
+        with open(pkg_resources.resource_filename('fcreplay', 'data/supported_games.json')) as f:
+            self.supported_games = json.load(f)
+
         self.fg = FeedGenerator()
-        self.fg.id('https://fightcadevids.com/feeds')
-        self.fg.title('FightcadeVids')
+        self.fg.id('https://fightcadevids.com/feeds' + self.path())
+        self.fg.title('FightcadeVids' + self.title_suffix())
         self.fg.author({'name': 'Gino Lisignoli', 'email': 'glisignoli@gmail.com'})
         self.fg.link(href='https://fightcadevids.com') # rel='alternate')
         self.fg.logo('https://fightcadevids.com/assets/img/fightcade_logo')
         self.fg.subtitle('Fightcade Videos')
         self.fg.language('en')
 
-        self.atomfeed = self.fg.atom_str(pretty=True)
-        self.rssfeed = self.fg.rss_str(pretty=True)
+        self.newest_date = None
+        self.version = hashlib.sha1(self.path().encode())
 
-        with open(pkg_resources.resource_filename('fcreplay', 'data/supported_games.json')) as f:
-            self.supported_games = json.load(f)
+    def path(self):
+        if self.game is not None:
+            return f'/game/{self.game}'
+        if self.player is not None:
+            return f'/player/{self.player}'
+        return ''
 
-        self.db = Database()
+    def title_suffix(self):
+        if self.game is not None:
+            return f" - {self.supported_games[self.game]['game_name']}"
+        if self.player is not None:
+            return f" - {self.player}"
+        return ''
 
     def generate_feed(self):
         # Read lates videos from database
-        replays = self.db.get_all_finished_replays(limit=25)
+        replays = queries.finished_replays(FEED_LENGTH, game=self.game, player=self.player)
 
         dates = []
 
@@ -47,18 +76,55 @@ class Feed:
             fe.updated(r.date_added.strftime('%a, %e %b %Y %H:%M:%S UTC'))
 
             dates.append(r.date_added)
+            self.version.update(f"{r.id}:{r.date_added}:{r.video_youtube_id}".encode())
 
         # Get newest date from list
-        newest_date = max(dates)
+        if dates:
+            self.newest_date = max(dates)
+            self.fg.updated(self.newest_date.strftime('%a, %e %b %Y %H:%M:%S UTC'))
+            self.fg.lastBuildDate(self.newest_date.strftime('%a, %e %b %Y %H:%M:%S UTC'))
 
-        self.fg.updated(newest_date.strftime('%a, %e %b %Y %H:%M:%S UTC'))
+    def render(self):
+        """Render the feed in every format.
 
-    def render_atom(self):
-        self.generate_feed()
-        atom = self.fg.atom_str(pretty=True)
-        return atom
+        The etag depends only on the replays in the feed, so it's the same in
+        every site process.
 
-    def render_rss(self):
+        Returns:
+            dict: Format to (body, etag, last modified date)
+        """
         self.generate_feed()
-        rss = self.fg.rss_str(pretty=True)
-        return rss
+
+        rendered = {}
+        for kind, body in (('atom', self.fg.atom_str(pretty=True)), ('rss', self.fg.rss_str(pretty=True))):
+            rendered[kind] = (body, f"{kind}-{self.version.hexdigest()}", self.newest_date)
+        return rendered
+
+
+def feed_response(kind, game=None, player=None):
+    """Return a feed response, rendered at most once per FEED_TTL.
+
+    Both formats are rendered and cached together. Requests with a matching
+    If-None-Match or If-Modified-Since get a 304.
+
+    Args:
+        kind (str): 'atom' or 'rss'
+        game (str, optional): Only include replays of this game
+        player (str, optional): Only include replays with this player
+
+    Returns:
+        flask.Response: Response
+    """
+    rendered = cache.get_or_set(
+        f"feed:{game}:{player}", FEED_TTL,
+        lambda: Feed(game=game, player=player).render()
+    )
+    body, etag, last_modified = rendered[kind]
+
+    response = make_response(body)
+    response.content_type = CONTENT_TYPES[kind]
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.public = True
+    response.cache_control.max_age = FEED_TTL
+    return response.make_conditional(request)
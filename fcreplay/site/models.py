@@ -22,6 +22,20 @@ class Replays(db.Model):
     video_youtube_id = db.Column(db.String)
     fail_count = db.Column(db.Integer)
     ia_filename = db.Column(db.String)
+    date_finished = db.Column(db.DateTime)
+
+    # There are no foreign keys in the database, so the join columns are marked with foreign()
+    description = db.relationship(
+        'Descriptions', primaryjoin='foreign(Descriptions.id) == Replays.id', uselist=False, viewonly=True)
+    characters = db.relationship(
+        'Character_detect', primaryjoin='foreign(Character_detect.challenge_id) == Replays.id',
+        order_by='Character_detect.vid_seconds', viewonly=True)
+
+
+class Job(db.Model):
+    id = db.Column(db.Text, primary_key=True)
+    start_time = db.Column(db.DateTime)
+    instance = db.Column(db.String)
 
 
 class Descriptions(db.Model):
@@ -29,10 +43,47 @@ class Descriptions(db.Model):
     description = db.Column(db.Text)
 
 
+class Players(db.Model):
+    name = db.Column(db.Text, primary_key=True)
+
+
+class Search_trigram(db.Model):
+    trigram = db.Column(db.Text, primary_key=True)
+    source = db.Column(db.Text, primary_key=True)
+    key = db.Column(db.Text, primary_key=True)
+
+
+class Search_trigram_count(db.Model):
+    trigram = db.Column(db.Text, primary_key=True)
+    source = db.Column(db.Text, primary_key=True)
+    count = db.Column(db.Integer)
+
+
+class Game_count(db.Model):
+    id = db.Column(db.Text, primary_key=True)
+    count = db.Column(db.Integer)
+
+
+class Cache_generation(db.Model):
+    id = db.Column(db.Text, primary_key=True)
+    generation = db.Column(db.Integer)
+
+
+class Stage_timing(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    challenge_id = db.Column(db.String)
+    game = db.Column(db.String)
+    stage = db.Column(db.String)
+    replay_length = db.Column(db.Integer)
+    duration = db.Column(db.Float)
+    date_added = db.Column(db.DateTime)
+
+
 class Character_detect(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     challenge_id = db.Column(db.Text, primary_key=True)
     p1_char = db.Column(db.String)
     p2_char = db.Column(db.String)
     vid_time = db.Column(db.String)
+    vid_seconds = db.Column(db.Integer)
     game = db.Column(db.String)
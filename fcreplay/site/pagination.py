@@ -0,0 +1,102 @@
+"""Keyset pagination for replay listings.
+
+The next and previous page links carry a cursor, the (sort column, id) of
+the last or first replay on the current page, as after=<value>,<id> or
+before=<value>,<id>. A page with a cursor starts right after it, so paging
+through a listing never uses OFFSET, in any process. Pages addressed only
+by number, eg. a numbered link or an old bookmark, still use OFFSET.
+
+The total count is kept in the site cache, so it's shared between processes
+using the filesystem backend, and dropped with the cache generation when
+the visible replays change.
+
+Replays with a NULL sort value are never reached through a cursor, which is
+fine for visible replays as add_replay always sets them.
+"""
+from flask import abort
+from flask_sqlalchemy import Pagination
+from fcreplay.site.cache import cache
+from fcreplay.site.models import Replays
+from sqlalchemy import DateTime, tuple_
+
+import datetime
+
+# Seconds that counts are cached for, they are also dropped when the cache generation changes
+COUNT_TTL = 3600
+
+
+def _query_key(query):
+    compiled = query.statement.compile()
+    return str(compiled) + repr(sorted(compiled.params.items()))
+
+
+def format_cursor(replay, order_column):
+    """Return the cursor for replay, or None if its sort value is NULL."""
+    value = getattr(replay, order_column.key)
+    if value is None:
+        return None
+    if isinstance(value, datetime.datetime):
+        value = value.isoformat()
+    return f"{value},{replay.id}"
+
+
+def parse_cursor(cursor, order_column):
+    """Return (sort value, id) from a cursor, aborting with a 400 if it's malformed."""
+    try:
+        value, challenge_id = cursor.split(',', 1)
+        if isinstance(order_column.type, DateTime):
+            return datetime.datetime.fromisoformat(value), challenge_id
+        return order_column.type.python_type(value), challenge_id
+    except ValueError:
+        abort(400)
+
+
+def paginate(query, order_column, page, per_page=9, after=None, before=None):
+    """Return a page of replays.
+
+    Args:
+        query (flask_sqlalchemy.BaseQuery): Replays query, ordered by order_column
+            descending, then Replays.id descending
+        order_column (sqlalchemy.Column): Column the query is sorted by
+        page (int): Page number, starting at 1
+        per_page (int, optional): Replays per page. Defaults to 9.
+        after (str, optional): Cursor from the previous page's next link
+        before (str, optional): Cursor from the next page's previous link
+
+    Returns:
+        flask_sqlalchemy.Pagination: Pagination, without a query. next_cursor and
+            prev_cursor are the url arguments for the next and previous page links.
+    """
+    if page < 1:
+        abort(404)
+
+    total = cache.get_or_set(f"count:{_query_key(query)}", COUNT_TTL, lambda: query.order_by(None).count())
+    position = tuple_(order_column, Replays.id)
+
+    if after is not None:
+        items = query.filter(position < tuple_(*parse_cursor(after, order_column))).limit(per_page).all()
+    elif before is not None:
+        # Read backwards from the cursor, then put the page back in order
+        items = query.filter(position > tuple_(*parse_cursor(before, order_column))).order_by(None).order_by(
+            order_column.asc(), Replays.id.asc()
+        ).limit(per_page).all()[::-1]
+    else:
+        items = query.offset((page - 1) * per_page).limit(per_page).all()
+
+    if not items and page != 1:
+        abort(404)
+
+    pagination = Pagination(None, page, per_page, total, items)
+    pagination.next_cursor = {}
+    pagination.prev_cursor = {}
+    if items:
+        next_cursor = format_cursor(items[-1], order_column)
+        if next_cursor is not None:
+            pagination.next_cursor = {'after': next_cursor}
+
+        # The first page is linked without a cursor, so it always shows the newest replays
+        prev_cursor = format_cursor(items[0], order_column)
+        if prev_cursor is not None and page > 2:
+            pagination.prev_cursor = {'before': prev_cursor}
+
+    return pagination
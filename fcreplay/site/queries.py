@@ -1,24 +1,89 @@
-from fcreplay.site.models import Replays, Descriptions, Character_detect
+from fcreplay import eta, metrics, search
+from fcreplay.site.cache import cache
+from fcreplay.site.models import Replays, Descriptions, Character_detect, Game_count, Job, Players, Search_trigram, Search_trigram_count, Stage_timing
 from fcreplay.site.database import db
+from sqlalchemy import and_, func, or_
+from sqlalchemy.orm import joinedload
 
+import datetime
 
-def _order(order_string):
+# Seconds the stage statistics for ETAs are cached for
+ETA_STATISTICS_TTL = 600
+
+
+def order_column(order_string):
     if order_string == 'date_replay':
-        return Replays.date_replay.desc()
+        return Replays.date_replay
     elif order_string == 'date_added':
-        return Replays.date_added.desc()
+        return Replays.date_added
     elif order_string == 'length':
-        return Replays.length.desc()
+        return Replays.length
     else:
         raise LookupError
 
 
+def _order(order_string):
+    """Return the ordering for order_string, newest or longest first, see pagination.paginate."""
+    return order_column(order_string).desc(), Replays.id.desc()
+
+
+def _trigram_index():
+    """Return the search_trigram tables, or None on postgres, where pg_trgm indexes are used."""
+    if not search.uses_trigram_table(db.engine):
+        return None
+    return search.TrigramIndex(Search_trigram.__table__, Search_trigram_count.__table__)
+
+
+def _description_search(search_query):
+    return Descriptions.query.with_entities(Descriptions.id).filter(
+        search.search_filter(
+            Descriptions.description, f'%{search_query}%',
+            key=Descriptions.id, source='description', search_query=search_query,
+            index=_trigram_index()
+        )
+    )
+
+
+def _player_filter(column, pattern):
+    return search.search_filter(
+        column, pattern,
+        key=column, source='player', search_query=pattern,
+        index=_trigram_index()
+    )
+
+
 def all_replays():
     return Replays.query.filter(
         Replays.created == True,
         Replays.failed == False,
         Replays.video_processed == True
-    ).order_by(Replays.date_added.desc())
+    ).order_by(*_order('date_added'))
+
+
+def finished_replays(limit, game=None, player=None):
+    query = Replays.query.filter(
+        Replays.created == True,
+        Replays.failed == False
+    )
+
+    if game is not None:
+        query = query.filter(Replays.game == game)
+
+    if player is not None:
+        query = query.filter((Replays.p1 == player) | (Replays.p2 == player))
+
+    return query.order_by(*_order('date_added')).limit(limit).all()
+
+
+def game_counts():
+    return {c.id: c.count for c in Game_count.query.all()}
+
+
+def pending_count():
+    return db.session.query(func.count(Replays.id)).filter(
+        Replays.created == False,
+        Replays.failed == False
+    ).scalar()
 
 
 def multiple_replays(challenge_ids):
@@ -30,22 +95,81 @@ def multiple_replays(challenge_ids):
     ).all()
 
 
-def single_replay(challenge_id):
-    return Replays.query.filter(
+def replay_status(challenge_id):
+    """Return (replay, job start time, player queue position), like Database.get_replay_status."""
+    queue = db.session.query(
+        Replays.id,
+        func.row_number().over(order_by=(Replays.date_added.desc(), Replays.id.desc())).label('position')
+    ).filter(
+        Replays.player_requested == True,
+        Replays.failed == False,
+        Replays.created == False
+    ).subquery()
+
+    return db.session.query(
+        Replays, Job.start_time, queue.c.position
+    ).outerjoin(
+        Job, Job.id == Replays.id
+    ).outerjoin(
+        queue, queue.c.id == Replays.id
+    ).filter(
         Replays.id == challenge_id
     ).first()
 
 
-def character_detect(challenge_id):
-    return Character_detect.query.filter(
-        Character_detect.challenge_id == challenge_id
+def replay_counts(since):
+    """Return the replay counts used for metrics, like Database.get_replay_counts."""
+    return metrics.query_replay_counts(db.session, Replays, Job, since)
+
+
+def replay_eta(replay):
+    """Return the predicted seconds until a replay is finished, like jobstatus.get_eta.
+
+    The stage statistics the model is fitted to are cached for ETA_STATISTICS_TTL seconds.
+    """
+    if replay.created or replay.failed:
+        return None
+
+    def stage_statistics():
+        since = datetime.datetime.utcnow() - datetime.timedelta(days=eta.HISTORY_DAYS)
+        return eta.query_stage_statistics(db.session, Stage_timing, since)
+
+    model = eta.EtaModel(cache.get_or_set('eta_statistics', ETA_STATISTICS_TTL, stage_statistics))
+    return eta.predict(
+        model, replay,
+        eta.query_running_replays(db.session, Replays, Job, Stage_timing),
+        lambda: eta.query_queue_ahead(db.session, Replays, replay),
+        datetime.datetime.utcnow()
+    )
+
+
+def video_details(challenge_ids):
+    """Return visible replays with their description and characters, loaded in one query."""
+    return Replays.query.options(
+        joinedload(Replays.description),
+        joinedload(Replays.characters)
+    ).filter(
+        Replays.created == True,
+        Replays.failed == False,
+        Replays.video_processed == True,
+        Replays.id.in_(challenge_ids)
     ).all()
 
 
+def video_detail(challenge_id):
+    """Return a replay with its description and characters, loaded in one query."""
+    return Replays.query.options(
+        joinedload(Replays.description),
+        joinedload(Replays.characters)
+    ).filter(
+        Replays.id == challenge_id
+    ).one_or_none()
+
+
 def player_search(player_id):
     return Replays.query.filter(
         (Replays.p1 == player_id) | (Replays.p2 == player_id)
-    )
+    ).order_by(*_order('date_added'))
 
 
 def basic_search(game_id, search_query, order_string):
@@ -53,124 +177,92 @@ def basic_search(game_id, search_query, order_string):
         Replays.created == True,
         Replays.failed == False,
         Replays.game.ilike(f'{game_id}'),
-        Replays.id.in_(
-            Descriptions.query.with_entities(Descriptions.id).filter(
-                Descriptions.description.ilike(f'%{search_query}%')
-            )
-        ),
+        Replays.id.in_(_description_search(search_query)),
         Replays.video_processed == True
-    ).order_by(_order(order_string))
-
+    ).order_by(*_order(order_string))
 
-def playerlist():
-    players = []
 
-    p1_query = db.session.query(Replays.p1.label('player'))
-    p2_query = db.session.query(Replays.p2.label('player'))
+def playerlist(after=None, limit=None):
+    query = Players.query.order_by(Players.name)
 
-    union_players = p1_query.union(p2_query)
+    if after is not None:
+        query = query.filter(Players.name > after)
 
-    for p in union_players:
-        players.append(p.player)
+    if limit is not None:
+        query = query.limit(limit)
 
-    return players
+    return [p.name for p in query]
 
 
 def playerlist_search(player_id):
-    players = []
-
-    p1_query = db.session.query(Replays.p1.label('player')).filter(
-        Replays.p1.ilike(f'%{player_id}%')
-    )
+    query = Players.query.filter(
+        search.search_filter(
+            Players.name, f'%{player_id}%',
+            key=Players.name, source='player', search_query=player_id,
+            index=_trigram_index()
+        )
+    ).order_by(Players.name)
 
-    p2_query = db.session.query(Replays.p2.label('player')).filter(
-        Replays.p2.ilike(f'%{player_id}%')
-    )
+    return [p.name for p in query]
 
-    union_players = p1_query.union(p2_query)
 
-    for p in union_players:
-        players.append(p.player)
+def _any(value, wildcards=('', 'Any', 'any')):
+    """Return None if value matches anything, otherwise value."""
+    if value is None or value.strip() in wildcards:
+        return None
+    return value.strip()
 
-    return players
 
+def _symmetric(column1, column2, value1, value2, match):
+    """Return a filter matching value1 and value2 against column1 and column2, in either order.
 
-def advanced_search(game_id, p1_rank, p2_rank, search_query, order_by, char1='Any', char2='Any', p1_name='_anyplayersearch_', p2_name='_anyplayersearch_'):
-    if p1_name.strip() == '':
-        p1_name = '%'
-    if p2_name.strip() == '':
-        p2_name = '%'
+    Values of None match anything. Returns None if both values are None.
+    """
+    if value1 is None and value2 is None:
+        return None
 
-    if char1 == 'Any':
-        char1 = '%'
-    if char2 == 'Any':
-        char2 = '%'
+    def pair(first, second):
+        return and_(*[match(c, v) for c, v in ((column1, first), (column2, second)) if v is not None])
 
-    if game_id == 'Any':
-        game_id = '%'
+    return or_(pair(value1, value2), pair(value2, value1))
 
-    if p1_rank == 'any':
-        p1_rank = '%'
-    if p2_rank == 'any':
-        p2_rank = '%'
 
+def advanced_search(game_id, p1_rank, p2_rank, search_query, order_by, char1='Any', char2='Any', p1_name='', p2_name=''):
     query = [
         Replays.created == True,
         Replays.failed == False,
-        Replays.game.ilike(f'{game_id}'),
         Replays.video_processed == True
     ]
 
-    query.append(
-        Replays.id.in_(
-            Descriptions.query.with_entities(Descriptions.id).filter(
-                Descriptions.description.ilike(f'%{search_query}%')
-            )
-        )
-    )
+    game_id = _any(game_id)
+    if game_id is not None:
+        query.append(Replays.game == game_id)
 
-    query.append(
-        Replays.id.in_(
-            Replays.query.with_entities(Replays.id).filter(
-                Replays.p1_rank.ilike(f'{p1_rank}'),
-                Replays.p2_rank.ilike(f'{p2_rank}')
-            ).union(
-                Replays.query.with_entities(Replays.id).filter(
-                    Replays.p1_rank.ilike(f'{p2_rank}'),
-                    Replays.p2_rank.ilike(f'{p1_rank}')
-                )
-            )
-        )
-    )
+    search_query = _any(search_query)
+    if search_query is not None:
+        query.append(Replays.id.in_(_description_search(search_query)))
+
+    ranks = _symmetric(Replays.p1_rank, Replays.p2_rank, _any(p1_rank), _any(p2_rank),
+                       lambda column, rank: column == rank)
+    if ranks is not None:
+        query.append(ranks)
+
+    players = _symmetric(Replays.p1, Replays.p2, _any(p1_name), _any(p2_name), _player_filter)
+    if players is not None:
+        query.append(players)
+
+    # Character names come from the character_detect table, so they are matched exactly
+    characters = _symmetric(Character_detect.p1_char, Character_detect.p2_char, _any(char1), _any(char2),
+                            lambda column, char: column == char)
+    if characters is not None:
+        character_filter = [characters]
+        if game_id is not None:
+            character_filter.append(Character_detect.game == game_id)
 
-    if char1 != '%' or char2 != '%':
         query.append(
             Replays.id.in_(
-                Character_detect.query.with_entities(Character_detect.challenge_id).filter(
-                    Character_detect.p1_char.ilike(f'{char1}'),
-                    Character_detect.p2_char.ilike(f'{char2}')
-                ).union(
-                    Character_detect.query.with_entities(Character_detect.challenge_id).filter(
-                        Character_detect.p1_char.ilike(f'{char2}'),
-                        Character_detect.p2_char.ilike(f'{char1}')
-                    )
-                )
+                Character_detect.query.with_entities(Character_detect.challenge_id).filter(*character_filter)
             )
         )
 
-    query.append(
-        Replays.id.in_(
-            Replays.query.with_entities(Replays.id).filter(
-                Replays.p1.ilike(f'{p1_name}'),
-                Replays.p2.ilike(f'{p2_name}')
-            ).union(
-                Replays.query.with_entities(Replays.id).filter(
-                    Replays.p1.ilike(f'{p2_name}'),
-                    Replays.p2.ilike(f'{p1_name}')
-                )
-            )
-        )
-    )
-
-    built_query = Replays.query.filter(*query)
-    return built_query.order_by(_order(order_by))
+    return Replays.query.filter(*query).order_by(*_order(order_by))
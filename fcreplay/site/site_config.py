@@ -1,12 +1,32 @@
 from fcreplay.config import Config as FcreplayConfig
 
+import os
+
 
 class Config(object):
     config = FcreplayConfig()
     DEBUG = False
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SQLALCHEMY_DATABASE_URI = config.sql_baseurl
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_pre_ping': True,
+        'pool_size': config.sql_pool_size,
+        'max_overflow': config.sql_max_overflow,
+        'pool_recycle': config.sql_pool_recycle,
+    }
     SECRET_KEY = config.secret_key
+    CACHE_TYPE = 'memory'  # memory, filesystem or null
+    CACHE_SIZE = 1000
+    CACHE_DIR = '/tmp/fcreplay_site_cache'
+    CACHE_GENERATION_INTERVAL = 5
+    SITEMAP_DIR = '/tmp/fcreplay_sitemap'
+    SITEMAP_URL = 'http://fightcadevids.com'
+    SITEMAP_INTERVAL = 3600
+    # Threads serving requests, passed to waitress by files/waitress.sh
+    THREADS = int(os.environ.get('SITE_THREADS', 8))
+    # Status long polls waiting at once. Each holds a thread and a database connection, so
+    # sql_pool_size + sql_max_overflow should be at least THREADS + STATUS_MAX_WAITERS
+    STATUS_MAX_WAITERS = THREADS // 2
 
 
 class ProdConfig(Config):
@@ -25,4 +45,8 @@ class TestConfig(Config):
     DEBUG = True
 
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    SQLALCHEMY_ENGINE_OPTIONS = {}
     SECRET_KEY = 'testingtestingtesting'
+    CACHE_TYPE = 'null'
+    SITEMAP_DIR = '/tmp/fcreplay_test_sitemap'  # Tests set a temporary directory
+    SITEMAP_INTERVAL = 0
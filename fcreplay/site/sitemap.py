@@ -0,0 +1,196 @@
+"""Sitemap index of the site pages and every replay shown on the site.
+
+Replay URLs are split into files of SITEMAP_SIZE URLs, ordered by
+(date_added, id). The files and a small index.json are written to
+SITEMAP_DIR, and are updated at most every SITEMAP_INTERVAL seconds.
+
+Updates are incremental. set_replays_processed sets date_added when a replay
+becomes visible, so new replays are always added after the last file. A
+file is only written again if the number of replays in its range changed
+(eg. a replay was deleted), or if it's the last, partly filled file.
+
+Replays are streamed from the database in batches of STREAM_BATCH, and
+written straight to disk, so the catalogue is never loaded into memory.
+"""
+from fcreplay.site.models import Replays
+from flask import current_app
+from sqlalchemy import func, tuple_
+from xml.sax.saxutils import escape
+
+import datetime
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import time
+
+log = logging.getLogger('fcreplay')
+
+# Maximum number of URLs in a sitemap file, from the sitemap protocol
+SITEMAP_SIZE = 50000
+
+# Number of rows fetched from the database at a time
+STREAM_BATCH = 1000
+
+URLSET_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+URLSET_FOOTER = '</urlset>\n'
+
+
+def _visible_replays():
+    return Replays.query.filter(
+        Replays.created == True,
+        Replays.failed == False,
+        Replays.video_processed == True,
+        Replays.date_added.isnot(None)
+    )
+
+
+def _key(row):
+    return [row.date_added.isoformat(), row.id]
+
+
+def _cursor(key):
+    return tuple_(datetime.datetime.fromisoformat(key[0]), key[1])
+
+
+class Sitemap:
+    def __init__(self, directory, base_url, size=SITEMAP_SIZE):
+        self.directory = directory
+        self.base_url = base_url.rstrip('/')
+        self.size = size
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def video_path(self, number):
+        """Return the path of video sitemap file number, starting at 0."""
+        return self._path(f"videos-{number}.xml")
+
+    def state(self):
+        """Return the saved state, or an empty state if there is none.
+
+        Returns:
+            dict: 'updated' (unix time) and 'chunks', a list of
+                {'first': key, 'last': key, 'count': int, 'lastmod': str}
+        """
+        try:
+            with open(self._path('index.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {'updated': 0, 'chunks': []}
+
+    def _save_state(self, state):
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(state, f)
+        os.replace(temp_path, self._path('index.json'))
+
+    def _unchanged_chunks(self, chunks):
+        """Return the leading full chunks whose replays haven't changed."""
+        unchanged = []
+        for chunk in chunks:
+            if chunk['count'] != self.size:
+                break
+
+            count = _visible_replays().with_entities(func.count(Replays.id)).filter(
+                tuple_(Replays.date_added, Replays.id) >= _cursor(chunk['first']),
+                tuple_(Replays.date_added, Replays.id) <= _cursor(chunk['last'])
+            ).scalar()
+            if count != chunk['count']:
+                break
+            unchanged.append(chunk)
+        return unchanged
+
+    def _write_chunks(self, number, rows):
+        """Write rows to video sitemap files, starting at file number.
+
+        Returns:
+            list: Chunk state for each file written
+        """
+        chunks = []
+        f = None
+        temp_path = None
+        last = None
+        count = 0
+        base_url = escape(self.base_url)
+
+        def close():
+            f.write(URLSET_FOOTER)
+            f.close()
+            os.replace(temp_path, self.video_path(number + len(chunks) - 1))
+            chunks[-1].update(last=_key(last), lastmod=last.date_added.strftime('%Y-%m-%d'), count=count)
+
+        for row in rows:
+            if f is None or count == self.size:
+                if f is not None:
+                    close()
+                fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+                f = os.fdopen(fd, 'w')
+                f.write(URLSET_HEADER)
+                chunks.append({'first': _key(row)})
+                count = 0
+
+            f.write(f"<url><loc>{base_url}/video/{escape(row.id)}</loc><lastmod>{row.date_added:%Y-%m-%d}</lastmod></url>\n")
+            last = row
+            count += 1
+
+        if f is not None:
+            close()
+        return chunks
+
+    def update(self, full=False, interval=None):
+        """Update the sitemap files.
+
+        Args:
+            full (bool, optional): Write every file again. Defaults to False.
+            interval (int, optional): Only update if the last update was more than
+                interval seconds ago, checked once the update lock is held
+
+        Returns:
+            dict: State, see Sitemap.state
+        """
+        with open(self._path('update.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            state = self.state()
+            if interval is not None and time.time() - state['updated'] < interval:
+                return state
+
+            chunks = [] if full else self._unchanged_chunks(state['chunks'])
+
+            query = _visible_replays().with_entities(Replays.id, Replays.date_added)
+            if chunks:
+                query = query.filter(tuple_(Replays.date_added, Replays.id) > _cursor(chunks[-1]['last']))
+            rows = query.order_by(Replays.date_added, Replays.id).execution_options(
+                stream_results=True).yield_per(STREAM_BATCH)
+
+            written = self._write_chunks(len(chunks), rows)
+            log.debug(f"Kept {len(chunks)} sitemap files, wrote {len(written)}")
+            chunks.extend(written)
+
+            # Remove files that are no longer in the index
+            for number in range(len(chunks), len(state['chunks'])):
+                try:
+                    os.remove(self.video_path(number))
+                except FileNotFoundError:
+                    pass
+
+            state = {'updated': time.time(), 'chunks': chunks}
+            self._save_state(state)
+            return state
+
+    def update_if_stale(self, interval):
+        """Update the sitemap if it wasn't updated in the last interval seconds, and return the state."""
+        state = self.state()
+        if time.time() - state['updated'] < interval:
+            return state
+        return self.update(interval=interval)
+
+
+def site_sitemap():
+    """Return the Sitemap for the current app, configured with SITEMAP_DIR and SITEMAP_URL."""
+    if 'sitemap' not in current_app.extensions:
+        current_app.extensions['sitemap'] = Sitemap(current_app.config['SITEMAP_DIR'], current_app.config['SITEMAP_URL'])
+    return current_app.extensions['sitemap']
@@ -2,6 +2,7 @@ class Status:
     def __init__(self):
         self.status_description = {
             "ADDED": "Replay added",
+            "CLAIMED": "Replay claimed by a recorder",
             "FAILED": "Replay failed to encode",
             "JOB_ADDED": "Job added",
             "REMOVED_JOB": "Removed job",
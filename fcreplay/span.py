@@ -0,0 +1,101 @@
+"""Measure the wall time, CPU time and peak memory of a block of code.
+
+Example:
+    with Span('encode') as span:
+        subprocess.run(['mencoder', ...])
+    log.info(f"{span.name} took {span.duration}s, {span.cpu_seconds}s of CPU")
+
+CPU time includes child processes (eg. mencoder and ffmpeg) that finished
+during the span. Peak RSS is the highest resident set size of the process
+during the span, or of a child process if one raised the high water mark of
+all children. Per span peaks rely on /proc/self/clear_refs, so outside of
+linux the process peak is since the process started.
+"""
+from fcreplay.metrics import format_metric
+
+import resource
+import time
+
+
+def _cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime + children.ru_utime + children.ru_stime
+
+
+def _children_peak_rss():
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+
+
+def _reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _peak_rss():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Span:
+    def __init__(self, name):
+        """Time a block of code, see the module docstring.
+
+        Args:
+            name (str): Name of the span, eg. the processing stage
+        """
+        self.name = name
+        self.duration = None
+        self.cpu_seconds = None
+        self.peak_rss = None
+        self.failed = False
+
+    def __enter__(self):
+        _reset_peak_rss()
+        self._children_peak_rss = _children_peak_rss()
+        self._cpu_start = _cpu_seconds()
+        self._start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.monotonic() - self._start
+        self.cpu_seconds = _cpu_seconds() - self._cpu_start
+
+        self.peak_rss = _peak_rss()
+        children_peak_rss = _children_peak_rss()
+        if children_peak_rss > self._children_peak_rss:
+            self.peak_rss = max(self.peak_rss, children_peak_rss)
+
+        self.failed = exc_type is not None
+
+
+def prometheus_text(spans, labels=None):
+    """Return finished spans as gauges in the prometheus text format.
+
+    Args:
+        spans (list): Finished Spans, the name is used as the stage label
+        labels (dict, optional): Labels added to every sample, eg. {'game': 'sfiii3nr1'}
+
+    Returns:
+        str: Metrics text
+    """
+    metrics = [
+        ('fcreplay_stage_duration_seconds', 'Wall time of each processing stage of the last replay', 'duration'),
+        ('fcreplay_stage_cpu_seconds', 'CPU time, including child processes, of each processing stage of the last replay', 'cpu_seconds'),
+        ('fcreplay_stage_peak_rss_bytes', 'Peak resident set size of each processing stage of the last replay', 'peak_rss'),
+    ]
+
+    return ''.join(
+        format_metric(metric, 'gauge', help_text, [(dict(labels or {}, stage=span.name), getattr(span, attribute)) for span in spans])
+        for metric, help_text, attribute in metrics
+    )
@@ -8,6 +8,7 @@ from dataclasses import dataclass
 @dataclass
 class status:
     ADDED: str = "ADDED"
+    CLAIMED: str = "CLAIMED"
     FAILED: str = "FAILED"
     JOB_ADDED: str = "JOB_ADDED"
     REMOVED_JOB: str = "REMOVED_JOB"
@@ -0,0 +1,146 @@
+"""Run the tasker's periodic jobs from one process.
+
+Each job runs on a thread pool, so a slow job doesn't hold up the others:
+ - A job never overlaps itself. The next run is scheduled when a run
+   finishes, a random number of seconds between interval and max_interval
+   later, so jobs drift apart instead of running in lockstep.
+ - trigger runs a job straight away, or straight after its current run.
+ - An exception is logged and counted, the job runs again at its next time.
+
+Run durations and results are kept per job:
+    fcreplay_job_duration_seconds{job}       Histogram of run durations
+    fcreplay_job_runs_total{job,result}      Runs by result, success or error
+
+Example:
+    supervisor = Supervisor()
+    supervisor.add('check_video_status', tasker.update_video_status, 3300, 3900)
+    supervisor.run_forever()
+"""
+from concurrent.futures import ThreadPoolExecutor
+from fcreplay import metrics
+
+import logging
+import random
+import threading
+import time
+
+log = logging.getLogger('fcreplay')
+
+# Job duration buckets in seconds, jobs take from under a second to hours
+JOB_BUCKETS = (0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+
+
+class _Job:
+    def __init__(self, name, function, interval, max_interval, next_run):
+        self.name = name
+        self.function = function
+        self.interval = interval
+        self.max_interval = max_interval
+        self.next_run = next_run
+        self.running = False
+        self.triggered = False
+
+
+class Supervisor:
+    def __init__(self, max_workers=5, clock=time.monotonic, uniform=random.uniform):
+        """Schedule jobs on a thread pool, see the module docstring.
+
+        Args:
+            max_workers (int, optional): Jobs that can run at the same time
+            clock (function, optional): Returns the time in seconds
+            uniform (function, optional): Returns a random number between two numbers
+        """
+        self.clock = clock
+        self.uniform = uniform
+        self.jobs = {}
+        self.durations = metrics.Histogram('fcreplay_job_duration_seconds', 'Seconds each tasker job run took',
+                                           buckets=JOB_BUCKETS)
+        self.runs = metrics.Counter('fcreplay_job_runs_total', 'Tasker job runs by result')
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='tasker-job')
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+
+    def add(self, name, function, interval, max_interval=None, start_delay=0):
+        """Add a job.
+
+        Args:
+            name (str): Job name, used in logs and metrics
+            function (function): Called with no arguments
+            interval (int): Minimum seconds between the end of a run and the next
+            max_interval (int, optional): Maximum seconds between runs. Defaults to interval.
+            start_delay (int, optional): The first run is up to this many seconds after adding
+        """
+        next_run = self.clock() + self.uniform(0, start_delay)
+        with self._lock:
+            self.jobs[name] = _Job(name, function, interval, max_interval or interval, next_run)
+        self._wake.set()
+
+    def trigger(self, name):
+        """Run a job now, or once its current run finishes. Unknown jobs are ignored."""
+        with self._lock:
+            job = self.jobs.get(name)
+            if job is None:
+                return
+            if job.running:
+                job.triggered = True
+            else:
+                job.next_run = self.clock()
+        self._wake.set()
+
+    def run_pending(self):
+        """Start the jobs that are due and not already running.
+
+        Returns:
+            list: Names of the started jobs
+        """
+        now = self.clock()
+        with self._lock:
+            due = [job for job in self.jobs.values() if not job.running and job.next_run <= now]
+            for job in due:
+                job.running = True
+
+        for job in due:
+            self._executor.submit(self._run, job)
+        return [job.name for job in due]
+
+    def _run(self, job):
+        start = self.clock()
+        result = 'error'
+        try:
+            job.function()
+            result = 'success'
+        except Exception as e:
+            log.exception(f"Job {job.name} failed: {e}")
+        finally:
+            # Also reached for SystemExit and the like, so the job isn't left running forever
+            end = self.clock()
+            self.durations.observe(end - start, job=job.name)
+            self.runs.inc(job=job.name, result=result)
+            log.debug(f"Job {job.name} finished in {end - start:.1f}s: {result}")
+
+            with self._lock:
+                job.running = False
+                if job.triggered:
+                    job.triggered = False
+                    job.next_run = end
+                else:
+                    job.next_run = end + self.uniform(job.interval, job.max_interval)
+            self._wake.set()
+
+    def run_forever(self, tick=1):
+        """Run jobs until stop is called, checking at least every tick seconds."""
+        while not self._stopped.is_set():
+            self.run_pending()
+            self._wake.wait(tick)
+            self._wake.clear()
+
+    def stop(self, wait=True):
+        """Stop run_forever, and wait for running jobs if wait is true."""
+        self._stopped.set()
+        self._wake.set()
+        self._executor.shutdown(wait=wait)
+
+    def render(self):
+        """Return the job metrics in the prometheus text format."""
+        return self.durations.render() + self.runs.render()
@@ -1,101 +1,139 @@
 #!/usr/bin/env python3
+from fcreplay import metrics
+from fcreplay.containers import ContainerTracker
 from fcreplay.database import Database
 from fcreplay.getreplay import Getreplay
+from fcreplay.scheduler import RecorderScheduler, avi_footprint, parse_size
+from fcreplay.supervisor import Supervisor
+from fcreplay.videostatus import VideoStatusChecker
 import docker
+import json
 import os
-import requests
-import schedule
+import pkg_resources
 import shutil
-import time
 import uuid
 
+# Directory AVI_TEMP_DIR is mounted on in the tasker container
+AVI_STORAGE_DIR = '/avi_storage_temp'
+
+INSTANCE_PREFIX = 'fcreplay-instance-'
+
+# Hourly jobs run every 55 to 65 minutes, and start up to START_JITTER seconds apart
+HOURLY = (55 * 60, 65 * 60)
+START_JITTER = 30
+
 
 class Tasker:
-    def __init__(self):
-        self.started_instances = {}
+    def __init__(self, docker_client=None):
+        self.started_instances = {}  # Container name: temp dir uuid
+        self.instance_replays = {}  # Container name: challenge id it was started for
+        self._docker = docker_client
+        self._containers = None
         self.db = Database()
         self.max_instances = 1
         self.max_fails = 5
+        self.launches = metrics.Counter('fcreplay_tasker_launches_total', 'Recorder instances launched by the tasker')
+        self.scheduler = RecorderScheduler(
+            avi_dir=AVI_STORAGE_DIR,
+            cpus_per_instance=int(os.environ.get('CPUS', 1)),
+            memory_per_instance=parse_size(os.environ.get('MEMORY', 0))
+        )
 
-    def check_for_replay(self) -> bool:
-        if self.number_of_instances() >= self.max_instances:
-            print(f"Maximum number of instances ({self.max_instances}) reached")
-            return False
+        self.supervisor = Supervisor()
+        self.video_status = VideoStatusChecker()
+        self._getreplay = None
+
+        with open(pkg_resources.resource_filename('fcreplay', 'data/supported_games.json')) as f:
+            self.supported_games = json.load(f)
+
+    def avi_footprint(self, replay) -> int:
+        """Return the estimated bytes of AVI files recorded for a replay."""
+        return avi_footprint(replay.length, self.supported_games[replay.game]['aspect_ratio'])
 
-        print("Looking for replay")
-        player_replay = self.db.get_oldest_player_replay()
-        if player_replay is not None:
-            print("Found player replay")
-            self.launch_fcreplay()
-            return True
+    def admit(self, replay) -> bool:
+        """Check the host has the cpu, memory and disk to record the replay."""
+        admitted, reason = self.scheduler.admit(self.avi_footprint(replay))
+        if not admitted:
+            print(f"Not starting an instance: {reason}")
+        return admitted
 
-        replay = self.db.get_oldest_replay()
-        if replay is not None:
-            print("Found replay")
-            self.launch_fcreplay()
-            return True
+    def fill_capacity(self):
+        """Start an instance for each of the next pending replays, until the instance limit is reached,
+        resources run out, or there are no replays.
 
-        print("No replays")
-        return False
+        Each instance is told which replay to claim, so it records the replay it was admitted for.
+        """
+        free_slots = self.max_instances - self.number_of_instances()
+        if free_slots <= 0:
+            print(f"Maximum number of instances ({self.max_instances}) reached")
+            return
+
+        print("Looking for replays")
+        # Replays of instances that are still starting haven't been claimed yet
+        replays = self.db.get_pending_replays(free_slots, exclude=self.instance_replays.values())
+        if not replays:
+            print("No replays")
+            return
+
+        for replay in replays:
+            if not self.admit(replay):
+                break
+            print(f"Starting instance for replay {replay.id}")
+            self.launch_fcreplay(replay)
+
+    @property
+    def docker(self):
+        """Docker client shared by the tasker."""
+        if self._docker is None:
+            self._docker = docker.from_env()
+        return self._docker
+
+    @property
+    def containers(self) -> ContainerTracker:
+        """Running instances, followed from docker events once first used."""
+        if self._containers is None:
+            self._containers = ContainerTracker(self.docker, INSTANCE_PREFIX, on_exit=lambda name: self.supervisor.trigger('recorder'))
+            self._containers.start()
+        return self._containers
 
     def number_of_instances(self) -> int:
-        d_client = docker.from_env()
-        containers = d_client.containers.list()
-
-        instance_count = 0
-        for container in containers:
-            if 'fcreplay-instance-' in container.name:
-                instance_count += 1
-
-        return instance_count
-
-    def running_instance(self, instance_hostname) -> bool:
-        try:
-            d_client = docker.from_env()
-            for i in d_client.containers.list():
-                if instance_hostname in i.attrs['Config']['Hostname']:
-                    return True
-        except requests.exceptions.HTTPError:
-            print(f"Failed to find container {instance_hostname}")
-            return False
+        return self.containers.count()
 
-        return False
+    def running_instance(self, instance_name) -> bool:
+        return self.containers.is_running(instance_name)
 
     def remove_temp_dirs(self):
         """Remove temp directories for containers no longer running."""
         remove_instances = []
 
-        for docker_hostname in self.started_instances:
-            if not self.running_instance(docker_hostname):
-                print(f"Removing '/avi_storage_temp/{self.started_instances[docker_hostname]}'")
-                shutil.rmtree(f"/avi_storage_temp/{self.started_instances[docker_hostname]}")
-                remove_instances.append(docker_hostname)
+        for instance_name in self.started_instances:
+            if not self.running_instance(instance_name):
+                print(f"Removing '{AVI_STORAGE_DIR}/{self.started_instances[instance_name]}'")
+                shutil.rmtree(f"{AVI_STORAGE_DIR}/{self.started_instances[instance_name]}")
+                remove_instances.append(instance_name)
+                self.scheduler.stopped(instance_name)
 
         for i in remove_instances:
             del self.started_instances[i]
+            self.instance_replays.pop(i, None)
 
     def retry_failed_videos(self):
         """Retry failed videos."""
         print('Setting failed videos to retry')
-        failed_replays = self.db.get_all_failed_replays(limit=1000)
-
-        for r in failed_replays:
-            if r.fail_count < self.max_fails:
-                self.db.rerecord_replay(r.id)
-                print(f"Marked failed replay {r.id} to be re-encoded")
+        counts = self.db.retry_failed(self.max_fails)
+        for challenge_id in counts['ids']:
+            print(f"Marked replay {challenge_id} to be re-encoded")
+        print(f"Marked {counts['replays']} failed replays to be re-encoded")
 
     def delete_failed_videos(self):
         """Delete replays that have failed 5 times to record
         """
-        failed_replays = self.db.get_all_failed_replays(limit=1000)
-        for r in failed_replays:
-            if r.fail_count >= self.max_fails:
-                self.db.delete_replay(r.id)
-
-    def launch_fcreplay(self):
-        print("Getting docker env")
-        d_client = docker.from_env()
+        counts = self.db.purge_failed(self.max_fails)
+        for challenge_id in counts['ids']:
+            print(f"Deleted replay {challenge_id}")
+        print(f"Deleted {counts['replays']} replays that failed {self.max_fails} times")
 
+    def launch_fcreplay(self, replay):
         instance_uuid = str(uuid.uuid4().hex)
 
         if 'FCREPLAY_NETWORK' not in os.environ:
@@ -105,7 +143,7 @@ class Tasker:
         networks = os.environ['FCREPLAY_NETWORK'].split(',')
 
         print(f"Starting new instance with temp dir: '{os.environ['AVI_TEMP_DIR']}/{instance_uuid}'")
-        c_instance = d_client.containers.run(
+        c_instance = self.docker.containers.run(
             'fcreplay/image:latest',
             command='fcrecord',
             cpu_count=int(os.environ['CPUS']),
@@ -113,7 +151,8 @@ class Tasker:
             mem_limit=str(os.environ['MEMORY']),
             network=networks[0],
             remove=True,
-            name=f"fcreplay-instance-{instance_uuid}",
+            name=f"{INSTANCE_PREFIX}{instance_uuid}",
+            environment={'FCREPLAY_CHALLENGE_ID': replay.id},
             volumes={
                 str(os.environ['CLIENT_SECRETS']): {'bind': '/root/.client_secrets.json', 'mode': 'ro'},
                 str(os.environ['CONFIG']): {'bind': '/root/config.json', 'mode': 'ro'},
@@ -129,15 +168,17 @@ class Tasker:
         if len(networks) > 1:
             for n in networks[1:]:
                 print(f"Adding container to network {n}")
-                d_net = d_client.networks.get(n)
+                d_net = self.docker.networks.get(n)
                 d_net.connect(c_instance)
 
-        print("Getting instance uuid")
-        self.started_instances[c_instance.attrs['Config']['Hostname']] = instance_uuid
+        self.containers.add(c_instance.id, c_instance.name)
+        self.started_instances[c_instance.name] = instance_uuid
+        self.instance_replays[c_instance.name] = replay.id
+        self.scheduler.started(c_instance.name, f"{AVI_STORAGE_DIR}/{instance_uuid}", self.avi_footprint(replay))
+        self.launches.inc()
 
     def check_for_docker_network(self):
-        d_client = docker.from_env()
-        d_net = d_client.networks.list()
+        d_net = self.docker.networks.list()
         networks = os.environ['FCREPLAY_NETWORK'].split(',')
 
         if set(networks) <= set([i.name for i in d_net]) is False:
@@ -147,82 +188,110 @@ class Tasker:
         return True
 
     def update_video_status(self):
-        """Update the status for videos uploaded to archive.org
+        """Update the status for videos uploaded to archive.org or youtube
         """
         print("Checking status for completed videos")
 
         # Get all replays that are completed, where video_processed is false
         to_check = self.db.get_unprocessed_replays()
 
-        for replay in to_check:
-            # Check if replay has embeded video link. Easy way to do this is to check
-            # if a thumbnail is created
-            print(f"Checking: {replay.id}")
-            if replay.video_youtube_uploaded:
-                print(f"Checking url: http://img.youtube.com/vi/{replay.video_youtube_id}/0.jpg")
-                try:
-                    r = requests.get(f"http://img.youtube.com/vi/{replay.video_youtube_id}/0.jpg")
-                except Exception as e:
-                    print(f"Caught exception: {e}, when checking {replay.id}")
-                    continue
-            else:
-                print(f"Checking url: https://archive.org/download/{replay.id.replace('@', '-')}/__ia_thumb.jpg")
-                try:
-                    r = requests.get(f"https://archive.org/download/{replay.id.replace('@', '-')}/__ia_thumb.jpg")
-                except Exception as e:
-                    print(f"Caught exception: {e}, when checking {replay.id}")
-                    continue
-
-            print(f"ID: {replay.id}, Status: {r.status_code}")
-            if r.status_code == 200:
-                self.db.set_replay_processed(challenge_id=replay.id)
-
-    def recorder(self, max_instances=1):
+        # A video is processed once its thumbnail is available
+        processed = self.video_status.check_all(to_check)
+        self.db.set_replays_processed(processed)
+        print(f"{len(processed)} of {len(to_check)} videos are processed")
+
+    def collect_metrics(self) -> str:
+        """Return the tasker and replay metrics in the prometheus text format."""
+        return ''.join([
+            metrics.replay_gauges(self.db.get_replay_counts()),
+            metrics.format_metric('fcreplay_tasker_instances', 'gauge', 'Running recorder instances',
+                                  [({}, self.number_of_instances())]),
+            metrics.format_metric('fcreplay_tasker_max_instances', 'gauge', 'Maximum number of recorder instances',
+                                  [({}, self.max_instances)]),
+            self.launches.render(),
+            self.supervisor.render(),
+        ])
+
+    def add_recorder(self, max_instances=None) -> bool:
+        """Add the recorder job, which starts instances and removes their temp dirs.
+
+        It runs every 30 to 60 seconds, and straight away when an instance exits.
+        """
         if self.check_for_docker_network() is False:
             return False
 
-        schedule.every(10).to(30).seconds.do(self.remove_temp_dirs)
-        schedule.every(30).to(60).seconds.do(self.check_for_replay)
-
-        self.max_instances = max_instances
+        if max_instances is not None:
+            self.max_instances = int(max_instances)
 
         if 'MAX_INSTANCES' in os.environ:
             self.max_instances = int(os.environ['MAX_INSTANCES'])
 
-        self.check_for_replay()
+        self.supervisor.add('recorder', self.refill, 30, 60)
+        return True
+
+    def add_check_top_weekly(self) -> bool:
+        """Add the job getting the top weekly replays, if GET_WEEKLY is true."""
+        if os.environ.get('GET_WEEKLY', '').lower() != 'true':
+            return False
 
-        while True:
-            schedule.run_pending()
-            time.sleep(1)
+        self.supervisor.add('check_top_weekly', lambda: self.getreplay.get_top_weekly(), *HOURLY, start_delay=START_JITTER)
+        return True
 
-    def check_top_weekly(self):
-        if 'GET_WEEKLY' in os.environ:
-            if os.environ['GET_WEEKLY'].lower() == 'true':
-                g = Getreplay()
-                schedule.every(1).hour.do(g.get_top_weekly)
+    def add_check_video_status(self):
+        self.supervisor.add('check_video_status', self.update_video_status, *HOURLY, start_delay=START_JITTER)
+
+    def add_retry_failed_replays(self):
+        self.supervisor.add('retry_failed_replays', self.retry_failed_videos, *HOURLY, start_delay=START_JITTER)
+
+    def add_delete_failed_replays(self):
+        self.supervisor.add('delete_failed_replays', self.delete_failed_videos, *HOURLY, start_delay=START_JITTER)
+
+    @property
+    def getreplay(self) -> Getreplay:
+        if self._getreplay is None:
+            self._getreplay = Getreplay()
+        return self._getreplay
+
+    def refill(self):
+        """Remove temp dirs of exited instances, then start new ones."""
+        self.remove_temp_dirs()
+        self.fill_capacity()
 
-                g.get_top_weekly()
-                while True:
-                    schedule.run_pending()
-                    time.sleep(1)
+    def serve_metrics(self):
+        if 'METRICS_PORT' in os.environ:
+            metrics.start_exporter(int(os.environ['METRICS_PORT']), self.collect_metrics)
+
+    def start_all(self, max_instances=None):
+        """Run every tasker job in this process, sharing the database and docker clients."""
+        if not self.add_recorder(max_instances):
+            return False
+        self.add_check_top_weekly()
+        self.add_check_video_status()
+        self.add_retry_failed_replays()
+        self.add_delete_failed_replays()
+
+        self.serve_metrics()
+        self.supervisor.run_forever()
+
+    def recorder(self, max_instances=None):
+        if not self.add_recorder(max_instances):
+            return False
+
+        self.serve_metrics()
+        self.supervisor.run_forever()
+
+    def check_top_weekly(self):
+        if self.add_check_top_weekly():
+            self.supervisor.run_forever()
 
     def check_video_status(self):
-        self.update_video_status()
-        schedule.every(1).hour.do(self.update_video_status)
-        while True:
-            schedule.run_pending()
-            time.sleep(1)
+        self.add_check_video_status()
+        self.supervisor.run_forever()
 
     def schedule_retry_failed_replays(self):
-        self.retry_failed_videos()
-        schedule.every(1).hour.do(self.retry_failed_videos)
-        while True:
-            schedule.run_pending()
-            time.sleep(1)
+        self.add_retry_failed_replays()
+        self.supervisor.run_forever()
 
     def schedule_delete_failed_replays(self):
-        self.delete_failed_videos()
-        schedule.every(1).hour.do(self.delete_failed_videos)
-        while True:
-            schedule.run_pending()
-            time.sleep(1)
+        self.add_delete_failed_replays()
+        self.supervisor.run_forever()
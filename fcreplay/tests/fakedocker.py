@@ -0,0 +1,127 @@
+'''
+In memory stand-in for docker.DockerClient, covering what the tasker uses
+
+Containers started with containers.run, and stopped with container.stop, send
+start and die events to every open event stream.
+'''
+import docker
+import queue
+import threading
+import time
+import uuid
+
+_CLOSED = object()
+
+
+class FakeEventStream:
+    def __init__(self):
+        self.queue = queue.Queue()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        event = self.queue.get()
+        if event is _CLOSED:
+            raise StopIteration
+        if isinstance(event, Exception):
+            raise event
+        return event
+
+    def close(self):
+        self.queue.put(_CLOSED)
+
+
+class FakeContainer:
+    def __init__(self, client, name):
+        self.client = client
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.attrs = {'Config': {'Hostname': self.id[:12]}}
+        self.running = True
+
+    def stop(self):
+        self.running = False
+        self.client.send_event('die', self)
+
+
+class FakeContainers:
+    def __init__(self, client):
+        self.client = client
+        self.all = []
+        self.list_calls = 0
+
+    def list(self, filters=None):
+        self.list_calls += 1
+        name = (filters or {}).get('name', '')
+        return [c for c in self.all if c.running and name in c.name]
+
+    def run(self, image, name=None, **kwargs):
+        container = FakeContainer(self.client, name or uuid.uuid4().hex)
+        container.run_kwargs = kwargs
+        self.all.append(container)
+        self.client.send_event('start', container)
+        return container
+
+
+class FakeNetwork:
+    def __init__(self, name):
+        self.name = name
+        self.connected = []
+
+    def connect(self, container):
+        self.connected.append(container)
+
+
+class FakeNetworks:
+    def __init__(self, names):
+        self.networks = {n: FakeNetwork(n) for n in names}
+
+    def list(self):
+        return list(self.networks.values())
+
+    def get(self, name):
+        if name not in self.networks:
+            raise docker.errors.NotFound(f"network {name} not found")
+        return self.networks[name]
+
+
+class FakeDockerClient:
+    def __init__(self, networks=('bridge',)):
+        self.containers = FakeContainers(self)
+        self.networks = FakeNetworks(networks)
+        self.streams = []
+        self.lock = threading.Lock()
+
+    def events(self, decode=False, filters=None):
+        stream = FakeEventStream()
+        with self.lock:
+            self.streams.append(stream)
+        return stream
+
+    def send_event(self, action, container):
+        event = {
+            'Type': 'container',
+            'Action': action,
+            'id': container.id,
+            'Actor': {'ID': container.id, 'Attributes': {'name': container.name}}
+        }
+        with self.lock:
+            for stream in self.streams:
+                stream.queue.put(event)
+
+    def break_streams(self, error=None):
+        '''Make every open event stream raise error, by default like a restarted docker daemon'''
+        with self.lock:
+            for stream in self.streams:
+                stream.queue.put(error or docker.errors.APIError('event stream closed'))
+            self.streams = []
+
+
+def wait_for(condition, timeout=5):
+    '''Wait for condition() to be true, for changes made by the event thread'''
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError('Timed out waiting for condition')
+        time.sleep(0.01)
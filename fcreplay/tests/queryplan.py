@@ -0,0 +1,46 @@
+from contextlib import contextmanager
+from sqlalchemy import event
+
+
+@contextmanager
+def capture_statements(engine):
+    '''
+    Collects every (statement, parameters) executed on the engine
+    '''
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def sequential_scans(engine, statement, parameters):
+    '''
+    Returns the lines of the query plan that read a whole table
+
+    sqlite reports a full table scan as 'SCAN <table>' with no index, postgres
+    as 'Seq Scan'. Sequential scans are disabled on postgres so it only uses
+    one when no index can answer the query. Statements run with executemany
+    are explained with their first parameters.
+    '''
+    if isinstance(parameters, (list, tuple)) and parameters and isinstance(parameters[0], (list, tuple, dict)):
+        parameters = parameters[0]
+    with engine.connect() as connection:
+        cursor = connection.connection.cursor()
+        if engine.dialect.name == 'sqlite':
+            cursor.execute(f"EXPLAIN QUERY PLAN {statement}", parameters)
+            plan = [row[-1] for row in cursor.fetchall()]
+            scans = [line for line in plan if line.startswith('SCAN') and 'INDEX' not in line]
+        else:
+            cursor.execute('SET enable_seqscan = off')
+            cursor.execute(f"EXPLAIN {statement}", parameters)
+            plan = [row[0] for row in cursor.fetchall()]
+            scans = [line for line in plan if 'Seq Scan' in line]
+        cursor.close()
+
+    return scans
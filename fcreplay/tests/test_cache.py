@@ -0,0 +1,110 @@
+import os
+os.environ['FCREPLAY_CONFIG'] = './fcreplay/tests/common/config_test_site.json'
+
+from fcreplay.site.cache import FileSystemBackend, MemoryBackend, cache
+from fcreplay.site.create_app import create_app, db
+from fcreplay.site.models import Cache_generation
+from fcreplay.site.site_config import TestConfig
+from unittest.mock import patch
+import pytest
+
+
+class CacheConfig(TestConfig):
+    CACHE_TYPE = 'memory'
+    CACHE_GENERATION_INTERVAL = 0
+
+
+@pytest.fixture
+def app():
+    app = create_app(CacheConfig)
+
+    with app.app_context():
+        db.create_all()
+        yield app.test_client()
+
+
+def test_memory_backend():
+    backend = MemoryBackend(size=2)
+    backend.set('a', 1, ttl=60)
+    backend.set('b', 2, ttl=60)
+    assert backend.get('a') == 1
+
+    backend.set('c', 3, ttl=60)
+    assert backend.get('b') is None, 'Least recently used entry should be evicted'
+    assert backend.get('a') == 1
+
+    with patch('fcreplay.site.cache.time.time', return_value=2 ** 40):
+        assert backend.get('a') is None, 'Expired entries should not be returned'
+
+
+def test_filesystem_backend(tmp_path):
+    backend = FileSystemBackend(str(tmp_path), size=10)
+    backend.set('a', {'value': 1}, ttl=60)
+    assert FileSystemBackend(str(tmp_path), size=10).get('a') == {'value': 1}, 'Entries should be shared between instances'
+    assert len(backend) == 1
+
+    with patch('fcreplay.site.cache.time.time', return_value=2 ** 40):
+        assert backend.get('a') is None, 'Expired entries should not be returned'
+    assert len(backend) == 0, 'Expired entries should be removed when read'
+
+    (tmp_path / 'writing.tmp').write_bytes(b'')
+    backend.clear()
+    assert backend.get('a') is None
+    assert (tmp_path / 'writing.tmp').exists(), 'Entries being written should not be cleared'
+
+    with patch('fcreplay.site.cache.os.replace', side_effect=FileNotFoundError):
+        backend.set('b', {'value': 2}, ttl=60)
+    assert backend.get('b') is None, 'A failed write should be a cache miss'
+    assert sorted(os.listdir(tmp_path)) == ['writing.tmp'], 'The temporary file should be removed'
+
+
+def test_filesystem_backend_size(tmp_path):
+    backend = FileSystemBackend(str(tmp_path), size=3)
+    backend.set('expired', 0, ttl=-1)
+    backend.set('short', 1, ttl=10)
+    backend.set('long', 2, ttl=60)
+    assert len(backend) == 3
+
+    backend.set('new', 3, ttl=60)
+    assert len(backend) == 3
+    assert backend.get('expired') is None, 'Expired entries should be removed first'
+    assert backend.get('short') == 1
+
+    backend.set('newer', 4, ttl=60)
+    assert len(backend) == 3
+    assert backend.get('short') is None, 'The entry closest to expiring should be removed'
+    assert [backend.get(key) for key in ['long', 'new', 'newer']] == [2, 3, 4]
+
+
+def test_get_or_set_none(app):
+    calls = []
+    for _ in range(2):
+        assert cache.get_or_set('none', 60, lambda: calls.append(1)) is None
+    assert len(calls) == 1, 'A cached None should be a hit'
+
+
+def test_cached_view(app):
+    first = app.get('/api/supportedgames')
+    second = app.get('/api/supportedgames')
+    assert second.data == first.data
+    assert second.headers['Content-Type'] == first.headers['Content-Type']
+
+    stats = app.get('/api/cachestats').json
+    assert stats['hits'] == 1
+    assert stats['misses'] == 1
+    assert stats['entries'] == 1
+
+    for i in range(3):
+        assert app.get(f'/api/supportedgames?x={i}').data == first.data
+    assert app.get('/api/cachestats').json['entries'] == 1, 'Query arguments the view ignores should not make new entries'
+
+
+def test_generation_invalidates(app):
+    app.get('/about')
+    db.session.add(Cache_generation(id='site', generation=1))
+    db.session.commit()
+    app.get('/about')
+
+    stats = app.get('/api/cachestats').json
+    assert stats['hits'] == 0, 'A new generation should clear the cache'
+    assert stats['generation'] == 1
@@ -0,0 +1,70 @@
+from fcreplay.containers import ContainerTracker
+from fcreplay.tests.fakedocker import FakeDockerClient, wait_for
+
+
+class TestContainerTracker:
+    def test_events(self):
+        client = FakeDockerClient()
+        client.containers.run('fcreplay/image:latest', name='fcreplay-instance-0')
+        client.containers.run('postgres', name='postgres')
+
+        exited = []
+        tracker = ContainerTracker(client, 'fcreplay-instance-', on_exit=exited.append)
+        tracker.start()
+        try:
+            assert tracker.count() == 1, 'Running instances should be listed on start'
+
+            container = client.containers.run('fcreplay/image:latest', name='fcreplay-instance-1')
+            wait_for(lambda: tracker.count() == 2)
+            assert tracker.is_running('fcreplay-instance-1')
+
+            container.stop()
+            wait_for(lambda: exited == ['fcreplay-instance-1'])
+            assert tracker.count() == 1
+            assert not tracker.is_running('fcreplay-instance-1')
+
+            tracker.add(container.id, container.name)
+            assert tracker.count() == 1, 'A container that already died should not be added'
+
+            assert client.containers.list_calls == 1, 'Containers should only be listed once'
+        finally:
+            tracker.stop()
+
+    def test_reconnect(self, monkeypatch):
+        monkeypatch.setattr('fcreplay.containers.RECONNECT_DELAY', 0.01)
+        client = FakeDockerClient()
+        tracker = ContainerTracker(client, 'fcreplay-instance-')
+        tracker.start()
+        try:
+            client.break_streams()
+            # Started while the event stream was down
+            client.containers.run('fcreplay/image:latest', name='fcreplay-instance-0')
+            wait_for(lambda: tracker.count() == 1)
+        finally:
+            tracker.stop()
+
+    def test_unexpected_errors(self, monkeypatch):
+        monkeypatch.setattr('fcreplay.containers.RECONNECT_DELAY', 0.01)
+        client = FakeDockerClient()
+
+        def on_exit(name):
+            raise RuntimeError('callback failed')
+
+        tracker = ContainerTracker(client, 'fcreplay-instance-', on_exit=on_exit)
+        tracker.start()
+        try:
+            container = client.containers.run('fcreplay/image:latest', name='fcreplay-instance-0')
+            wait_for(lambda: tracker.count() == 1)
+            container.stop()
+            wait_for(lambda: tracker.count() == 0)
+
+            # A failing exit callback should not stop the tracker
+            client.containers.run('fcreplay/image:latest', name='fcreplay-instance-1')
+            wait_for(lambda: tracker.count() == 1)
+
+            client.break_streams(ValueError('Expecting value: line 1 column 1'))
+            client.containers.run('fcreplay/image:latest', name='fcreplay-instance-2')
+            wait_for(lambda: tracker.count() == 2)
+            assert client.containers.list_calls == 2, 'Containers should be listed again after an error'
+        finally:
+            tracker.stop()
@@ -148,3 +148,21 @@ class TestInstance:
 
             assert mock_replay.add_job.called
             assert e.type == SystemExit, "Should exit with no errors"
+
+    @patch('fcreplay.instance.Config')
+    @patch('fcreplay.instance.Replay')
+    def test_finished_replay_not_failed(self, mock_replay, mock_config):
+        temp_dir = tempfile.TemporaryDirectory()
+        mock_replay.return_value.write_metrics.side_effect = OSError('Read-only file system')
+
+        instance = Instance()
+        instance.config.upload_to_ia = False
+        instance.config.upload_to_yt = False
+        instance.config.fcreplay_dir = temp_dir.name
+        instance.config.fcadefbneo_path = temp_dir.name
+
+        with pytest.raises(OSError):
+            instance.main()
+
+        assert mock_replay.return_value.set_created.called
+        assert not mock_replay.return_value.handle_fail.called, 'A finished replay should never be failed'
@@ -0,0 +1,43 @@
+from fcreplay import metrics
+import urllib.error
+import urllib.request
+import pytest
+
+
+class TestMetrics:
+    def test_histogram(self):
+        histogram = metrics.Histogram('request_seconds', 'Latency', buckets=(0.1, 1))
+        histogram.observe(0.05, route='/')
+        histogram.observe(0.5, route='/')
+        histogram.observe(5, route='/')
+
+        lines = histogram.render().splitlines()
+        assert '# TYPE request_seconds histogram' in lines
+        assert 'request_seconds_bucket{route="/",le="0.1"} 1' in lines
+        assert 'request_seconds_bucket{route="/",le="1"} 2' in lines, 'Buckets should be cumulative'
+        assert 'request_seconds_bucket{route="/",le="+Inf"} 3' in lines
+        assert 'request_seconds_sum{route="/"} 5.55' in lines
+        assert 'request_seconds_count{route="/"} 3' in lines
+
+    def test_replay_gauges(self):
+        counts = metrics.ReplayCounts(queued={'ADDED': 2}, failed={'FAILED': 1}, finished_per_hour=3, running=1)
+        lines = metrics.replay_gauges(counts).splitlines()
+
+        assert 'fcreplay_queue_depth{status="ADDED"} 2' in lines
+        assert 'fcreplay_failed_replays{status="FAILED"} 1' in lines
+        assert 'fcreplay_replays_finished_per_hour 3' in lines
+        assert 'fcreplay_running_instances 1' in lines
+
+    def test_exporter(self):
+        server = metrics.start_exporter(0, lambda: 'up 1\n', host='127.0.0.1')
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+        try:
+            with urllib.request.urlopen(f"{url}/metrics", timeout=5) as response:
+                assert response.headers['Content-Type'] == metrics.CONTENT_TYPE
+                assert response.read() == b'up 1\n'
+
+            with pytest.raises(urllib.error.HTTPError):
+                urllib.request.urlopen(f"{url}/other", timeout=5)
+        finally:
+            server.shutdown()
+            server.server_close()
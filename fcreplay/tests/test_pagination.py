@@ -0,0 +1,127 @@
+import os
+os.environ['FCREPLAY_CONFIG'] = './fcreplay/tests/common/config_test_site.json'
+
+from fcreplay.site import queries
+from fcreplay.site.create_app import create_app, db
+from fcreplay.site.models import Cache_generation, Replays
+from fcreplay.site.pagination import paginate
+from fcreplay.site.site_config import TestConfig
+from fcreplay.tests.queryplan import capture_statements
+from werkzeug.exceptions import BadRequest, NotFound
+import datetime
+import pytest
+
+
+class PaginationConfig(TestConfig):
+    CACHE_TYPE = 'memory'
+    CACHE_GENERATION_INTERVAL = 0
+
+
+@pytest.fixture
+def app():
+    app = create_app(PaginationConfig)
+
+    with app.app_context():
+        db.create_all()
+        for i in range(30):
+            db.session.add(Replays(
+                id=f"replay-{i:02}",
+                created=True,
+                failed=False,
+                video_processed=True,
+                date_added=datetime.datetime(2022, 1, 1) + datetime.timedelta(minutes=i // 2),
+                length=100,
+                game='sfiii3nr1',
+                p1='alice', p2='bob', p1_loc='NZ', p2_loc='AU', p1_rank='1', p2_rank='2',
+                date_replay=datetime.datetime(2022, 1, 1)
+            ))
+        db.session.commit()
+        yield app
+
+
+def search(order_by='date_added'):
+    return queries.advanced_search('Any', 'any', 'any', '', order_by)
+
+
+def page_ids(page, order_by='date_added', **cursor):
+    return [r.id for r in paginate(search(order_by), queries.order_column(order_by), page, **cursor).items]
+
+
+@pytest.mark.parametrize('order_by', ['date_added', 'length'])
+def test_matches_offset(app, order_by):
+    expected = [[r.id for r in search(order_by).offset((page - 1) * 9).limit(9)] for page in range(1, 5)]
+
+    for page in range(1, 5):
+        assert page_ids(page, order_by) == expected[page - 1], f"Page {page} should match OFFSET pagination"
+
+
+@pytest.mark.parametrize('order_by', ['date_added', 'length'])
+def test_cursors(app, order_by):
+    expected = [[r.id for r in search(order_by).offset((page - 1) * 9).limit(9)] for page in range(1, 5)]
+
+    # Page forwards with the next links, then back with the previous links
+    pagination = paginate(search(order_by), queries.order_column(order_by), 1)
+    for page in range(2, 5):
+        assert 'after' in pagination.next_cursor
+        pagination = paginate(search(order_by), queries.order_column(order_by), page, **pagination.next_cursor)
+        assert [r.id for r in pagination.items] == expected[page - 1], f"Page {page} should start after the cursor"
+
+    for page in [3, 2]:
+        pagination = paginate(search(order_by), queries.order_column(order_by), page, **pagination.prev_cursor)
+        assert [r.id for r in pagination.items] == expected[page - 1], f"Page {page} should end before the cursor"
+    assert pagination.prev_cursor == {}, 'The first page should be linked without a cursor'
+
+
+def test_cursor_skips_offset(app):
+    page_ids(1)
+    with capture_statements(db.engine) as statements:
+        assert page_ids(3, after='2022-01-01T00:08:00,replay-17') == [f"replay-{i:02}" for i in range(16, 7, -1)]
+
+    replay_statements = [(s, p) for s, p in statements if 'FROM replays' in s]
+    assert len(replay_statements) == 1, 'The count should be cached'
+    statement, parameters = replay_statements[0]
+    assert '(replays.date_added, replays.id) <' in statement
+    assert parameters[-1] == 0, 'A page with a cursor should not use OFFSET'
+
+
+def test_bad_cursor(app):
+    for cursor in ['x', 'yesterday,replay-1']:
+        with pytest.raises(BadRequest):
+            page_ids(2, after=cursor)
+
+
+def test_cached_count(app):
+    pagination = paginate(queries.all_replays(), queries.order_column('date_added'), 1)
+    assert pagination.total == 30
+    assert pagination.pages == 4
+
+    db.session.add(Replays(id='replay-new', created=True, failed=False, video_processed=True,
+                           date_added=datetime.datetime(2023, 1, 1), length=100))
+    db.session.commit()
+
+    pagination = paginate(queries.all_replays(), queries.order_column('date_added'), 1)
+    assert pagination.total == 30, 'Count should be cached'
+    assert pagination.items[0].id == 'replay-new', 'Items should not be cached'
+
+    db.session.add(Cache_generation(id='site', generation=1))
+    db.session.commit()
+    pagination = paginate(queries.all_replays(), queries.order_column('date_added'), 1)
+    assert pagination.total == 31, 'Count should be dropped with the cache generation'
+
+
+def test_links(app):
+    rv = app.test_client().get('/?page=2')
+    assert b'page=3&amp;after=2022-01-01T00%3A06%3A00%2Creplay-12' in rv.data, 'The next link should carry a cursor'
+    assert b'before=' not in rv.data, 'The link to the first page should not carry a cursor'
+
+    rv = app.test_client().get('/?page=3&after=2022-01-01T00%3A06%3A00%2Creplay-12')
+    assert b'page=2&amp;before=2022-01-01T00%3A05%3A00%2Creplay-11' in rv.data, 'The previous link should carry a cursor'
+    assert b'href="/?page=1"' in rv.data, 'Numbered links should not carry a cursor'
+
+
+def test_missing_page(app):
+    with pytest.raises(NotFound):
+        page_ids(0)
+
+    with pytest.raises(NotFound):
+        page_ids(5)
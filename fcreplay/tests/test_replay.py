@@ -23,6 +23,22 @@ class TestReplay:
 
         assert isinstance(desired_resolution, list), "Returned value is not a list"
 
+    @patch('fcreplay.replay.CharacterDetection')
+    @patch('fcreplay.replay.Database')
+    @patch('fcreplay.replay.Config')
+    def test_get_characters(self, mock_config, mock_database, mock_character_detection):
+        timeline = [['C1', 'C2', '0:00:05', 5], ['C3', 'C2', '0:01:00', 60]]
+        mock_character_detection.return_value.get_characters.return_value = timeline
+
+        r = Replay()
+        r.get_characters()
+
+        r.db.add_detected_characters_bulk.assert_called_once_with(
+            challenge_id=r.replay.id,
+            game=r.replay.game,
+            timeline=timeline
+        ), 'Timeline should be added in one call'
+
     @patch('fcreplay.replay.Database')
     @patch('fcreplay.replay.Config')
     def test_description_and_tags_no_chars_no_append(self, mock_config, mock_database):
@@ -174,3 +190,29 @@ class TestReplay:
 
         sorted_list = r.sort_files(single_list)
         assert sorted_list == good_list, 'List with single file should be sorted'
+
+    @patch('fcreplay.replay.CharacterDetection')
+    @patch('fcreplay.replay.Database')
+    @patch('fcreplay.replay.Config')
+    def test_write_metrics(self, mock_config, mock_database, mock_character_detection, tmp_path):
+        mock_config.return_value.metrics_textfile = str(tmp_path / 'fcreplay.prom')
+        mock_character_detection.return_value.get_characters.return_value = []
+
+        r = Replay()
+        r.replay.game = 'sfiii3nr1'
+        r.get_characters()
+        r.write_metrics()
+        r.db.add_stage_timing.assert_not_called()
+
+        r.update_status('ENCODED')
+        timing = r.db.add_stage_timing.call_args.kwargs
+        assert timing['stage'] == 'characters', 'Stages should be recorded'
+        assert timing['duration'] >= 0 and timing['peak_rss'] > 0
+        assert r.unrecorded_spans == [], 'Stages should be recorded with the next status change'
+
+        metrics = (tmp_path / 'fcreplay.prom').read_text()
+        assert 'fcreplay_stage_duration_seconds{game="sfiii3nr1",stage="characters"}' in metrics
+
+        # A metrics file that can't be written is only logged
+        mock_config.return_value.metrics_textfile = str(tmp_path / 'missing' / 'fcreplay.prom')
+        r.write_metrics()
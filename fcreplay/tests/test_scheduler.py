@@ -0,0 +1,59 @@
+from fcreplay.scheduler import DISK_MARGIN, MEMORY_MARGIN, RecorderScheduler, Resources, avi_footprint, parse_size
+
+
+class TestScheduler:
+    def scheduler(self, resources, clock):
+        return RecorderScheduler(
+            avi_dir='/avi',
+            cpus_per_instance=2,
+            memory_per_instance=parse_size('1g'),
+            measure=lambda path: resources,
+            clock=lambda: clock[0]
+        )
+
+    def test_parse_size(self):
+        assert parse_size('4g') == 4 * 2 ** 30
+        assert parse_size('512m') == 512 * 2 ** 20
+        assert parse_size(1024) == 1024
+
+    def test_avi_footprint(self):
+        assert avi_footprint(120, [4, 3]) == avi_footprint(120, [3, 4]), 'Vertical games have the same frame size'
+        assert avi_footprint(240, [4, 3]) == 2 * avi_footprint(120, [4, 3])
+
+    def test_admit(self, tmp_path):
+        clock = [0]
+        footprint = 2 ** 30
+        resources = Resources(cpus=8, load=1.0, memory_available=16 * 2 ** 30, disk_free=footprint * 2 + DISK_MARGIN)
+        scheduler = self.scheduler(resources, clock)
+
+        assert scheduler.admit(footprint)[0]
+        scheduler.started('instance-0', str(tmp_path / 'instance-0'), footprint)
+        assert scheduler.admit(footprint)[0]
+        scheduler.started('instance-1', str(tmp_path / 'instance-1'), footprint)
+
+        admitted, reason = scheduler.admit(footprint)
+        assert not admitted and 'disk' in reason, 'Disk for running instances should be reserved'
+
+        # Files already written are in the free space
+        (tmp_path / 'instance-0').mkdir()
+        (tmp_path / 'instance-0' / 'replay.avi').write_bytes(b'0' * 1024)
+        assert scheduler.reserved_disk() == 2 * footprint - 1024
+
+        scheduler.stopped('instance-0')
+        assert scheduler.reserved_disk() == footprint
+
+    def test_admit_cpu_and_memory(self):
+        clock = [0]
+        resources = Resources(cpus=4, load=1.0, memory_available=4 * 2 ** 30, disk_free=2 ** 40)
+        scheduler = self.scheduler(resources, clock)
+
+        scheduler.started('instance-0', '/avi/instance-0', 0)
+        admitted, reason = scheduler.admit(0)
+        assert not admitted and 'load' in reason, 'Instances starting up should count towards the load'
+
+        clock[0] = 120
+        assert scheduler.admit(0)[0], 'Started instances are in the load average after a minute'
+
+        low_memory = self.scheduler(resources._replace(memory_available=2 ** 30 + MEMORY_MARGIN - 1), clock)
+        admitted, reason = low_memory.admit(0)
+        assert not admitted and 'memory' in reason
@@ -0,0 +1,16 @@
+from fcreplay import search
+from fcreplay.models import Search_trigram, Search_trigram_count
+
+
+def test_trigrams():
+    assert search.trigrams('Ryu vs') == {'ryu', 'yu ', 'u v', ' vs'}
+    assert search.trigrams('ab') == set(), 'Text shorter than a trigram has no trigrams'
+    assert search.trigrams(None) == set()
+
+
+def test_trigram_candidates():
+    index = search.TrigramIndex(Search_trigram.__table__, Search_trigram_count.__table__)
+
+    assert search.trigram_candidates(index, 'player', 'ab') is None, 'Short queries should not use the index'
+    assert search.trigram_candidates(index, 'player', 'a%bcd') is None, 'Wildcards should not use the index'
+    assert search.trigram_candidates(index, 'player', 'abcd') is not None
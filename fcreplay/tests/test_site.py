@@ -1,15 +1,38 @@
 import os
 os.environ['FCREPLAY_CONFIG'] = './fcreplay/tests/common/config_test_site.json'
 
+from fcreplay import notify, search
+from fcreplay.models import Base
+from fcreplay.site import blueprint, queries
 from fcreplay.site.create_app import create_app, db
+from fcreplay.site.models import Character_detect, Descriptions, Game_count, Players, Replays, Search_trigram, Search_trigram_count
 from fcreplay.site.site_config import TestConfig
+from fcreplay.tests.queryplan import capture_statements, sequential_scans
+import datetime
+import json
+import threading
+import time
 import xml.etree.ElementTree as ET
 import pytest
 
+
+def index_text(source, key, text):
+    """Add text to the search_trigram tables, like Database does."""
+    for row in search.trigram_rows(source, key, text):
+        db.session.add(Search_trigram(**row))
+        count = Search_trigram_count.query.get((row['trigram'], row['source']))
+        if count is None:
+            db.session.add(Search_trigram_count(trigram=row['trigram'], source=row['source'], count=1))
+        else:
+            count.count += 1
+        db.session.flush()
+
+
 class TestSite:
     @pytest.fixture
-    def app(self):
+    def app(self, tmp_path):
         app = create_app(TestConfig)
+        app.config['SITEMAP_DIR'] = str(tmp_path / 'sitemap')
 
         # Create Tables
         db.app = app
@@ -17,6 +40,38 @@ class TestSite:
 
         yield app.test_client()
 
+        db.session.remove()
+        db.drop_all()
+
+    @pytest.fixture
+    def schema_app(self):
+        """App using the schema and indexes that Database.migrate creates."""
+        app = create_app(TestConfig)
+
+        with app.app_context():
+            Base.metadata.create_all(db.engine)
+            yield app
+
+    @pytest.mark.parametrize('query', [
+        lambda: queries.all_replays().limit(9).all(),
+        lambda: queries.video_detail('replay-0'),
+        lambda: queries.video_details(['replay-0', 'replay-1']),
+        lambda: queries.player_search('player').limit(9).all(),
+        lambda: queries.pending_count(),
+        lambda: queries.basic_search('sfiii3nr1', 'ryu vs', 'date_added').limit(9).all(),
+        lambda: queries.playerlist_search('player'),
+        lambda: queries.advanced_search('sfiii3nr1', 'any', 'any', '', 'date_added').limit(9).all(),
+        lambda: queries.advanced_search('sfiii3nr1', 'any', 'any', '', 'date_added', char1='Ken', char2='Ryu').limit(9).all(),
+        lambda: queries.advanced_search('any', 'any', 'any', '', 'date_added', char1='Ken', char2='Ryu').limit(9).all(),
+        lambda: queries.advanced_search('any', 'any', 'any', '', 'date_added', char1='Ken').limit(9).all(),
+    ])
+    def test_query_uses_index(self, schema_app, query):
+        with capture_statements(db.engine) as statements:
+            query()
+
+        for statement, parameters in statements:
+            assert sequential_scans(db.engine, statement, parameters) == [], f"Query should use an index: {statement}"
+
     def test_site_root(self, app):
         rv = app.get('/')
 
@@ -34,12 +89,165 @@ class TestSite:
         assert rv.status_code == 200
         assert rv.is_json
 
+    def test_api_video(self, app):
+        for i in range(2):
+            db.session.add(Replays(id=f'video-{i}', p1='alice', p2='bob', p1_loc='NZ', p2_loc='AU', p1_rank='1', p2_rank='2',
+                                   game='sfiii3nr1', length=120, created=True,
+                                   failed=False, video_processed=True, video_youtube_uploaded=False))
+            db.session.add(Descriptions(id=f'video-{i}', description=f'Description {i}'))
+            db.session.add(Character_detect(id=i * 2, challenge_id=f'video-{i}', p1_char='Ken', p2_char='Ryu',
+                                            vid_time='0:01:05', vid_seconds=65))
+            db.session.add(Character_detect(id=i * 2 + 1, challenge_id=f'video-{i}', p1_char='Yun', p2_char='Ryu',
+                                            vid_time='0:00:03', vid_seconds=3))
+        db.session.commit()
+
+        with capture_statements(db.engine) as statements:
+            rv = app.get('/api/video/video-0')
+        assert len(statements) == 1, 'Replay, description and characters should be loaded in one query'
+
+        assert rv.status_code == 200
+        assert rv.json['description'] == 'Description 0'
+        assert [c['seek_time'] for c in rv.json['characters']] == [3, 65], 'Characters should be in video order'
+
+        rv = app.post('/api/video', json={'ids': ['video-0', 'video-1', 'missing']})
+        assert sorted(rv.json) == ['video-0', 'video-1']
+        assert rv.json['video-1']['video_url'] == 'https://archive.org/details/video-1'
+
+        assert app.get('/api/video/missing').status_code == 404
+        assert app.post('/api/video', json={}).status_code == 404
+        assert app.post('/api/video', json={'ids': ['x'] * 101}).status_code == 400
+
+        rv = app.get('/video/video-0')
+        assert rv.status_code == 200
+        assert b'?seek=65' in rv.data
+        assert app.get('/video/missing').status_code == 404
+
+    def test_status_wait(self, app, monkeypatch):
+        monkeypatch.setattr('fcreplay.site.blueprint.STATUS_WAIT_TIMEOUT', 0.2)
+        for i in range(2):
+            db.session.add(Replays(id=f'status-{i}', status='ADDED', player_requested=True, created=False,
+                                   failed=False, date_added=datetime.datetime(2022, 1, 1, 0, i)))
+        db.session.commit()
+
+        rv = app.get('/api/status/status-0')
+        assert rv.json['queue_position'] == 2, 'Newer player replays are claimed first'
+        assert app.get('/api/status/missing').status_code == 404
+        assert app.get('/api/status/missing/wait').status_code == 404
+
+        assert app.get('/api/status/status-0/wait').json['queue_position'] == 2, 'A changed status should return at once'
+
+        start = time.monotonic()
+        rv = app.get('/api/status/status-0/wait?status=ADDED&queue_position=2')
+        assert rv.json['queue_position'] == 2
+        assert 0.2 <= time.monotonic() - start < 2, 'An unchanged status should return after the timeout'
+
+        # Another replay being claimed moves this one up the queue
+        monkeypatch.setattr('fcreplay.site.blueprint.STATUS_WAIT_TIMEOUT', 5)
+
+        def claim():
+            Replays.query.get('status-1').created = True
+            notify.publish(db.session, 'status-1', 'CLAIMED')
+            db.session.commit()
+            db.session.remove()
+
+        timer = threading.Timer(0.2, claim)
+        timer.start()
+        start = time.monotonic()
+        rv = app.get('/api/status/status-0/wait?status=ADDED&queue_position=2')
+        timer.join()
+        assert rv.json['queue_position'] == 1
+        assert time.monotonic() - start < 4, 'A change should end the wait'
+
+        Replays.query.get('status-0').status = 'FINISHED'
+        db.session.commit()
+        assert app.get('/api/status/status-0/wait?status=FINISHED').json['status'] == 'FINISHED', \
+            'Final statuses should not wait'
+
+        waiters = app.application.extensions['status_waiters']
+        held = 0
+        while waiters.acquire(blocking=False):
+            held += 1
+        assert held == app.application.config['STATUS_MAX_WAITERS'] == app.application.config['THREADS'] // 2
+        rv = app.get('/api/status/status-1/wait')
+        for _ in range(held):
+            waiters.release()
+        assert rv.status_code == 503, 'Waiting requests should be limited'
+        assert rv.headers['Retry-After'] == str(blueprint.STATUS_RETRY_AFTER)
+
+    def test_status_page(self, app, monkeypatch):
+        def no_database(*args, **kwargs):
+            raise AssertionError('The site should use its own session')
+
+        monkeypatch.setattr('fcreplay.database.Database.__init__', no_database)
+        # Without any stage history, recording takes the replay length and the other stages no time
+        db.session.add(Replays(id='status-0', status='ADDED', player_requested=True, created=False, failed=False,
+                               game='sfiii3nr1', length=3900, date_added=datetime.datetime(2022, 1, 1)))
+        db.session.commit()
+
+        rv = app.get('/status/status-0')
+        assert rv.status_code == 200
+        assert b'1h 5m' in rv.data
+        assert b'/api/status/status-0/wait' in rv.data
+        assert app.get('/status/missing').status_code == 404
+
+    def test_metrics(self, app):
+        db.session.add(Replays(id='queued-0', status='ADDED', created=False, failed=False))
+        db.session.add(Replays(id='failed-0', status='FAILED', created=False, failed=True))
+        db.session.add(Replays(id='finished-0', status='FINISHED', created=True, failed=False,
+                               date_finished=datetime.datetime.utcnow()))
+        db.session.commit()
+
+        app.get('/about')
+        rv = app.get('/metrics')
+        assert rv.status_code == 200
+        assert rv.content_type.startswith('text/plain; version=0.0.4')
+
+        lines = rv.data.decode().splitlines()
+        assert 'fcreplay_queue_depth{status="ADDED"} 1' in lines
+        assert 'fcreplay_failed_replays{status="FAILED"} 1' in lines
+        assert 'fcreplay_replays_finished_per_hour 1' in lines
+        assert 'fcreplay_running_instances 0' in lines
+        assert any(line.startswith('fcreplay_site_request_seconds_count{method="GET",route="/about",status="200"}') for line in lines)
+
     def test_api_supportedgames(self, app):
         rv = app.get('/api/supportedgames')
 
         assert rv.status_code == 200
         assert rv.is_json
 
+    def test_api_playerlist(self, app):
+        db.session.add_all([Players(name=f'player-{i}') for i in range(3)])
+        db.session.commit()
+
+        rv = app.get('/api/playerlist?limit=2')
+        assert rv.status_code == 200
+        assert rv.json == ['player-0', 'player-1']
+        assert 'rel="next"' in rv.headers['Link'], 'A full page should link to the next page'
+
+        rv = app.get('/api/playerlist?limit=2&after=player-1')
+        assert rv.json == ['player-2']
+        assert 'Link' not in rv.headers, 'The last page should not link to a next page'
+
+        rv = app.get('/api/playerlist')
+        etag = rv.headers['ETag']
+        rv = app.get('/api/playerlist', headers={'If-None-Match': etag})
+        assert rv.status_code == 304, 'An unchanged player list should not be sent again'
+
+    def test_trigram_search(self, app):
+        descriptions = {'replay-0': 'Ryu vs Ryu', 'replay-1': 'Ken vs Ryu vs Ken'}
+        for challenge_id, description in descriptions.items():
+            db.session.add(Replays(id=challenge_id, created=True, failed=False, video_processed=True, game='sfiii3nr1'))
+            db.session.add(Descriptions(id=challenge_id, description=description))
+            index_text('description', challenge_id, description)
+        db.session.commit()
+
+        # 'replay-1' contains every trigram of 'ryu vs ryu', but not the text
+        results = queries.basic_search('sfiii3nr1', 'ryu vs ryu', 'date_added').all()
+        assert [r.id for r in results] == ['replay-0']
+
+        results = queries.basic_search('sfiii3nr1', 'vs', 'date_added').all()
+        assert len(results) == 2, 'Short queries should still match'
+
     def test_submit(self, app):
         pass
 
@@ -54,15 +262,83 @@ class TestSite:
 
         assert rv.status_code == 200
 
+    def test_about_game_counts(self, app):
+        db.session.add(Game_count(id='sfiii3nr1', count=1234))
+        db.session.commit()
+
+        rv = app.get('/about')
+
+        assert rv.status_code == 200
+        assert b'1234' in rv.data, 'About page should show the per game count'
+
     def test_advancedSearch(self, app):
         pass
 
     def test_advancedSearchResult(self, app):
-        pass
+        rv = app.get('/advancedSearchResult?game=Any&p1_rank=any&p2_rank=any&char1=Any&char2=Any&search=')
+
+        assert rv.status_code == 200
+
+    def test_advanced_search(self, app):
+        replays = [
+            ('replay-0', 'alice', '1', 'Ryu', 'bob', '2', 'Ken'),
+            ('replay-1', 'bob', '2', 'Ken', 'carol', '1', 'Ryu'),
+            ('replay-2', 'carol', '3', 'Ryu', 'alice', '3', 'Ryu'),
+        ]
+        for i, (challenge_id, p1, p1_rank, p1_char, p2, p2_rank, p2_char) in enumerate(replays):
+            db.session.add(Replays(id=challenge_id, p1=p1, p1_rank=p1_rank, p2=p2, p2_rank=p2_rank, game='sfiii3nr1',
+                                   created=True, failed=False, video_processed=True, length=i))
+            db.session.add(Character_detect(id=i, challenge_id=challenge_id, p1_char=p1_char, p2_char=p2_char, game='sfiii3nr1'))
+        for player in ('alice', 'bob', 'carol'):
+            index_text('player', player, player)
+        db.session.commit()
+
+        def ids(**kwargs):
+            arguments = {'game_id': 'sfiii3nr1', 'p1_rank': 'any', 'p2_rank': 'any', 'search_query': '', 'order_by': 'length'}
+            return [r.id for r in queries.advanced_search(**{**arguments, **kwargs})]
+
+        assert ids() == ['replay-2', 'replay-1', 'replay-0'], 'Empty filters should match every replay'
+        assert ids(game_id='Any') == ['replay-2', 'replay-1', 'replay-0']
+        assert ids(game_id='ggxx') == []
+        assert ids(p1_name='bob', p2_name='alice') == ['replay-0'], 'Players should match in either order'
+        assert ids(p2_name='ALICE') == ['replay-2', 'replay-0']
+        assert ids(p1_rank='2', p2_rank='1') == ['replay-1', 'replay-0'], 'Ranks should match in either order'
+        assert ids(p1_rank='3') == ['replay-2']
+        assert ids(char1='Ken', char2='Ryu') == ['replay-1', 'replay-0'], 'Characters should match in either order'
+        assert ids(char1='Ryu', char2='Ryu') == ['replay-2']
 
     def test_search(self, app):
         pass
 
+    def test_feeds(self, app):
+        for i, game in enumerate(['sfiii3nr1', 'sfiii3nr1', 'garou']):
+            db.session.add(Replays(id=f'feed-{i}', p1='alice', p2=f'player-{i}', p1_loc='NZ', p2_loc='AU', game=game,
+                                   created=True, failed=False, video_youtube_uploaded=False,
+                                   date_added=datetime.datetime(2022, 1, 1, 0, i)))
+        db.session.commit()
+
+        rv = app.get('/feed/atom')
+        assert rv.status_code == 200
+        assert rv.content_type == 'application/atom+xml'
+        assert len(ET.fromstring(rv.data).findall('{http://www.w3.org/2005/Atom}entry')) == 3
+
+        rv_again = app.get('/feed/atom', headers={'If-None-Match': rv.headers['ETag']})
+        assert rv_again.status_code == 304, 'An unchanged feed should not be sent again'
+
+        rv_again = app.get('/feed/atom', headers={'If-Modified-Since': rv.headers['Last-Modified']})
+        assert rv_again.status_code == 304
+
+        rv = app.get('/feed/game/garou/rss')
+        assert rv.status_code == 200
+        assert rv.content_type == 'application/rss+xml'
+        assert len(ET.fromstring(rv.data).findall('channel/item')) == 1
+
+        rv = app.get('/feed/player/player-0/atom')
+        assert len(ET.fromstring(rv.data).findall('{http://www.w3.org/2005/Atom}entry')) == 1
+
+        assert app.get('/feed/player/nobody/rss').status_code == 200, 'Empty feeds should render'
+        assert app.get('/feed/game/notagame/rss').status_code == 404
+
     def test_robots_and_ads(self, app):
         rv_ads = app.get('/ads.txt')
         rv_robots = app.get('/robots.txt')
@@ -71,10 +347,26 @@ class TestSite:
         assert rv_robots.status_code == 200
 
     def test_sitemap(self, app):
+        db.session.add(Replays(id='sitemap-0', created=True, failed=False, video_processed=True,
+                               date_added=datetime.datetime(2022, 1, 1)))
+        db.session.commit()
+
         rv = app.get('/sitemap.xml')
 
         assert rv.status_code == 200
         assert ET.fromstring(rv.data)
+        assert b'/sitemap/videos-0.xml' in rv.data
+
+        rv = app.get('/sitemap/pages.xml')
+        assert rv.status_code == 200
+        assert ET.fromstring(rv.data)
+
+        rv = app.get('/sitemap/videos-0.xml')
+        assert rv.status_code == 200
+        assert b'/video/sitemap-0' in ET.tostring(ET.fromstring(rv.data))
+        rv.close()
+
+        assert app.get('/sitemap/videos-1.xml').status_code == 404
 
         try:
             bad_xml = "foo"
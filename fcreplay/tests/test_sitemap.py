@@ -0,0 +1,94 @@
+import os
+os.environ['FCREPLAY_CONFIG'] = './fcreplay/tests/common/config_test_site.json'
+
+from fcreplay.site.create_app import create_app, db
+from fcreplay.site.models import Replays
+from fcreplay.site.site_config import TestConfig
+from fcreplay.site.sitemap import Sitemap
+import datetime
+import xml.etree.ElementTree as ET
+import pytest
+
+NAMESPACE = {'s': 'http://www.sitemaps.org/schemas/sitemap/0.9'}
+
+
+def add_replays(start, count, **kwargs):
+    for i in range(start, start + count):
+        db.session.add(Replays(
+            id=f"replay-{i:03}",
+            created=True,
+            failed=False,
+            video_processed=True,
+            date_added=datetime.datetime(2022, 1, 1) + datetime.timedelta(minutes=i),
+            **kwargs
+        ))
+    db.session.commit()
+
+
+def video_ids(sitemap, number):
+    tree = ET.parse(sitemap.video_path(number))
+    return [loc.text.rsplit('/', 1)[1] for loc in tree.findall('s:url/s:loc', NAMESPACE)]
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = create_app(TestConfig)
+    app.config['SITEMAP_DIR'] = str(tmp_path / 'sitemap')
+
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture
+def sitemap(app, tmp_path):
+    return Sitemap(str(tmp_path), 'http://example.com/', size=10)
+
+
+def test_chunks(sitemap):
+    add_replays(0, 25)
+    db.session.add(Replays(id='pending', created=False, failed=False, video_processed=False))
+    db.session.commit()
+
+    state = sitemap.update()
+
+    assert [c['count'] for c in state['chunks']] == [10, 10, 5]
+    assert video_ids(sitemap, 0) == [f"replay-{i:03}" for i in range(10)]
+    assert video_ids(sitemap, 2) == [f"replay-{i:03}" for i in range(20, 25)]
+
+
+def test_incremental_update(sitemap):
+    add_replays(0, 25)
+    sitemap.update()
+    full_chunk_mtime = os.stat(sitemap.video_path(1)).st_mtime_ns
+
+    add_replays(25, 10)
+    state = sitemap.update()
+
+    assert [c['count'] for c in state['chunks']] == [10, 10, 10, 5]
+    assert os.stat(sitemap.video_path(1)).st_mtime_ns == full_chunk_mtime, 'Full unchanged files should not be written'
+    assert video_ids(sitemap, 3) == [f"replay-{i:03}" for i in range(30, 35)]
+
+
+def test_removed_replay(sitemap):
+    add_replays(0, 25)
+    sitemap.update()
+
+    db.session.delete(Replays.query.get('replay-005'))
+    db.session.commit()
+    state = sitemap.update()
+
+    assert [c['count'] for c in state['chunks']] == [10, 10, 4]
+    assert 'replay-005' not in video_ids(sitemap, 0)
+    assert not os.path.exists(sitemap.video_path(3))
+
+
+def test_update_if_stale(sitemap):
+    add_replays(0, 5)
+    sitemap.update()
+    add_replays(5, 5)
+
+    assert sitemap.update_if_stale(3600)['chunks'][0]['count'] == 5, 'Fresh sitemap should not be updated'
+    assert sitemap.update_if_stale(0)['chunks'][0]['count'] == 10
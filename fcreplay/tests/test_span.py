@@ -0,0 +1,28 @@
+from fcreplay.span import Span, prometheus_text
+import pytest
+import subprocess
+import sys
+
+
+class TestSpan:
+    def test_span(self):
+        with Span('encode') as span:
+            subprocess.run([sys.executable, '-c', 'sum(range(10 ** 6)); bytearray(64 * 2 ** 20)'], check=True)
+
+        assert span.duration > 0
+        assert span.cpu_seconds > 0, 'CPU time of child processes should be counted'
+        assert span.peak_rss >= 64 * 2 ** 20, 'Peak RSS of child processes should be counted'
+        assert not span.failed
+
+        with pytest.raises(RuntimeError):
+            with Span('upload_to_ia') as failed:
+                raise RuntimeError
+        assert failed.failed
+
+    def test_prometheus_text(self):
+        with Span('encode') as span:
+            pass
+
+        lines = prometheus_text([span], labels={'game': 'say "hi"'}).splitlines()
+        assert '# TYPE fcreplay_stage_cpu_seconds gauge' in lines
+        assert f'fcreplay_stage_peak_rss_bytes{{game="say \\"hi\\"",stage="encode"}} {span.peak_rss}' in lines
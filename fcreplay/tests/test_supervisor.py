@@ -0,0 +1,104 @@
+from fcreplay.supervisor import Supervisor
+from fcreplay.tests.fakedocker import wait_for
+
+import threading
+
+
+class TestSupervisor:
+    def supervisor(self, clock):
+        return Supervisor(clock=lambda: clock[0], uniform=lambda a, b: b)
+
+    def test_schedule(self):
+        clock = [0]
+        supervisor = self.supervisor(clock)
+        runs = []
+        supervisor.add('job', lambda: runs.append(clock[0]), 10, 20, start_delay=5)
+
+        try:
+            assert supervisor.run_pending() == [], 'First run should wait for the start delay'
+            clock[0] = 5
+            assert supervisor.run_pending() == ['job']
+            wait_for(lambda: not supervisor.jobs['job'].running)
+
+            clock[0] = 24
+            assert supervisor.run_pending() == []
+            clock[0] = 25
+            assert supervisor.run_pending() == ['job'], 'Next run should be max_interval after the last one'
+            wait_for(lambda: len(runs) == 2)
+        finally:
+            supervisor.stop()
+
+    def test_overlap(self):
+        clock = [0]
+        supervisor = self.supervisor(clock)
+        release = threading.Event()
+        supervisor.add('slow', release.wait, 1)
+
+        try:
+            assert supervisor.run_pending() == ['slow']
+            clock[0] = 100
+            assert supervisor.run_pending() == [], 'A running job should not start again'
+
+            supervisor.trigger('slow')
+            release.set()
+            wait_for(lambda: not supervisor.jobs['slow'].running)
+            assert supervisor.jobs['slow'].next_run == 100, 'A trigger while running should run the job after it'
+            assert supervisor.run_pending() == ['slow']
+        finally:
+            release.set()
+            supervisor.stop()
+
+    def test_metrics(self):
+        clock = [0]
+        supervisor = self.supervisor(clock)
+
+        def fail():
+            raise ValueError('failed')
+
+        supervisor.add('ok', lambda: None, 60)
+        supervisor.add('fail', fail, 60)
+        try:
+            supervisor.run_pending()
+            wait_for(lambda: not any(j.running for j in supervisor.jobs.values()))
+        finally:
+            supervisor.stop()
+
+        lines = supervisor.render().splitlines()
+        assert 'fcreplay_job_runs_total{job="ok",result="success"} 1.0' in lines
+        assert 'fcreplay_job_runs_total{job="fail",result="error"} 1.0' in lines
+        assert 'fcreplay_job_duration_seconds_count{job="ok"} 1' in lines
+        assert supervisor.jobs['fail'].next_run == 60, 'A failed job should run again at its next time'
+
+    def test_base_exception(self):
+        clock = [0]
+        supervisor = self.supervisor(clock)
+
+        def exit():
+            raise SystemExit(1)
+
+        supervisor.add('exit', exit, 60)
+        try:
+            assert supervisor.run_pending() == ['exit']
+            wait_for(lambda: not supervisor.jobs['exit'].running)
+        finally:
+            supervisor.stop()
+
+        assert supervisor.jobs['exit'].next_run == 60, 'A job exiting should still be scheduled again'
+        assert 'fcreplay_job_runs_total{job="exit",result="error"} 1.0' in supervisor.render().splitlines()
+
+    def test_run_forever(self):
+        supervisor = Supervisor()
+        ran = threading.Event()
+        supervisor.add('job', ran.set, 3600)
+
+        thread = threading.Thread(target=supervisor.run_forever, kwargs={'tick': 60})
+        thread.start()
+        try:
+            assert ran.wait(5), 'Adding a job should wake the loop'
+            ran.clear()
+            supervisor.trigger('job')
+            assert ran.wait(5), 'A triggered job should run without waiting for the tick'
+        finally:
+            supervisor.stop()
+            thread.join(5)
+        assert not thread.is_alive()
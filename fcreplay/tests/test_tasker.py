@@ -1,5 +1,7 @@
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
+from fcreplay import metrics
 from fcreplay.tasker import Tasker
+from fcreplay.tests.fakedocker import FakeDockerClient, wait_for
 
 
 class TestTasker:
@@ -8,28 +10,100 @@ class TestTasker:
         t = Tasker()
         return t
 
-    def test_check_for_replay(self, capsys):
+    def test_collect_metrics(self):
         tasker = self.tasker()
-        tasker.max_instances = 1
-
-        with patch.object(Tasker, 'number_of_instances', return_value=1), capsys.disabled():
-            assert tasker.check_for_replay() is False, 'Should return false when max_number_of_instances reached'
-
-        with patch.object(Tasker, 'number_of_instances', return_value=0):
-            with patch.object(Tasker, 'launch_fcreplay') as launch_fcreplay:
-                tasker.db.get_oldest_player_replay.return_value = True
-                assert tasker.check_for_replay() is True, 'Should return true'
-                capture = capsys.readouterr()
-                assert 'Found player replay' in capture.out, 'Should find player replay'
-                assert launch_fcreplay.assert_called, 'Should launch fcreplay'
-
-                tasker.db.get_oldest_player_replay.return_value = None
-                tasker.db.get_oldest_replay.return_value = True
-                assert tasker.check_for_replay() is True, 'Should return true'
-                capture = capsys.readouterr()
-                assert 'Found replay' in capture.out, 'Should find player replay'
-                assert launch_fcreplay.assert_called, 'Should launch fcreplay'
-
-                tasker.db.get_oldest_player_replay.return_value = None
-                tasker.db.get_oldest_replay.return_value = None
-                assert tasker.check_for_replay() is False, 'Should return false'
+        tasker.db.get_replay_counts.return_value = metrics.ReplayCounts({'ADDED': 4}, {}, 2, 1)
+        tasker.launches.inc()
+
+        with patch.object(Tasker, 'number_of_instances', return_value=1):
+            lines = tasker.collect_metrics().splitlines()
+
+        assert 'fcreplay_queue_depth{status="ADDED"} 4' in lines
+        assert 'fcreplay_tasker_instances 1' in lines
+        assert 'fcreplay_tasker_launches_total 1.0' in lines
+
+    def test_fill_capacity(self, capsys):
+        tasker = self.tasker()
+        tasker.max_instances = 3
+        replays = [MagicMock(id=f'replay-{i}', length=600, game='sfiii3nr1') for i in range(3)]
+
+        with patch.object(Tasker, 'number_of_instances', return_value=3), patch.object(Tasker, 'launch_fcreplay') as launch_fcreplay:
+            tasker.fill_capacity()
+        assert 'Maximum number of instances (3) reached' in capsys.readouterr().out
+        launch_fcreplay.assert_not_called()
+
+        tasker.instance_replays = {'fcreplay-instance-0': 'starting'}
+        tasker.db.get_pending_replays.return_value = replays[:2]
+        with patch.object(Tasker, 'number_of_instances', return_value=1), \
+                patch.object(Tasker, 'launch_fcreplay') as launch_fcreplay, \
+                patch.object(tasker.scheduler, 'admit', return_value=(True, '')):
+            tasker.fill_capacity()
+        assert tasker.db.get_pending_replays.call_args[0][0] == 2, 'Only replays for the free slots should be fetched'
+        assert list(tasker.db.get_pending_replays.call_args[1]['exclude']) == ['starting'], \
+            'Replays of starting instances should be left out'
+        assert [c[0][0] for c in launch_fcreplay.call_args_list] == replays[:2], 'One instance should start per replay'
+
+        tasker.db.get_pending_replays.return_value = replays
+        with patch.object(Tasker, 'number_of_instances', return_value=0), \
+                patch.object(Tasker, 'launch_fcreplay') as launch_fcreplay, \
+                patch.object(tasker.scheduler, 'admit', side_effect=[(True, ''), (True, ''), (False, 'Low disk')]):
+            tasker.fill_capacity()
+        assert launch_fcreplay.call_count == 2, 'Instances should start until resources run out'
+
+        tasker.db.get_pending_replays.return_value = []
+        with patch.object(Tasker, 'number_of_instances', return_value=0), patch.object(Tasker, 'launch_fcreplay') as launch_fcreplay:
+            tasker.fill_capacity()
+        launch_fcreplay.assert_not_called()
+
+    def test_instances(self, tmp_path, monkeypatch):
+        monkeypatch.setattr('fcreplay.tasker.AVI_STORAGE_DIR', str(tmp_path))
+        for name in ['CPUS', 'MEMORY', 'CLIENT_SECRETS', 'CONFIG', 'DESCRIPTION_APPEND', 'IA', 'ROMS',
+                     'YOUTUBE_UPLOAD_CREDENTIALS', 'AVI_TEMP_DIR', 'BAD_WORDS_FILE']:
+            monkeypatch.setenv(name, '1')
+        monkeypatch.setenv('FCREPLAY_NETWORK', 'bridge,world')
+
+        client = FakeDockerClient(networks=['bridge', 'world'])
+        with patch('fcreplay.tasker.Database'):
+            tasker = Tasker(docker_client=client)
+        assert tasker.check_for_docker_network()
+
+        tasker.supervisor.trigger = MagicMock()
+        try:
+            tasker.launch_fcreplay(MagicMock(id='replay-0', length=600, game='sfiii3nr1'))
+            assert tasker.number_of_instances() == 1, 'Launched instances should be counted straight away'
+            assert client.containers.all[0].run_kwargs['environment'] == {'FCREPLAY_CHALLENGE_ID': 'replay-0'}
+            assert client.networks.get('world').connected, 'Instance should be added to the other networks'
+
+            name, instance_uuid = list(tasker.started_instances.items())[0]
+            (tmp_path / instance_uuid).mkdir()
+            tasker.remove_temp_dirs()
+            assert (tmp_path / instance_uuid).exists(), 'Temp dirs of running instances should be kept'
+
+            client.containers.all[0].stop()
+            wait_for(lambda: tasker.supervisor.trigger.called)
+            tasker.supervisor.trigger.assert_called_with('recorder')
+            assert tasker.number_of_instances() == 0
+
+            tasker.remove_temp_dirs()
+            assert not (tmp_path / instance_uuid).exists()
+            assert tasker.started_instances == {}
+            assert tasker.instance_replays == {}
+            assert client.containers.list_calls == 1, 'Containers should only be listed once'
+        finally:
+            tasker.containers.stop()
+
+    def test_start_all(self, monkeypatch):
+        monkeypatch.setenv('FCREPLAY_NETWORK', 'bridge')
+        monkeypatch.setenv('GET_WEEKLY', 'true')
+        monkeypatch.delenv('MAX_INSTANCES', raising=False)
+        with patch('fcreplay.tasker.Database'):
+            tasker = Tasker(docker_client=FakeDockerClient())
+
+        with patch.object(tasker.supervisor, 'run_forever') as run_forever:
+            tasker.start_all(max_instances='2')
+        run_forever.assert_called_once()
+        assert tasker.max_instances == 2
+        assert sorted(tasker.supervisor.jobs) == [
+            'check_top_weekly', 'check_video_status', 'delete_failed_replays', 'recorder', 'retry_failed_replays'
+        ]
+        tasker.supervisor.stop()
@@ -0,0 +1,99 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from fcreplay.videostatus import RateLimiter, VideoStatusChecker
+
+import pytest
+import threading
+import time
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_HEAD(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.command, self.path))
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+
+        try:
+            if 'slow' in self.path:
+                time.sleep(2)
+            elif 'flaky' in self.path and server.requests.count(('HEAD', self.path)) == 1:
+                self.send_response(503)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            else:
+                time.sleep(0.05)
+
+            self.send_response(200 if 'ready' in self.path else 404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.requests = []
+    server.in_flight = 0
+    server.max_in_flight = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def replay(challenge_id, youtube_id=None):
+    return SimpleNamespace(id=challenge_id, video_youtube_uploaded=youtube_id is not None, video_youtube_id=youtube_id)
+
+
+class TestVideoStatus:
+    def checker(self, server, **kwargs):
+        base = f"http://127.0.0.1:{server.server_address[1]}"
+        return VideoStatusChecker(
+            youtube_url=base + '/yt/{id}', archive_url=base + '/ia/{id}', backoff=0, **kwargs
+        )
+
+    def test_check_all(self, stub_server):
+        checker = self.checker(stub_server, workers=4, rate=1000)
+        replays = [replay(f"ready-{i}@sfiii3nr1") for i in range(8)] + [replay('missing'), replay('yt', 'ready-yt')]
+
+        assert checker.check_all(replays) == [f"ready-{i}@sfiii3nr1" for i in range(8)] + ['yt']
+        assert ('HEAD', '/ia/ready-0-sfiii3nr1') in stub_server.requests
+        assert ('HEAD', '/yt/ready-yt') in stub_server.requests
+        assert {method for method, path in stub_server.requests} == {'HEAD'}
+        assert 1 < stub_server.max_in_flight <= 4, 'Replays should be checked concurrently, up to workers'
+        checker.close()
+
+    def test_retry(self, stub_server):
+        checker = self.checker(stub_server, rate=1000)
+        assert checker.check_all([replay('flaky/ready')]) == ['flaky/ready'], '503 responses should be retried'
+        assert stub_server.requests.count(('HEAD', '/ia/flaky/ready')) == 2
+        checker.close()
+
+    def test_timeout(self, stub_server):
+        checker = self.checker(stub_server, rate=1000, timeout=0.2, retries=0)
+        start = time.monotonic()
+        assert checker.check_all([replay('slow/ready'), replay('ready')]) == ['ready']
+        assert time.monotonic() - start < 1.5, 'A hung request should time out'
+        checker.close()
+
+    def test_rate_limiter(self):
+        clock = [0.0]
+        sleeps = []
+        limiter = RateLimiter(2, clock=lambda: clock[0], sleep=sleeps.append)
+
+        limiter.wait('archive.org')
+        limiter.wait('archive.org')
+        limiter.wait('img.youtube.com')
+        limiter.wait('archive.org')
+        assert sleeps == [0.5, 1.0], 'Requests should be spaced out per host'
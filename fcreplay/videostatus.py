@@ -0,0 +1,119 @@
+"""Check if uploaded replay videos are available yet.
+
+A video is available once its thumbnail exists, on youtube for replays
+uploaded there, otherwise on archive.org. Thumbnails are checked with HEAD
+requests from a thread pool sharing one keep-alive session:
+ - Each request has a timeout, so a hung connection can't stall the check.
+ - Requests to each host are limited to RATE per second.
+ - 429 and 5xx responses, and connection errors, are retried with
+   exponential backoff, honouring Retry-After.
+
+Example:
+    available = VideoStatusChecker().check_all(db.get_unprocessed_replays())
+    db.set_replays_processed(available)
+"""
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+from urllib3.util.retry import Retry
+
+import collections
+import logging
+import requests
+import threading
+import time
+
+log = logging.getLogger('fcreplay')
+
+YOUTUBE_THUMBNAIL = 'http://img.youtube.com/vi/{id}/0.jpg'
+ARCHIVE_THUMBNAIL = 'https://archive.org/download/{id}/__ia_thumb.jpg'
+
+WORKERS = 8
+TIMEOUT = 10
+RATE = 5  # Requests per second to each host
+RETRIES = 3
+BACKOFF = 1  # Seconds before the first retry, doubled for each retry
+
+
+class RateLimiter:
+    def __init__(self, rate, clock=time.monotonic, sleep=time.sleep):
+        """Space out calls to each host, to at most rate per second."""
+        self.interval = 1 / rate
+        self.clock = clock
+        self.sleep = sleep
+        self._next = collections.defaultdict(float)
+        self._lock = threading.Lock()
+
+    def wait(self, host):
+        """Wait for the next free slot for host."""
+        with self._lock:
+            now = self.clock()
+            slot = max(now, self._next[host])
+            self._next[host] = slot + self.interval
+        if slot > now:
+            self.sleep(slot - now)
+
+
+class VideoStatusChecker:
+    def __init__(self, workers=WORKERS, timeout=TIMEOUT, rate=RATE, retries=RETRIES, backoff=BACKOFF,
+                 youtube_url=YOUTUBE_THUMBNAIL, archive_url=ARCHIVE_THUMBNAIL):
+        """Check replay thumbnails, see the module docstring.
+
+        Args:
+            workers (int, optional): Requests in flight at once
+            timeout (int, optional): Seconds to wait to connect, and for a response
+            rate (int, optional): Requests per second to each host
+            retries (int, optional): Retries for errors and 429 or 5xx responses
+            backoff (int, optional): Seconds before the first retry
+            youtube_url (str, optional): Youtube thumbnail url, formatted with id
+            archive_url (str, optional): archive.org thumbnail url, formatted with id
+        """
+        self.workers = workers
+        self.timeout = timeout
+        self.limiter = RateLimiter(rate)
+        self.youtube_url = youtube_url
+        self.archive_url = archive_url
+
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=['HEAD'],
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def url(self, replay) -> str:
+        """Return the thumbnail url for a replay."""
+        if replay.video_youtube_uploaded:
+            return self.youtube_url.format(id=replay.video_youtube_id)
+        return self.archive_url.format(id=replay.id.replace('@', '-'))
+
+    def check(self, replay) -> bool:
+        """Return true if the replay's thumbnail exists."""
+        url = self.url(replay)
+        self.limiter.wait(urlsplit(url).netloc)
+        try:
+            r = self.session.head(url, timeout=self.timeout, allow_redirects=True)
+        except requests.exceptions.RequestException as e:
+            log.warning(f"Caught exception: {e}, when checking {replay.id}")
+            return False
+
+        log.debug(f"ID: {replay.id}, Url: {url}, Status: {r.status_code}")
+        return r.status_code == 200
+
+    def check_all(self, replays) -> list:
+        """Check replays concurrently.
+
+        Returns:
+            list: Ids of the replays with a thumbnail
+        """
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='video-status') as executor:
+            results = executor.map(self.check, replays)
+            return [replay.id for replay, available in zip(replays, results) if available]
+
+    def close(self):
+        self.session.close()
@@ -1,3 +1,3 @@
 #!/bin/bash
 cd /app/
-waitress-serve --port=80 'fcreplay.site.app:app'
+waitress-serve --port=80 --threads=${SITE_THREADS:-8} 'fcreplay.site.app:app'